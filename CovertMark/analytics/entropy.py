@@ -2,7 +2,7 @@ from . import constants
 
 import scipy.stats
 import numpy as np
-from math import log, floor
+from math import floor
 from os import urandom
 from collections import defaultdict
 
@@ -32,21 +32,80 @@ class EntropyAnalyser:
         :raises ValueError: on an invalid block size or request size.
         """
 
+        requested_bytes = self._random_byte_array(request_size, block_size).tobytes()
+        blocks = [requested_bytes[i:i+block_size] for i in range(0, len(requested_bytes), block_size)]
+
+        return blocks
+
+
+    def _random_byte_array(self, request_size, block_size):
+        """
+        Return uniformly distributed bytes as in :meth:`request_random_bytes`,
+        as a NumPy array viewing the constant sample without copying.
+
+        :param int request_size: the size of requested uniformly distributed bytes.
+        :param int block_size: the number of bytes in each block.
+        :returns: a uint8 NumPy array of the size required.
+        :raises ValueError: on an invalid block size or request size.
+        """
+
         if request_size < 1 or not isinstance(request_size, int):
             raise ValueError("Request size must be a positive integer.")
 
         if not isinstance(block_size, int) or block_size > request_size:
             raise ValueError("Block size must be a positive integer and smaller than request size.")
 
-        if request_size <= len(self.random_bytes):
-            requested_bytes = self.random_bytes[:request_size]
-        else:
+        if request_size > len(self.random_bytes):
             self.random_bytes = sorted([np.random.bytes(request_size) for i in range(5)], key=EntropyAnalyser.byte_entropy)[-1]
-            requested_bytes = self.random_bytes
 
-        blocks = [requested_bytes[i:i+block_size] for i in range(0, len(requested_bytes), block_size)]
+        return np.frombuffer(self.random_bytes, dtype=np.uint8, count=request_size)
 
-        return blocks
+
+    @staticmethod
+    def _byte_array(input_bytes):
+        """
+        View bytes-like input as a NumPy array of bytes without copying, so that
+        payloads can be supplied as `bytes`, `memoryview` slices of a payload
+        arena, or uint8 NumPy arrays.
+
+        :param input_bytes: input in bytes, bytearray, memoryview or uint8 array.
+        :returns: a one-dimensional uint8 NumPy array, None if input not bytes-like.
+        """
+
+        if isinstance(input_bytes, np.ndarray):
+            if input_bytes.dtype != np.uint8:
+                return None
+            return input_bytes.ravel()
+
+        if isinstance(input_bytes, (bytes, bytearray, memoryview)):
+            return np.frombuffer(input_bytes, dtype=np.uint8)
+
+        return None
+
+
+    @staticmethod
+    def _block_entropies(byte_array, block_size):
+        """
+        Calculate the shannon entropy of each block of a fixed size in the input,
+        discarding the remainder.
+
+        :param numpy.ndarray byte_array: input as a uint8 NumPy array.
+        :param int block_size: the number of bytes in each block.
+        :returns: a NumPy array of the base 2 shannon entropy of each block.
+        """
+
+        block_count = len(byte_array) // block_size
+        blocks = byte_array[:block_count*block_size].reshape(block_count, block_size)
+
+        # Count byte values of all blocks at once, offsetting each block's values.
+        offset_values = blocks.astype(np.int64) + (np.arange(block_count) * 256)[:, np.newaxis]
+        counts = np.bincount(offset_values.ravel(), minlength=block_count*256).reshape(block_count, 256)
+
+        probabilities = counts / float(block_size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = np.where(counts > 0, probabilities * np.log2(probabilities), 0.0)
+
+        return -terms.sum(axis=1)
 
 
     @staticmethod
@@ -54,32 +113,18 @@ class EntropyAnalyser:
         """
         Calculate the shannon entropy of the input bytes.
 
-        :param bytes input_bytes: input in bytes.
+        :param bytes input_bytes: input in bytes, or a bytes-like view of them.
         :returns: the base 2 shannon entropy of input_bytes.
         """
 
-        if not isinstance(input_bytes, bytes) or len(input_bytes) == 0:
+        byte_array = EntropyAnalyser._byte_array(input_bytes)
+        if byte_array is None or len(byte_array) == 0:
             return 0
 
-        byte_array = [input_bytes[i:i+1] for i in range(len(input_bytes))]
-        occurances = {}
-        total = 0
-        for s in byte_array:
-            if s in occurances:
-                occurances[s] += 1
-            else:
-                occurances[s] = 1
-            total += 1
-
-        probabilities = {}
-        for occurance in occurances:
-            probabilities[occurance] = float(occurances[occurance]) / float(total)
+        counts = np.bincount(byte_array, minlength=256)
+        probabilities = counts[counts > 0] / float(len(byte_array))
 
-        entropy = 0
-        for p in probabilities:
-            entropy += -1 * probabilities[p] * log(probabilities[p], 2)
-
-        return entropy
+        return float(-np.sum(probabilities * np.log2(probabilities)))
 
 
     def anderson_darling_dist_test(self, input_bytes, block_size):
@@ -88,7 +133,7 @@ class EntropyAnalyser:
         input_bytes was likely drawn from the same distribution as a random
         distribution, based on Shannon entropy of individual blocks of fixed size.
 
-        :param bytes input_bytes: input in bytes to be tested.
+        :param bytes input_bytes: input in bytes to be tested, or a bytes-like view of them.
         :param int block_size: the block size for each entropy-calculation block.
         :returns: `{min_threshold, p}`, where min_threshold is
             the minimum threshold in float under which the null hypothesis can
@@ -100,21 +145,18 @@ class EntropyAnalyser:
         :raises ValueError: if block size is greater than the amount of bytes supplied.
         """
 
-        if not isinstance(input_bytes, bytes) or not isinstance(block_size, int):
+        byte_array = self._byte_array(input_bytes)
+        if byte_array is None or not isinstance(block_size, int):
             raise TypeError("input_bytes must be in bytes and block_size must be an integer.")
 
-        if len(input_bytes) < block_size:
+        if len(byte_array) < block_size:
             raise ValueError("Block size is greater than the amount of bytes input.")
 
-        # Chop up the input.
-        remainders = len(input_bytes) % block_size
-        if remainders > 0: # in Python a[:-0] will result in an empty string.
-            input_bytes = input_bytes[:-remainders]
-        blocks = [input_bytes[i:i+block_size] for i in range(0, len(input_bytes), block_size)]
-
-        # Calculate each block's entropy as well as a uniform random distribution's.
-        block_entropies = [self.byte_entropy(block) for block in blocks]
-        random_entropies = [self.byte_entropy(block) for block in self.request_random_bytes(len(input_bytes), block_size)]
+        # Calculate each block's entropy as well as a uniform random distribution's,
+        # discarding the remainder.
+        tested_size = len(byte_array) - len(byte_array) % block_size
+        block_entropies = self._block_entropies(byte_array[:tested_size], block_size)
+        random_entropies = self._block_entropies(self._random_byte_array(tested_size, block_size), block_size)
 
         # Compare them with Anderson-Darling.
         try:
@@ -153,7 +195,7 @@ class EntropyAnalyser:
         input_bytes was likely drawn from the same distribution as a random
         distribution, based on Shannon entropy of individual blocks of fixed size.
 
-        :param bytes input_bytes: input in bytes to be tested.
+        :param bytes input_bytes: input in bytes to be tested, or a bytes-like view of them.
         :param int block_size: an integer block size for entropy-calculation block.
         :returns: the p-value from the KS two-sample test, hypothesis rejectable
             if p is very small (usually <0.1), meaning that likely drawn from non-
@@ -163,21 +205,18 @@ class EntropyAnalyser:
         :raises ValueError: if block size is greater than the amount of bytes supplied.
         """
 
-        if not isinstance(input_bytes, bytes) or not isinstance(block_size, int):
+        byte_array = self._byte_array(input_bytes)
+        if byte_array is None or not isinstance(block_size, int):
             raise TypeError("input_bytes must be in bytes and block_size must be an integer.")
 
-        if len(input_bytes) < block_size:
+        if len(byte_array) < block_size:
             raise ValueError("Block size is greater than the amount of bytes input.")
 
-        # Chop up the input into equal chunks, discarding remainder.
-        remainders = len(input_bytes) % block_size
-        if remainders > 0: # in Python a[:-0] will result in an empty string.
-            input_bytes = input_bytes[:-remainders]
-        blocks = [input_bytes[i:i+block_size] for i in range(0, len(input_bytes), block_size)]
-
-        # Calculate each block's entropy as well as a uniform random distribution's.
-        block_entropies = [self.byte_entropy(block) for block in blocks]
-        random_entropies = [self.byte_entropy(block) for block in self.request_random_bytes(len(input_bytes), block_size)]
+        # Calculate each block's entropy as well as a uniform random distribution's,
+        # discarding the remainder.
+        tested_size = len(byte_array) - len(byte_array) % block_size
+        block_entropies = self._block_entropies(byte_array[:tested_size], block_size)
+        random_entropies = self._block_entropies(self._random_byte_array(tested_size, block_size), block_size)
 
         # Perform the KS 2-sample test.
         statistic, p = scipy.stats.ks_2samp(block_entropies, random_entropies)
@@ -190,20 +229,19 @@ class EntropyAnalyser:
         Perform a Kolmogorov-Smirnov distribution hypothesis test on on whether the
         input_bytes was likely uniformly distributed (not by entropy value).
 
-        :param bytes input_bytes: input in bytes to be tested.
+        :param bytes input_bytes: input in bytes to be tested, or a bytes-like view of them.
         :returns: the p-value from the KS two-sample test, hypothesis rejectable
             if p is very small (usually <0.1), meaning input likely not uniformly
             distributed.
         :raises TypeError: if the input were not supplied as bytes.
         """
 
-        if not isinstance(input_bytes, bytes):
+        input_dist = self._byte_array(input_bytes)
+        if input_dist is None:
             raise TypeError("input_bytes must be in bytes.")
 
-        # Perform the KS uniform distribution test.
-        input_dist = [input_bytes[i:i+1].hex() for i in range(len(input_bytes))]
-        random_bytes = self.request_random_bytes(len(input_dist), 1)
-        uniform_dist = [i.hex() for i in random_bytes]
+        # Perform the KS uniform distribution test on byte values.
+        uniform_dist = self._random_byte_array(len(input_dist), 1)
         statistic, p = scipy.stats.ks_2samp(input_dist, uniform_dist)
 
         return p
@@ -215,15 +253,17 @@ class EntropyAnalyser:
         through the payload bytes and counting the number of distinct values in each
         window. A fast, low-leading constant O(n) operation.
 
-        :param bytes input_bytes: input in bytes to be tested.
+        :param bytes input_bytes: input in bytes to be tested, or a bytes-like view of them.
         :param int window_size: the size of the sliding window.
         :returns: the mean proportion of windows tested with distinct values.
         :raises TypeError: if the input were not supplied as bytes.
         """
 
-        if not isinstance(input_bytes, bytes):
+        byte_array = self._byte_array(input_bytes)
+        if byte_array is None:
             raise TypeError("input_bytes must be in bytes.")
-        
+        input_bytes = byte_array.tolist()
+
         # We cannot find any if the window is over-sized.
         if window_size > len(input_bytes):
             return 0
@@ -3,7 +3,6 @@ from ..data import utils as data_utils
 
 import numpy as np
 from scipy import stats
-from sklearn.cluster import MeanShift, estimate_bandwidth
 from operator import itemgetter
 from collections import Counter, defaultdict
 
@@ -30,33 +29,10 @@ def ordered_tcp_payload_length_frequency(packets, tls_only=False, bandwidth=3):
         seen non-Large Segment Offload traces captured on devices.
     """
 
-    # Collect the lengths.
-    lengths = []
-    for packet in packets:
-        if packet['tcp_info'] is None:
-            continue
-        elif tls_only and packet['tls_info'] is None:
-            continue
-        elif len(packet['tcp_info']['payload']) > constants.MTU_FRAME_AVOIDANCE_THRESHOLD_CLUSTERING:
-            continue
-        else:
-            lengths.append(len(packet['tcp_info']['payload']))
+    histogram = tcp_payload_length_histogram(packets, tls_only,
+     constants.MTU_FRAME_AVOIDANCE_THRESHOLD_CLUSTERING)
 
-    # Cluster the lengths.
-    lengths = np.array(list(zip(lengths, np.zeros(len(lengths)))), dtype=np.int)
-    meanshift = MeanShift(bandwidth=bandwidth, bin_seeding=True)
-    meanshift.fit(lengths)
-    labels = meanshift.labels_
-    labels_unique = np.unique(labels)
-    n_clusters_ = len(labels_unique)
-
-    # Return the top clusters in order.
-    clusters = []
-    for i in range(n_clusters_):
-        members = (labels == i)
-        clusters.append(set(lengths[members, 0]))
-
-    return clusters
+    return cluster_length_histogram(histogram, bandwidth)
 
 
 def ordered_udp_payload_length_frequency(packets, bandwidth=3):
@@ -75,30 +51,168 @@ def ordered_udp_payload_length_frequency(packets, bandwidth=3):
     """
 
     # Collect the lengths.
+    lengths = [packet['len'] for packet in packets if packet['proto'] == "UDP"]
+    histogram = length_histogram(lengths, constants.MTU_FRAME_AVOIDANCE_THRESHOLD_CLUSTERING)
+
+    return cluster_length_histogram(histogram, bandwidth)
+
+
+def length_histogram(lengths, max_length=None):
+    """
+    Count the occurrences of each integer length, so that length-based
+    analysis can be carried out in time proportional to the largest length
+    rather than the number of packets.
+
+    :param list lengths: a list or array of non-negative integer lengths.
+    :param int max_length: if not None, lengths above it will not be counted.
+    :returns: a 1-D numpy array indexed by length, containing the number of
+        occurrences of that length.
+    """
+
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if max_length is not None:
+        lengths = lengths[lengths <= max_length]
+
+    if len(lengths) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    return np.bincount(lengths)
+
+
+def counts_to_histogram(length_counts, max_length=None):
+    """
+    Convert a mapping of lengths and their number of occurrences, such as one
+    summarised by MongoDB, into a histogram as produced by :func:`length_histogram`.
+
+    :param dict length_counts: a dict mapping non-negative integer lengths to
+        their number of occurrences.
+    :param int max_length: if not None, lengths above it will not be counted.
+    :returns: a 1-D numpy array indexed by length, containing the number of
+        occurrences of that length.
+    """
+
+    lengths = [i for i in length_counts if max_length is None or i <= max_length]
+    if len(lengths) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    histogram = np.zeros(max(lengths) + 1, dtype=np.int64)
+    for length in lengths:
+        histogram[length] = length_counts[length]
+
+    return histogram
+
+
+def tcp_payload_length_histogram(packets, tls_only=False, max_length=None):
+    """
+    Build a histogram of TCP payload lengths from the input packets.
+
+    :param list packets: a list of parsed packets, non-tcp packets will be ignored.
+    :param bool tls_only: if True ignoring non-TLS frames.
+    :param int max_length: if not None, payloads longer than it will not be
+        counted.
+    :returns: a 1-D numpy array indexed by payload length, see :func:`length_histogram`.
+    """
+
     lengths = []
     for packet in packets:
-        if packet['proto'] != "UDP":
+        if packet['tcp_info'] is None:
             continue
-        elif len(packet['len']) > constants.MTU_FRAME_AVOIDANCE_THRESHOLD_CLUSTERING:
+        elif tls_only and packet['tls_info'] is None:
             continue
         else:
-            lengths.append(packet['len'])
+            lengths.append(packet['tcp_info'].get('payload_len', len(packet['tcp_info']['payload'])))
 
-    # Cluster the lengths.
-    lengths = np.array(list(zip(lengths, np.zeros(len(lengths)))), dtype=np.int)
-    meanshift = MeanShift(bandwidth=bandwidth, bin_seeding=True)
-    meanshift.fit(lengths)
-    labels = meanshift.labels_
-    labels_unique = np.unique(labels)
-    n_clusters_ = len(labels_unique)
+    return length_histogram(lengths, max_length)
 
-    # Return the top clusters in order.
-    clusters = []
-    for i in range(n_clusters_):
-        members = (labels == i)
-        clusters.append(set(lengths[members, 0]))
 
-    return clusters
+def cluster_length_histogram(histogram, bandwidth=3, max_iter=300):
+    """
+    Flat-kernel mean shift clustering of integer lengths, operating on their
+    histogram rather than on individual points. Approximates
+    :class:`sklearn.cluster.MeanShift` with `bin_seeding` on one-dimensional
+    input, including its fallback to seeding from the lengths themselves when
+    binning does not reduce them, but each shift only costs two prefix sum
+    lookups, so clustering takes O(n + L) time for n lengths bounded by L.
+    Tied modes are ordered by descending centre as in scikit-learn, although
+    lengths or centres exactly a bandwidth apart may be grouped differently, as
+    scikit-learn's neighbour searches round such distances either way.
+
+    :param histogram: a 1-D array indexed by length, as produced by
+        :func:`length_histogram`.
+    :param int bandwidth: the maximum distance within clusters, i.e. max difference
+        between lengths.
+    :param int max_iter: maximum number of shifts for each seed.
+    :returns: a list of sets containing clustered lengths ordered from most
+        frequent to least. Empty if the histogram contains no lengths.
+    :raises ValueError: if the bandwidth is not positive.
+    """
+
+    if bandwidth <= 0:
+        raise ValueError("Bandwidth must be positive.")
+
+    histogram = np.asarray(histogram, dtype=np.int64)
+    lengths = np.flatnonzero(histogram)
+    if len(lengths) == 0:
+        return []
+
+    # Prefix sums of counts and of length-weighted counts, allowing the count
+    # and sum of lengths within any window to be found in constant time.
+    max_length = len(histogram) - 1
+    count_sums = np.concatenate(([0], np.cumsum(histogram)))
+    weight_sums = np.concatenate(([0], np.cumsum(histogram * np.arange(len(histogram)))))
+
+    def window(centres):
+        lower = np.clip(np.ceil(centres - bandwidth), 0, max_length + 1).astype(np.int64)
+        upper = np.clip(np.floor(centres + bandwidth) + 1, 0, max_length + 1).astype(np.int64)
+        return count_sums[upper] - count_sums[lower], weight_sums[upper] - weight_sums[lower]
+
+    # Seed from lengths binned to a grid of bandwidth-sized bins, or from the
+    # lengths themselves if every length falls in a bin of its own, dropping
+    # seeds with no length within reach.
+    centres = np.unique(np.round(lengths / bandwidth)) * bandwidth
+    if len(centres) == count_sums[-1]:
+        centres = lengths.astype(np.float64)
+    counts, _ = window(centres)
+    centres = centres[counts > 0]
+
+    # Shift all seeds simultaneously until each of them converges.
+    intensities = np.zeros(len(centres), dtype=np.int64)
+    active = np.ones(len(centres), dtype=bool)
+    stop_threshold = 1e-3 * bandwidth
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        counts, weights = window(centres[active])
+        shifted = weights / counts
+        intensities[active] = counts
+        converged = np.abs(shifted - centres[active]) <= stop_threshold
+        centres[active] = shifted
+        active[np.flatnonzero(active)[converged]] = False
+
+    # Keep the most intense centre amongst those within bandwidth of each other.
+    order = sorted(range(len(centres)), key=lambda i: (intensities[i], centres[i]), reverse=True)
+    kept = []
+    for i in order:
+        if all(abs(centres[i] - centres[k]) > bandwidth for k in kept):
+            kept.append(i)
+    kept_centres = centres[kept]
+
+    # Assign each length to its nearest centre, ties to the more intense one.
+    ascending = np.argsort(kept_centres, kind="stable")
+    sorted_centres = kept_centres[ascending]
+    right = np.clip(np.searchsorted(sorted_centres, lengths), 0, len(kept) - 1)
+    left = np.clip(right - 1, 0, len(kept) - 1)
+    left_distance = np.abs(lengths - sorted_centres[left])
+    right_distance = np.abs(lengths - sorted_centres[right])
+    use_right = (right_distance < left_distance) | \
+     ((right_distance == left_distance) & (ascending[right] < ascending[left]))
+    labels = np.where(use_right, ascending[right], ascending[left])
+
+    clusters = [set() for _ in kept]
+    for length, label in zip(lengths.tolist(), labels.tolist()):
+        clusters[label].add(length)
+
+    return [cluster for cluster in clusters if len(cluster) > 0]
 
 
 def window_packets_fixed_size(packets, window_size):
@@ -187,28 +301,26 @@ def group_packets_by_ip_fixed_size(packets, clients, window_size):
         return []
 
     client_packets = defaultdict(list)
+    client_matcher = data_utils.SubnetMatcher(clients)
     for packet in packets:
 
-        packet_srcnet = data_utils.build_subnet(packet['src'])
-        packet_dstnet = data_utils.build_subnet(packet['dst'])
-        packet_client = None
+        # Addresses are matched in their compact form, and the client is keyed
+        # as its single-address subnet.
+        if client_matcher.match_address(packet['src']):
+            packet_client = packet['src']
+            target = packet['dst']
 
-        for client in clients:
-            if client.overlaps(packet_srcnet):
-                packet_client = packet_srcnet
-                target = packet['dst']
-                break
+        elif client_matcher.match_address(packet['dst']):
+            packet_client = packet['dst']
+            target = packet['src']
 
-            elif client.overlaps(packet_dstnet):
-                packet_client = packet_dstnet
-                target = packet['src']
-                break
-
-        if not packet_client:
+        else:
             continue # Irrelevant packet.
 
+        prefix = 32 if data_utils.address_to_int(packet_client)[0] == 4 else 128
+
         # Append here first.
-        client_packets[(str(packet_client), target)].append(packet)
+        client_packets[("{}/{}".format(packet_client, prefix), target)].append(packet)
 
     # Now segment for each client/target pair by fixed size.
     for c in client_packets:
@@ -294,7 +406,8 @@ def get_window_stats(windowed_packets, client_ips, feature_selection=None):
     payload_lengths_up_bins = {(tcp_len_ranges[i-1], tcp_len_ranges[i]): 0 for i in range(1, len(tcp_len_ranges))}
     psh_up = 0
     ack_up = 0
-    packets_up = list(filter(lambda x: any([i.overlaps(data_utils.build_subnet(x['src'])) for i in client_subnets]), windowed_packets))
+    client_matcher = data_utils.SubnetMatcher(client_subnets)
+    packets_up = [i for i in windowed_packets if client_matcher.match_address(i['src'])]
 
     seqs_seen_down = set([])
     entropies_down = []
@@ -304,7 +417,7 @@ def get_window_stats(windowed_packets, client_ips, feature_selection=None):
     payload_lengths_down_bins = {(tcp_len_ranges[i-1], tcp_len_ranges[i]): 0 for i in range(1, len(tcp_len_ranges))}
     psh_down = 0
     ack_down = 0
-    packets_down = list(filter(lambda x: any([i.overlaps(data_utils.build_subnet(x['dst'])) for i in client_subnets]), windowed_packets))
+    packets_down = [i for i in windowed_packets if client_matcher.match_address(i['dst'])]
 
     if len(packets_up) > 0 and len(packets_down) > 0:
         stats['up_down_ratio'] = float(len(packets_up)) / len(packets_down)
@@ -344,7 +457,7 @@ def get_window_stats(windowed_packets, client_ips, feature_selection=None):
                     prev_time = float(packet['time']) * 1000000
 
             # Payload length tally.
-            up_len = len(packet_tcp['payload'])
+            up_len = packet_tcp.get('payload_len', len(packet_tcp['payload'])) # True length if truncated.
             if tcp_len_on:
                 payload_lengths_up.append(up_len)
             if tcp_len_bins_on:
@@ -358,9 +471,10 @@ def get_window_stats(windowed_packets, client_ips, feature_selection=None):
 
             # ACK/PSH information.
             if psh_on:
-                if packet_tcp['flags']['ACK'] == True:
+                flag_bits = data_utils.build_tcp_flags(packet_tcp['flags'])
+                if flag_bits & data_utils.TCP_FLAG_BITS['ACK']:
                     ack_up += 1
-                    if packet_tcp['flags']['PSH'] == True:
+                    if flag_bits & data_utils.TCP_FLAG_BITS['PSH']:
                         psh_up += 1
 
         if entropy_on:
@@ -453,7 +567,7 @@ def get_window_stats(windowed_packets, client_ips, feature_selection=None):
 
 
             # Payload length tally.
-            down_len = len(packet_tcp['payload'])
+            down_len = packet_tcp.get('payload_len', len(packet_tcp['payload'])) # True length if truncated.
             if tcp_len_on:
                 payload_lengths_down.append(down_len)
             if tcp_len_bins_on:
@@ -468,9 +582,10 @@ def get_window_stats(windowed_packets, client_ips, feature_selection=None):
 
             # ACK/PSH information.
             if psh_on:
-                if packet_tcp['flags']['ACK'] == True:
+                flag_bits = data_utils.build_tcp_flags(packet_tcp['flags'])
+                if flag_bits & data_utils.TCP_FLAG_BITS['ACK']:
                     ack_down += 1
-                    if packet_tcp['flags']['PSH'] == True:
+                    if flag_bits & data_utils.TCP_FLAG_BITS['PSH']:
                         psh_down += 1
 
         if entropy_on:
@@ -543,7 +658,7 @@ def synchronise_packets(packets, target_time, sort=False):
     :param float target_time: a valid UNIX timestamp to at least 6 d.p.
     :param bool sort: if True, the function will chronologically sort the input
         packets first.
-    :returns: time shifted input packets.
+    :returns: time shifted copies of input packets, input packets are not modified.
     """
 
     if not isinstance(target_time, float):
@@ -558,7 +673,4 @@ def synchronise_packets(packets, target_time, sort=False):
     packets_start_time = float(packets[0]['time'])
     diff = target_time - packets_start_time
 
-    for packet in packets:
-        packet['time'] = float(packet['time']) + diff
-
-    return packets
+    return [dict(packet, time=float(packet['time']) + diff) for packet in packets]
@@ -23,6 +23,7 @@ DIVIDER = "-" * 40
 PROCEDURE_RUN_FIELDS = ["strategy", "run_order", "user_params", "pt_pcap",
  "pt_filters", "pt_collection", "neg_pcap", "neg_filters", "neg_collection",
  "user_defined_name"]
+PROCEDURE_WORKERS = 4 # Maximum number of procedure runs executed concurrently.
 
 # UI colours.
 class colours:
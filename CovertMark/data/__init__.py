@@ -1 +1 @@
-from . import constants, mongo, parser, retrieve, utils, plot
+from . import constants, backend, mongo, columnar, reader, parser, retrieve, extractor, utils, plot
@@ -0,0 +1,515 @@
+from . import constants
+
+from abc import ABC, abstractmethod
+from threading import Lock
+from collections import OrderedDict
+from collections.abc import Mapping
+from datetime import date
+from os import urandom
+from bson import json_util
+import numpy as np
+import hashlib
+import sys
+
+
+class StorageBackend(ABC):
+    """
+    An abstract storage backend of parsed packet traces, each stored as a named
+    collection with an entry in the trace index describing it. Packets are
+    queried, filtered and projected in MongoDB query syntax regardless of the
+    backend. Implement this class to store traces elsewhere than MongoDB.
+    """
+
+    DECODED_PAYLOADS = False # Set to True if packets are returned with raw
+                             # rather than base64-encoded payloads.
+    PAYLOAD_VIEWS = False # Set to True if raw payloads are returned as memoryview
+                          # slices of a shared buffer rather than bytes.
+    QUERY_ERRORS = () # Exceptions raised by packet queries with invalid filters
+                      # or projections.
+
+    @property
+    @abstractmethod
+    def location(self):
+        """
+        The server or path of the storage, distinguishing traces of the same
+        name held by different storages.
+        """
+        pass
+
+
+    @abstractmethod
+    def lookup_collection(self, collection_name):
+        """
+        Check whether a collection by the name exists.
+
+        :param str collection_name: the name of collection checked.
+        :returns: True if collection name exists, False otherwise.
+        """
+        pass
+
+
+    @abstractmethod
+    def new_collection(self, description="", input_filters=[], derived_fields=False,
+     ingest_profile="full", max_payload_bytes=None):
+        """
+        Create a new trace collection with a name, store and return it.
+
+        :param str description: a description of this trace collection.
+        :param list input_filters: list of tuples (string-format filters, direction)
+            for input filters of this collection.
+        :param bool derived_fields: whether packets of this collection are stored
+            with derived fields.
+        :param str ingest_profile: the ingest profile packets are stored under.
+        :param int max_payload_bytes: the maximum TCP payload bytes stored per
+            packet, None if unlimited.
+        :returns: the name of the new collection, False if failed.
+        """
+        pass
+
+
+    @abstractmethod
+    def index_collection(self, collection_name, background=False):
+        """
+        Prepare the named collection for queries once bulk insertion has finished,
+        and record the time of completion in the trace index.
+
+        :param str collection_name: the name of the collection to be indexed.
+        :param bool background: if True, return without waiting for preparation
+            to finish where the backend supports it.
+        :returns: the time taken in seconds, None if preparation continues in
+            the background, False if the collection does not exist.
+        """
+        pass
+
+
+    @abstractmethod
+    def find_import(self, pcap_hash, input_filters, derived_fields=False,
+     ingest_profile="full", max_payload_bytes=None):
+        """
+        Find a completed import of a pcap with the same content and input filters.
+
+        :param str pcap_hash: content hash of the pcap.
+        :param list input_filters: list of tuples (filter, direction) used to
+            import the pcap.
+        :param bool derived_fields: if True, only match imports storing derived fields.
+        :param str ingest_profile: only match imports storing at least the fields
+            of this ingest profile.
+        :param int max_payload_bytes: only match imports storing at least this
+            many bytes of TCP payloads, or full payloads if None.
+        :returns: the name of the matching collection, None if no match.
+        """
+        pass
+
+
+    @abstractmethod
+    def record_import(self, collection_name, pcap_hash, input_filters=[]):
+        """
+        Record the content hash and normalised input filters of the pcap imported
+        into the named collection, or clear the record if pcap_hash is None.
+
+        :param str collection_name: the name of the imported collection.
+        :param str pcap_hash: content hash of the pcap, or None.
+        :param list input_filters: list of tuples (filter, direction) used to
+            import the pcap.
+        :returns: True if recorded, False if the collection does not exist.
+        """
+        pass
+
+
+    @abstractmethod
+    def delete_collection(self, collection_name):
+        """
+        Delete the index and the trace collection associated with collection_name.
+
+        :param str collection_name: the name of the collection to be deleted.
+        :returns: True if deleted where appropriate, False otherwise.
+        """
+        pass
+
+
+    @abstractmethod
+    def modify_collection_description(self, collection_name, description):
+        """
+        Modify the description of a trace collection.
+
+        :param str collection_name: the name of the collection to be modified.
+        :param str description: the new description of the collection.
+        :returns: True if modification successful, False otherwise.
+        """
+        pass
+
+
+    @abstractmethod
+    def list_collections(self):
+        """
+        Return all valid collections.
+
+        :returns: a list of trace index entries of valid collections.
+        """
+        pass
+
+
+    @abstractmethod
+    def insert_packets(self, packets, collection_name=""):
+        """
+        Insert a list of packets formatted as by
+        :meth:`~CovertMark.data.parser.PCAPParser.load_packet_info`.
+
+        :param list packets: packets to be inserted.
+        :param str collection_name: the name of the collection to be inserted into.
+        :returns: dict containing collection name and insertion result if
+            insertion successful, False otherwise.
+        """
+        pass
+
+
+    @abstractmethod
+    def iter_packets(self, collection_name, query_params, max_r=0, projection=None,
+     batch_size=0):
+        """
+        Return an iterable streaming matched packets in the named collection up
+        to a max of max_r packets.
+
+        :param str collection_name: name of the queried collection.
+        :param dict query_params: query written in MongoDB query object format.
+        :param int max_r: maximum number of returned packets, <= 0 means unlimited.
+        :param dict projection: fields to include or exclude from returned
+            packets, written in MongoDB projection format. All fields are
+            returned if None.
+        :param int batch_size: the number of packets fetched at a time, <= 0
+            means the backend default.
+        :returns: an iterable over packets found matching the query parameters,
+            False if the collection does not exist.
+        """
+        pass
+
+
+    def find_packets(self, collection_name, query_params, max_r=0, projection=None):
+        """
+        Return matched packets in the named collection up to a max of max_r
+        packets, see :meth:`iter_packets`.
+
+        :returns: a list of packets found matching the query parameters.
+        """
+
+        query_result = self.iter_packets(collection_name, query_params, max_r, projection)
+        if query_result is False:
+            return False
+
+        return [x for x in query_result]
+
+
+    @abstractmethod
+    def aggregate_packets(self, collection_name, pipeline):
+        """
+        Run an aggregation pipeline on the named collection, so that only the
+        summaries of packets are returned.
+
+        :param str collection_name: name of the queried collection.
+        :param list pipeline: a list of aggregation stages in MongoDB format.
+        :returns: a list of documents output by the final stage of the pipeline.
+        """
+        pass
+
+
+    @abstractmethod
+    def count_packets(self, collection_name, query_params={}):
+        """
+        Return the number of query-matched packets in the named collection.
+
+        :param str collection_name: name of the queried collection.
+        :param dict query_params: query written in MongoDB query object format.
+        :returns: the number of packets found matching the query parameters.
+        """
+        pass
+
+
+    @abstractmethod
+    def estimate_packets(self, collection_name):
+        """
+        Return the number of all packets in the named collection without counting
+        them where possible.
+
+        :param str collection_name: name of the queried collection.
+        :returns: the number of packets in the collection.
+        """
+        pass
+
+
+    @abstractmethod
+    def distinct_packets(self, collection_name, field_name, approximate=False):
+        """
+        Return the number of distinct fields of a column in the named collection.
+
+        :param str collection_name: name of the queried collection.
+        :param str field_name: name of column to count distinct packets.
+        :param bool approximate: if True, the count may be estimated.
+        :returns: the number of distinct fields found.
+        """
+        pass
+
+
+    @abstractmethod
+    def delete_packets(self, collection_name, query_params):
+        """
+        Delete matched packets in the named collection.
+
+        :param str collection_name: name of the queried collection.
+        :param str query_params: query written in MongoDB query object format.
+        :returns: packets deleted matching the query parameters.
+        """
+        pass
+
+
+    @staticmethod
+    def generate_name():
+        """
+        Generate a packet collection name in the format of 'traces(yyyymmdd)random-hex-string'.
+
+        :returns: a random collection name.
+        """
+        today = date.today().strftime("%Y%m%d")
+
+        return "traces" + today + hashlib.sha1(urandom(8)).hexdigest()
+
+
+def get_backend(backend_name=None):
+    """
+    Open the storage backend of traces as configured.
+
+    :param str backend_name: "mongodb" to store traces in the MongoDB server
+        at :const:`constants.MONGODB_SERVER`, or "columnar" to store them as
+        memory-mapped columnar files under :const:`constants.COLUMNAR_STORE_PATH`.
+        :const:`constants.STORAGE_BACKEND` is opened if None.
+    :returns: a :class:`StorageBackend` instance.
+    :raises ValueError: if the backend name is not recognised.
+    """
+
+    if backend_name is None:
+        backend_name = constants.STORAGE_BACKEND
+
+    # Imported here as both backends subclass StorageBackend.
+    if backend_name == "mongodb":
+        from . import mongo
+        return mongo.MongoDBManager(db_server=constants.MONGODB_SERVER)
+    elif backend_name == "columnar":
+        from . import columnar
+        return columnar.ColumnarStore(constants.COLUMNAR_STORE_PATH)
+    else:
+        raise ValueError("Unknown storage backend: " + str(backend_name))
+
+
+class PayloadArena:
+    """
+    Payloads of a retrieved trace held in one contiguous buffer, with the offset
+    and length of each payload in NumPy arrays. Payloads are handed out as
+    memoryview slices or NumPy arrays viewing the buffer, which are accepted by
+    :class:`~CovertMark.analytics.entropy.EntropyAnalyser` without copying.
+    """
+
+    def __init__(self, buffer, offsets, lengths):
+        """
+        :param buffer: a bytes-like buffer of concatenated payloads, such as a
+            memory-mapped file.
+        :param offsets: the offset of each payload in the buffer.
+        :param lengths: the length of each payload.
+        """
+
+        self._buffer = memoryview(buffer).cast('B')
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+
+
+    @staticmethod
+    def from_payloads(payloads):
+        """
+        Build an arena by concatenating payloads into a new buffer.
+
+        :param list payloads: payloads in bytes.
+        :returns: a :class:`PayloadArena` holding the payloads in order.
+        """
+
+        lengths = np.array([len(i) for i in payloads], dtype=np.int64)
+        offsets = np.zeros(len(payloads), dtype=np.int64)
+        if len(payloads) > 1:
+            offsets[1:] = np.cumsum(lengths)[:-1]
+
+        return PayloadArena(b''.join(payloads), offsets, lengths)
+
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+    def view(self, i):
+        """
+        Return the i-th payload without copying.
+
+        :param int i: the index of the payload.
+        :returns: a read-only memoryview of the payload.
+        """
+
+        offset = int(self.offsets[i])
+        return self._buffer[offset:offset+int(self.lengths[i])]
+
+
+    def array(self, i):
+        """
+        Return the i-th payload as a NumPy array without copying.
+
+        :param int i: the index of the payload.
+        :returns: a read-only uint8 NumPy array of the payload.
+        """
+
+        return np.frombuffer(self._buffer, dtype=np.uint8, count=int(self.lengths[i]),
+         offset=int(self.offsets[i]))
+
+
+class TraceCache:
+    """
+    A least-recently-used cache of retrieved packets shared by all components
+    of a process, keyed by storage location, collection, filter, projection
+    and the form packets are retrieved in, so that strategy instances loading
+    the same traces back-to-back do not fetch and decode them again. Cached
+    traces are held as tuples of packets shared between holders, which are
+    made read-only by :meth:`~CovertMark.data.retrieve.Retriever.retrieve_cached`
+    before caching. Traces are evicted when the estimated size of all cached
+    traces exceeds the memory budget, and are invalidated whenever this process
+    modifies or deletes their collection.
+    """
+
+    def __init__(self, budget=constants.TRACE_CACHE_BUDGET):
+        self._budget = budget
+        self._size = 0
+        self._traces = OrderedDict()
+        self._lock = Lock()
+
+
+    @staticmethod
+    def _key(location, collection_name, trace_filter, projection, payload_views, records):
+        return (location, collection_name, json_util.dumps(trace_filter, sort_keys=True),
+         json_util.dumps(projection, sort_keys=True), bool(payload_views), bool(records))
+
+
+    @staticmethod
+    def estimate_size(packets):
+        """
+        Estimate the memory held by packets, scaling up the deep size of evenly
+        spaced samples.
+
+        :param tuple packets: packets as retrieved.
+        :returns: the estimated number of bytes held.
+        """
+
+        if len(packets) == 0:
+            return 0
+
+        step = max(1, len(packets) // constants.TRACE_CACHE_SAMPLE)
+        samples = packets[::step]
+
+        def deep_size(obj):
+            size = sys.getsizeof(obj)
+            if isinstance(obj, memoryview): # Views of a payload arena.
+                size += obj.nbytes
+            elif isinstance(obj, np.ndarray) and obj.base is not None:
+                size += obj.nbytes
+            elif isinstance(obj, Mapping): # Including packet records.
+                size += sum([deep_size(v) for v in obj.values()])
+            elif isinstance(obj, (list, tuple)):
+                size += sum([deep_size(v) for v in obj])
+            return size
+
+        sampled = sum([deep_size(packet) for packet in samples])
+
+        return sys.getsizeof(packets) + sampled * len(packets) // len(samples)
+
+
+    def get(self, location, collection_name, trace_filter, projection,
+     payload_views=False, records=False):
+        """
+        Return the cached packets of a trace, marking it as recently used.
+
+        :param str location: the location of the storage, see :attr:`StorageBackend.location`.
+        :param str collection_name: the name of the collection retrieved.
+        :param dict trace_filter: the filter packets were retrieved with.
+        :param dict projection: the projection packets were retrieved with.
+        :param bool payload_views: whether payloads were retrieved as views.
+        :param bool records: whether packets were retrieved as records.
+        :returns: a tuple of packets, None if not cached.
+        """
+
+        key = TraceCache._key(location, collection_name, trace_filter, projection,
+         payload_views, records)
+        with self._lock:
+            if key not in self._traces:
+                return None
+            self._traces.move_to_end(key)
+            return self._traces[key][1]
+
+
+    def put(self, location, collection_name, trace_filter, projection, packets,
+     payload_views=False, records=False):
+        """
+        Cache the packets of a trace, evicting the least recently used traces
+        to stay within budget. Traces larger than the budget are not cached.
+
+        :param str location: the location of the storage, see :attr:`StorageBackend.location`.
+        :param str collection_name: the name of the collection retrieved.
+        :param dict trace_filter: the filter packets were retrieved with.
+        :param dict projection: the projection packets were retrieved with.
+        :param tuple packets: packets retrieved.
+        :param bool payload_views: whether payloads were retrieved as views.
+        :param bool records: whether packets were retrieved as records.
+        """
+
+        key = TraceCache._key(location, collection_name, trace_filter, projection,
+         payload_views, records)
+        size = TraceCache.estimate_size(packets)
+        if size > self._budget:
+            return
+
+        with self._lock:
+            if key in self._traces:
+                self._size -= self._traces.pop(key)[0]
+            while self._traces and self._size + size > self._budget:
+                _, (evicted_size, _) = self._traces.popitem(last=False)
+                self._size -= evicted_size
+            self._traces[key] = (size, packets)
+            self._size += size
+
+
+    def invalidate(self, location=None, collection_name=None):
+        """
+        Discard cached traces of a collection, those of a storage, or all.
+
+        :param str location: the location of the storage, None for all.
+        :param str collection_name: the name of the collection, None for all
+            collections of the storage.
+        """
+
+        with self._lock:
+            for key in list(self._traces.keys()):
+                if (location is None or key[0] == location) and \
+                 (collection_name is None or key[1] == collection_name):
+                    self._size -= self._traces.pop(key)[0]
+
+
+    def set_budget(self, budget):
+        """
+        Set the memory budget in bytes, evicting traces if now exceeded.
+
+        :param int budget: a non-negative number of bytes, 0 to disable caching.
+        :raises ValueError: if the budget is not a non-negative integer.
+        """
+
+        if not isinstance(budget, int) or budget < 0:
+            raise ValueError("Budget must be a non-negative integer.")
+
+        with self._lock:
+            self._budget = budget
+            while self._traces and self._size > self._budget:
+                _, (evicted_size, _) = self._traces.popitem(last=False)
+                self._size -= evicted_size
+
+
+trace_cache = TraceCache()
@@ -0,0 +1,808 @@
+from . import constants, utils, backend
+
+import os
+import json
+import shutil
+from base64 import b64decode
+from datetime import datetime
+from threading import Lock
+import numpy as np
+import bson
+
+# Fixed-width columns of each packet, stored as raw little-endian arrays.
+# TCP columns are only meaningful where the `tcp` column is set. Addresses are
+# stored as the high and low 64 bits of their integer values, with the IP
+# version giving both the address family and the packet type.
+COLUMNS = [("time", "<f8"), ("len", "<i8"), ("ttl", "<i2"), ("version", "<u1"),
+           ("proto", "<U16"), ("src_hi", "<u8"), ("src_lo", "<u8"),
+           ("dst_hi", "<u8"), ("dst_lo", "<u8"), ("tcp", "?"),
+           ("sport", "<i4"), ("dport", "<i4"), ("seq", "<i8"), ("ack", "<i8"),
+           ("flags", "<i2"), ("payload_len", "<i8"), ("payload_offset", "<i8"),
+           ("payload_size", "<i4"), ("extras_offset", "<i8"), ("extras_len", "<i4"),
+           ("pcap_offset", "<i8"), ("pcap_len", "<i4")]
+COLUMN_TYPES = dict(COLUMNS)
+
+# Packet fields stored in the columns listed.
+COLUMN_FIELDS = {"time": ["time"], "len": ["len"], "ttl": ["ttl"], "type": ["version"],
+                 "proto": ["proto"], "src": ["version", "src_hi", "src_lo"],
+                 "dst": ["version", "dst_hi", "dst_lo"],
+                 "tcp_info.sport": ["sport"], "tcp_info.dport": ["dport"],
+                 "tcp_info.seq": ["seq"], "tcp_info.ack": ["ack"],
+                 "tcp_info.flags": ["flags"], "tcp_info.payload_len": ["payload_len"],
+                 "pcap_offset": ["pcap_offset"], "pcap_len": ["pcap_len"]}
+
+IP_TYPES = {4: "IPv4", 6: "IPv6"}
+ADDRESS_MASK = (1 << 64) - 1
+
+# Variable fields of each packet, stored as a BSON document in the extras arena.
+EXTRAS_FIELDS = ["tls_info", "http_info", "has_tls", "has_http", "tcp_info.opts",
+                 "tcp_info.payload_entropy"]
+
+META_FILE = "trace.json"
+PAYLOAD_ARENA = "payload.bin"
+EXTRAS_ARENA = "extras.bin"
+
+_write_lock = Lock()
+
+
+class ColumnarStore(backend.StorageBackend):
+    """
+    A storage backend holding each trace as columnar files in a directory of
+    the local filesystem: fixed-width arrays of scalar packet fields, an arena
+    of concatenated TCP payloads, and an arena of BSON documents of variable
+    fields such as TLS records. Files are memory-mapped for reading, so traces
+    are loaded without a database server and without copying columns, and
+    payloads are returned as memoryview slices of the mapped payload arena.
+    The trace index entry of each trace is kept as JSON alongside its columns.
+    """
+
+    DECODED_PAYLOADS = True
+    PAYLOAD_VIEWS = True
+    QUERY_ERRORS = (ValueError,)
+
+    def __init__(self, store_path=constants.COLUMNAR_STORE_PATH):
+
+        self._store_path = os.path.abspath(os.path.expanduser(store_path))
+        os.makedirs(self._store_path, exist_ok=True)
+
+
+    @property
+    def location(self):
+        return self._store_path
+
+
+    def _path(self, collection_name, file_name=""):
+        return os.path.join(self._store_path, collection_name, file_name)
+
+
+    def _read_meta(self, collection_name):
+        with open(self._path(collection_name, META_FILE), 'r') as f:
+            return json.load(f)
+
+
+    def _write_meta(self, collection_name, meta):
+        temp_path = self._path(collection_name, META_FILE + ".tmp")
+        with open(temp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(temp_path, self._path(collection_name, META_FILE))
+
+
+    def _update_meta(self, collection_name, update):
+        with _write_lock:
+            meta = self._read_meta(collection_name)
+            update(meta)
+            self._write_meta(collection_name, meta)
+
+
+    def _columns(self, collection_name, count):
+        """
+        Memory-map the columns of a trace.
+
+        :param str collection_name: the name of the trace.
+        :param int count: the number of packets in the trace.
+        :returns: a dict mapping column names to read-only arrays.
+        """
+
+        columns = {}
+        for column, dtype in COLUMNS:
+            if count == 0:
+                columns[column] = np.zeros(0, dtype=dtype)
+            else:
+                columns[column] = np.memmap(self._path(collection_name, column + ".col"),
+                 dtype=dtype, mode='r', shape=(count,))
+
+        return columns
+
+
+    def _arena(self, collection_name, arena):
+        """
+        Memory-map an arena of a trace.
+
+        :returns: a read-only uint8 array of the arena, empty if nothing stored.
+        """
+
+        arena_path = self._path(collection_name, arena)
+        if os.path.getsize(arena_path) == 0:
+            return np.zeros(0, dtype=np.uint8)
+
+        return np.memmap(arena_path, dtype=np.uint8, mode='r')
+
+
+    def _replace(self, collection_name, file_name, content):
+        """
+        Replace a file of a trace through a new file, so that payloads still
+        viewed through memory maps of the old file remain valid.
+        """
+
+        temp_path = self._path(collection_name, file_name + ".tmp")
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+        os.replace(temp_path, self._path(collection_name, file_name))
+
+
+    def lookup_collection(self, collection_name):
+
+        if not collection_name or not collection_name.isalnum():
+            return False
+
+        return os.path.isfile(self._path(collection_name, META_FILE))
+
+
+    def new_collection(self, description="", input_filters=[], derived_fields=False,
+     ingest_profile="full", max_payload_bytes=None):
+
+        collection_name = self.generate_name()
+
+        # In case of collision.
+        while self.lookup_collection(collection_name):
+            collection_name = self.generate_name()
+
+        for input_filter in input_filters:
+            if not utils.build_subnet(input_filter[0]) or \
+             input_filter[1] not in [constants.IP_SRC, constants.IP_DST, constants.IP_EITHER]:
+                return False
+
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        meta = {"name": collection_name, "creation_time": now,
+            "description": description,
+            "input_filters": [(str(i[0]), int(i[1])) for i in input_filters],
+            "derived_fields": bool(derived_fields), "ingest_profile": ingest_profile,
+            "max_payload_bytes": max_payload_bytes, "count": 0, "bytes": 0}
+
+        os.makedirs(self._path(collection_name))
+        for column, _ in COLUMNS:
+            open(self._path(collection_name, column + ".col"), 'wb').close()
+        for arena in [PAYLOAD_ARENA, EXTRAS_ARENA]:
+            open(self._path(collection_name, arena), 'wb').close()
+        self._write_meta(collection_name, meta)
+
+        return collection_name
+
+
+    def index_collection(self, collection_name, background=False):
+
+        if not self.lookup_collection(collection_name):
+            return False
+
+        # Columns are scanned directly, so no secondary indexes are built.
+        index_time = 0.0
+        self._update_meta(collection_name, lambda meta: meta.update({"index_time": index_time}))
+
+        return index_time
+
+
+    def find_import(self, pcap_hash, input_filters, derived_fields=False,
+     ingest_profile="full", max_payload_bytes=None):
+
+        normalised_filters = utils.normalise_filters(input_filters)
+        for trace in self.list_collections():
+            if trace.get("pcap_hash") != pcap_hash:
+                continue
+            if trace.get("normalised_filters") != normalised_filters:
+                continue
+            if derived_fields and not trace["derived_fields"]:
+                continue
+            if not utils.covers_profile(trace.get("ingest_profile"), ingest_profile):
+                continue
+            if not utils.covers_payload_bytes(trace.get("max_payload_bytes"), max_payload_bytes):
+                continue
+            return trace["name"]
+
+        return None
+
+
+    def record_import(self, collection_name, pcap_hash, input_filters=[]):
+
+        if not self.lookup_collection(collection_name):
+            return False
+
+        def update(meta):
+            if pcap_hash is None:
+                meta.pop("pcap_hash", None)
+                meta.pop("normalised_filters", None)
+            else:
+                meta["pcap_hash"] = pcap_hash
+                meta["normalised_filters"] = utils.normalise_filters(input_filters)
+        self._update_meta(collection_name, update)
+
+        return True
+
+
+    def delete_collection(self, collection_name):
+
+        if not self.lookup_collection(collection_name):
+            return False
+
+        shutil.rmtree(self._path(collection_name))
+        backend.trace_cache.invalidate(self.location, collection_name)
+
+        return True
+
+
+    def modify_collection_description(self, collection_name, description):
+
+        if not self.lookup_collection(collection_name):
+            return False
+
+        self._update_meta(collection_name, lambda meta: meta.update({"description": description}))
+
+        return True
+
+
+    def list_collections(self):
+
+        traces = []
+        for collection_name in sorted(os.listdir(self._store_path)):
+            if self.lookup_collection(collection_name):
+                traces.append(self._read_meta(collection_name))
+
+        return traces
+
+
+    def insert_packets(self, packets, collection_name=""):
+
+        if collection_name == "":
+            collection_name = self.new_collection()
+            if not collection_name:
+                return False
+        elif not self.lookup_collection(collection_name):
+            return False
+
+        with _write_lock:
+            meta = self._read_meta(collection_name)
+            payload_end = os.path.getsize(self._path(collection_name, PAYLOAD_ARENA))
+            extras_end = os.path.getsize(self._path(collection_name, EXTRAS_ARENA))
+
+            values = {column: [] for column, _ in COLUMNS}
+            payloads = []
+            extras = []
+            for packet in packets:
+                for field in ["len", "ttl", "proto"]:
+                    values[field].append(packet[field])
+                for field in ["src", "dst"]:
+                    version, address = utils.address_to_int(packet[field])
+                    values[field + "_hi"].append(address >> 64)
+                    values[field + "_lo"].append(address & ADDRESS_MASK)
+                values["version"].append(version)
+                values["time"].append(float(packet["time"]))
+                for field in ["pcap_offset", "pcap_len"]: # -1 if not parsed from a pcap.
+                    values[field].append(packet.get(field, -1))
+                tcp_info = packet.get("tcp_info")
+                values["tcp"].append(tcp_info is not None)
+
+                extra = {}
+                for field in ["tls_info", "http_info", "has_tls", "has_http"]:
+                    if field in packet:
+                        extra[field] = packet[field]
+                if extra.get("tls_info") is not None and "data" in extra["tls_info"]:
+                    extra["tls_info"] = dict(extra["tls_info"],
+                     data=[b64decode(i) for i in extra["tls_info"]["data"]])
+
+                if tcp_info is not None:
+                    payload = b64decode(tcp_info["payload"])
+                    for field in ["sport", "dport", "seq", "ack"]:
+                        values[field].append(tcp_info[field])
+                    values["flags"].append(utils.build_tcp_flags(tcp_info["flags"]))
+                    values["payload_len"].append(tcp_info.get("payload_len", len(payload)))
+                    for field in ["opts", "payload_entropy"]:
+                        if field in tcp_info:
+                            extra["tcp_info." + field] = tcp_info[field]
+                else:
+                    payload = b''
+                    for field in ["sport", "dport", "seq", "ack", "flags", "payload_len"]:
+                        values[field].append(0)
+
+                values["payload_offset"].append(payload_end)
+                values["payload_size"].append(len(payload))
+                payload_end += len(payload)
+                payloads.append(payload)
+
+                extra = bson.encode(extra)
+                values["extras_offset"].append(extras_end)
+                values["extras_len"].append(len(extra))
+                extras_end += len(extra)
+                extras.append(extra)
+
+            for column, dtype in COLUMNS:
+                with open(self._path(collection_name, column + ".col"), 'ab') as f:
+                    np.array(values[column], dtype=dtype).tofile(f)
+            with open(self._path(collection_name, PAYLOAD_ARENA), 'ab') as f:
+                f.write(b''.join(payloads))
+            with open(self._path(collection_name, EXTRAS_ARENA), 'ab') as f:
+                f.write(b''.join(extras))
+
+            # Keep the same statistics as recorded in the MongoDB trace index.
+            meta["count"] += len(packets)
+            meta["bytes"] += sum([i.get("len", 0) for i in packets])
+            if len(packets) > 0:
+                start, end = min(values["time"]), max(values["time"])
+                meta["start_time"] = min(meta.get("start_time", start), start)
+                meta["end_time"] = max(meta.get("end_time", end), end)
+            self._write_meta(collection_name, meta)
+
+        backend.trace_cache.invalidate(self.location, collection_name)
+
+        return {"collection_name": collection_name, "inserted": InsertResult(len(packets))}
+
+
+    def iter_packets(self, collection_name, query_params, max_r=0, projection=None,
+     batch_size=0):
+
+        if not self.lookup_collection(collection_name):
+            return False
+
+        return self._iter_packets(collection_name, query_params, max_r, projection, batch_size)
+
+
+    def _iter_packets(self, collection_name, query_params, max_r, projection, batch_size):
+
+        if not isinstance(max_r, int) or max_r <= 0:
+            max_r = 0
+        if not isinstance(batch_size, int) or batch_size <= 0:
+            batch_size = constants.RETRIEVE_BATCH_SIZE
+
+        # Only read arenas if the filter or the returned packets need them.
+        query_paths = _query_paths(query_params)
+        need_payload = _projected("tcp_info.payload", projection) or \
+         any([_overlaps(i, "tcp_info.payload") and i != "tcp_info" for i in query_paths])
+        need_extras = any([_projected(i, projection) for i in EXTRAS_FIELDS]) or \
+         any([_overlaps(i, j) and i != "tcp_info" for i in query_paths for j in EXTRAS_FIELDS])
+
+        count = self._read_meta(collection_name)["count"]
+        columns = self._columns(collection_name, count)
+        payloads = memoryview(self._arena(collection_name, PAYLOAD_ARENA)) if need_payload else None
+        extras = self._arena(collection_name, EXTRAS_ARENA) if need_extras else None
+
+        returned = 0
+        for start in range(0, count, batch_size):
+            batch = {column: columns[column][start:start+batch_size].tolist() for column, _ in COLUMNS}
+            for i in range(len(batch["time"])):
+                packet = _build_packet(batch, i, payloads, extras)
+                if query_params and not _match(packet, query_params):
+                    continue
+                yield _project(packet, projection)
+                returned += 1
+                if max_r and returned >= max_r:
+                    return
+
+
+    def aggregate_packets(self, collection_name, pipeline):
+
+        if not self.lookup_collection(collection_name):
+            return False
+
+        # Only the fields referenced by the pipeline are read.
+        projection = {"time": True}
+        for stage in pipeline:
+            for operator, spec in stage.items():
+                if operator == "$match":
+                    projection.update(_filter_projection(spec))
+                elif operator in ["$group", "$project"]:
+                    projection.update({path: True for path in _expression_paths(spec)})
+
+        documents = self._iter_packets(collection_name, {}, 0, projection, 0)
+        for stage in pipeline:
+            operator, spec = list(stage.items())[0]
+            if operator == "$match":
+                documents = [i for i in documents if _match(i, spec)]
+            elif operator == "$group":
+                documents = _group(documents, spec)
+            elif operator == "$project":
+                documents = [_project(i, spec) for i in documents]
+            elif operator == "$count":
+                count = len(list(documents))
+                documents = [{spec: count}] if count > 0 else []
+            else:
+                raise ValueError("Unsupported aggregation stage: " + operator)
+
+        return [x for x in documents]
+
+
+    def count_packets(self, collection_name, query_params={}):
+
+        if not self.lookup_collection(collection_name):
+            return False
+
+        if not query_params:
+            return self.estimate_packets(collection_name)
+
+        projection = _filter_projection(query_params)
+        return sum([1 for _ in self._iter_packets(collection_name, query_params, 0, projection, 0)])
+
+
+    def estimate_packets(self, collection_name):
+
+        if not self.lookup_collection(collection_name):
+            return False
+
+        return self._read_meta(collection_name)["count"]
+
+
+    def distinct_packets(self, collection_name, field_name, approximate=False):
+
+        if not self.lookup_collection(collection_name):
+            return False
+
+        # Counted exactly regardless, as columns are scanned locally.
+        if field_name in COLUMN_FIELDS:
+            count = self._read_meta(collection_name)["count"]
+            columns = self._columns(collection_name, count)
+            values = np.column_stack([columns[i] for i in COLUMN_FIELDS[field_name]])
+            if field_name.startswith("tcp_info."):
+                values = values[columns["tcp"]]
+            return int(np.unique(values, axis=0).shape[0])
+
+        values = set()
+        for packet in self._iter_packets(collection_name, {field_name: {"$ne": None}},
+         0, {field_name: True}, 0):
+            value = _get(packet, field_name)
+            values.add(tuple(value) if isinstance(value, list) else value)
+
+        return len(values)
+
+
+    def delete_packets(self, collection_name, query_params):
+
+        if not self.lookup_collection(collection_name):
+            return False
+
+        projection = _filter_projection(query_params)
+        projection["time"] = True
+        matched = np.array([_match(packet, query_params) for packet in
+         self._iter_packets(collection_name, {}, 0, projection, 0)], dtype=bool)
+        deleted = int(matched.sum())
+        if deleted == 0:
+            return 0
+
+        with _write_lock:
+            meta = self._read_meta(collection_name)
+            columns = self._columns(collection_name, meta["count"])
+            keep = ~matched
+            kept = {column: np.array(columns[column][keep]) for column, _ in COLUMNS}
+
+            # Compact the arenas to the packets kept.
+            for arena, offset_column, length_column in [(PAYLOAD_ARENA, "payload_offset", "payload_size"),
+             (EXTRAS_ARENA, "extras_offset", "extras_len")]:
+                data = self._arena(collection_name, arena)
+                lengths = kept[length_column]
+                chunks = [bytes(data[o:o+l]) for o, l in zip(kept[offset_column].tolist(), lengths.tolist())]
+                offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]) if len(lengths) > 0 else lengths
+                kept[offset_column] = offsets.astype(COLUMN_TYPES[offset_column])
+                del data
+                self._replace(collection_name, arena, b''.join(chunks))
+
+            del columns
+            for column, dtype in COLUMNS:
+                self._replace(collection_name, column + ".col", kept[column].astype(dtype).tobytes())
+
+            # Recorded statistics and import no longer apply.
+            meta["count"] -= deleted
+            meta["bytes"] = int(kept["len"].sum())
+            for statistic in ["start_time", "end_time", "pcap_hash", "normalised_filters"]:
+                meta.pop(statistic, None)
+            if meta["count"] > 0:
+                meta["start_time"] = float(kept["time"].min())
+                meta["end_time"] = float(kept["time"].max())
+            self._write_meta(collection_name, meta)
+
+        backend.trace_cache.invalidate(self.location, collection_name)
+
+        return deleted
+
+
+class InsertResult:
+    """
+    The result of a packet insertion, mirroring that returned by MongoDB.
+    """
+
+    def __init__(self, count):
+        self.inserted_ids = list(range(count))
+
+
+def _build_packet(batch, i, payloads, extras):
+    """
+    Build a packet in the format of :meth:`~CovertMark.data.parser.PCAPParser.load_packet_info`
+    from the i-th row of a batch of columns, with raw rather than base64-encoded
+    payload and TLS data. The payload is a memoryview slice of the payload arena,
+    omitted if payloads is None, and variable fields are omitted if extras is None.
+    Addresses are decoded through the cache of :func:`~CovertMark.data.utils.int_to_address`,
+    and TCP flags are returned as :class:`~CovertMark.data.utils.TCPFlags`.
+    """
+
+    version = batch["version"][i]
+    packet = {"type": IP_TYPES[version],
+              "dst": utils.int_to_address(version, batch["dst_hi"][i] << 64 | batch["dst_lo"][i]),
+              "src": utils.int_to_address(version, batch["src_hi"][i] << 64 | batch["src_lo"][i]),
+              "len": batch["len"][i], "proto": batch["proto"][i],
+              "time": "{0:.6f}".format(batch["time"][i]), "ttl": batch["ttl"][i]}
+    if batch["pcap_offset"][i] >= 0:
+        packet["pcap_offset"] = batch["pcap_offset"][i]
+        packet["pcap_len"] = batch["pcap_len"][i]
+
+    extra = {}
+    if extras is not None:
+        offset = batch["extras_offset"][i]
+        extra = bson.decode(bytes(extras[offset:offset+batch["extras_len"][i]]))
+
+    if batch["tcp"][i]:
+        tcp_info = {"sport": batch["sport"][i], "dport": batch["dport"][i],
+                    "flags": utils.TCPFlags(batch["flags"][i]),
+                    "ack": batch["ack"][i], "seq": batch["seq"][i],
+                    "payload_len": batch["payload_len"][i]}
+        if payloads is not None:
+            offset = batch["payload_offset"][i]
+            tcp_info["payload"] = payloads[offset:offset+batch["payload_size"][i]]
+        for field in ["opts", "payload_entropy"]:
+            if "tcp_info." + field in extra:
+                tcp_info[field] = extra["tcp_info." + field]
+        packet["tcp_info"] = tcp_info
+    else:
+        packet["tcp_info"] = None
+
+    if extras is not None:
+        packet["tls_info"] = extra.get("tls_info")
+        packet["http_info"] = extra.get("http_info")
+        for field in ["has_tls", "has_http"]:
+            if field in extra:
+                packet[field] = extra[field]
+
+    return packet
+
+
+def _get(document, path):
+    """
+    Resolve a dotted path in a document, None if any part is missing or null.
+    """
+
+    for key in path.split("."):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(key)
+
+    return document
+
+
+def _overlaps(path, other):
+    return path == other or path.startswith(other + ".") or other.startswith(path + ".")
+
+
+def _projected(path, projection):
+    """
+    Check whether a projection returns any part of the field at path.
+    """
+
+    if not projection:
+        return True
+
+    fields = {k: v for k, v in projection.items() if k != "_id"}
+    if any(fields.values()):
+        return any([_overlaps(path, k) for k, v in fields.items() if v])
+    else:
+        return not any([path == k or path.startswith(k + ".") for k in fields])
+
+
+def _project(document, projection):
+    """
+    Apply an inclusion or exclusion projection in MongoDB format to a document.
+    """
+
+    if not projection:
+        return document
+
+    fields = {k: v for k, v in projection.items() if k != "_id"}
+    if any(fields.values()):
+        projected = {}
+        for path in [k for k, v in fields.items() if v]:
+            source, target = document, projected
+            keys = path.split(".")
+            for key in keys[:-1]:
+                if not isinstance(source, dict) or not isinstance(source.get(key), dict):
+                    source = None
+                    break
+                source = source[key]
+                target = target.setdefault(key, {})
+            if isinstance(source, dict) and keys[-1] in source:
+                target[keys[-1]] = source[keys[-1]]
+        return projected
+
+    projected = dict(document)
+    for path in fields:
+        keys = path.split(".")
+        target = projected
+        for key in keys[:-1]:
+            if not isinstance(target.get(key), dict):
+                target = None
+                break
+            target[key] = dict(target[key])
+            target = target[key]
+        if target is not None:
+            target.pop(keys[-1], None)
+
+    return projected
+
+
+def _query_paths(query):
+    """
+    Return the field paths referenced by a MongoDB query.
+    """
+
+    paths = []
+    if isinstance(query, dict):
+        for key, value in query.items():
+            if key in ["$and", "$or", "$nor"]:
+                for subquery in value:
+                    paths.extend(_query_paths(subquery))
+            elif not key.startswith("$"):
+                paths.append(key)
+    elif isinstance(query, list):
+        for subquery in query:
+            paths.extend(_query_paths(subquery))
+
+    return paths
+
+
+def _filter_projection(query):
+    """
+    Return an inclusion projection of the fields needed to evaluate a query.
+    Whether TCP information is null is decided by its payload length alone,
+    which is always stored, so that payloads are not read to test for TCP.
+    """
+
+    projection = {}
+    for path in _query_paths(query):
+        projection["tcp_info.payload_len" if path == "tcp_info" else path] = True
+
+    return projection
+
+
+def _expression_paths(expression):
+    """
+    Return the field paths referenced as "$path" by an aggregation expression.
+    """
+
+    if isinstance(expression, str) and expression.startswith("$"):
+        return [expression[1:]]
+    elif isinstance(expression, dict):
+        return [p for v in expression.values() for p in _expression_paths(v)]
+    elif isinstance(expression, list):
+        return [p for v in expression for p in _expression_paths(v)]
+
+    return []
+
+
+def _compare(value, operator, operand):
+    """
+    Evaluate a MongoDB query operator on a field value.
+    """
+
+    if operator == "$eq":
+        return value == operand
+    elif operator == "$ne":
+        return value != operand
+    elif operator == "$in":
+        return value in operand
+    elif operator == "$nin":
+        return value not in operand
+    elif operator in ["$gt", "$gte", "$lt", "$lte"]:
+        if value is None or operand is None:
+            return False
+        try:
+            return {"$gt": value > operand, "$gte": value >= operand,
+                    "$lt": value < operand, "$lte": value <= operand}[operator]
+        except TypeError:
+            return False
+    elif operator == "$not":
+        return not _match_value(value, operand)
+
+    raise ValueError("Unsupported query operator: " + operator)
+
+
+def _match_value(value, condition):
+    if isinstance(condition, dict) and len(condition) > 0 and \
+     all([k.startswith("$") for k in condition]):
+        return all([_compare(value, k, v) for k, v in condition.items() if k != "$exists"])
+
+    return value == condition
+
+
+def _match(document, query):
+    """
+    Check whether a document matches a MongoDB query, supporting comparison,
+    membership and logical operators. Missing fields are treated as null.
+    """
+
+    for key, condition in query.items():
+        if key == "$and":
+            if not all([_match(document, i) for i in condition]):
+                return False
+        elif key == "$or":
+            if not any([_match(document, i) for i in condition]):
+                return False
+        elif key == "$nor":
+            if any([_match(document, i) for i in condition]):
+                return False
+        else:
+            value = _get(document, key)
+            if isinstance(condition, dict) and "$exists" in condition:
+                parent = _get(document, key.rpartition(".")[0]) if "." in key else document
+                exists = isinstance(parent, dict) and key.rpartition(".")[2] in parent
+                if exists != bool(condition["$exists"]):
+                    return False
+            if not _match_value(value, condition):
+                return False
+
+    return True
+
+
+def _evaluate(document, expression):
+    """
+    Evaluate an aggregation expression of field paths, constants and the
+    `$cond`, `$eq`, `$ne`, `$and` and `$or` operators on a document.
+    """
+
+    if isinstance(expression, str) and expression.startswith("$"):
+        return _get(document, expression[1:])
+    elif isinstance(expression, dict):
+        if len(expression) == 1 and list(expression.keys())[0].startswith("$"):
+            operator, operands = list(expression.items())[0]
+            values = [_evaluate(document, i) for i in operands]
+            if operator == "$cond":
+                return values[1] if values[0] else values[2]
+            elif operator == "$eq":
+                return values[0] == values[1]
+            elif operator == "$ne":
+                return values[0] != values[1]
+            elif operator == "$and":
+                return all(values)
+            elif operator == "$or":
+                return any(values)
+            raise ValueError("Unsupported aggregation operator: " + operator)
+        return {k: _evaluate(document, v) for k, v in expression.items()}
+
+    return expression
+
+
+def _group(documents, spec):
+    """
+    Group documents as the MongoDB `$group` stage, supporting `$sum` accumulators.
+    """
+
+    groups = {}
+    for document in documents:
+        group_id = _evaluate(document, spec["_id"])
+        key = tuple(sorted(group_id.items())) if isinstance(group_id, dict) else group_id
+        if key not in groups:
+            groups[key] = {"_id": group_id}
+            for field in spec:
+                if field != "_id":
+                    groups[key][field] = 0
+        for field, accumulator in spec.items():
+            if field == "_id":
+                continue
+            if list(accumulator.keys()) != ["$sum"]:
+                raise ValueError("Unsupported accumulator in group field: " + field)
+            value = _evaluate(document, accumulator["$sum"])
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                groups[key][field] += value
+
+    return list(groups.values())
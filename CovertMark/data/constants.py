@@ -5,7 +5,28 @@ LOG_ERROR = True
 LOG_FILE = "parser_errors.log"
 TLS_TYPE = {20: "CHANGE_CIPHER_SPEC", 21: "ALERT", 22: "HANDSHAKE", 23: "APPLICATION_DATA"}
 TLS_VERSION = {769: "1.0", 770: "1.1", 771: "1.2", 772: "1.3"}
+STORAGE_BACKEND = "mongodb" # Or "columnar" for memory-mapped files at COLUMNAR_STORE_PATH.
 MONGODB_SERVER = "mongodb://localhost:27017/"
+COLUMNAR_STORE_PATH = "~/.covertmark/traces"
+MONGODB_POOL_SIZE = 20 # Maximum connections of the shared client per process.
+RETRIEVE_BATCH_SIZE = 1000 # Packets fetched by each cursor round trip when streaming.
+HLL_PRECISION = 14 # 2^14 HyperLogLog registers, standard error of about 0.8%.
+CATALOG_CACHE_TTL = 5 # Seconds before cached collection names are re-read.
+TRACE_CACHE_BUDGET = 2 * 1024 ** 3 # Bytes of retrieved packets cached per process.
+TRACE_CACHE_SAMPLE = 100 # Packets sampled to estimate the size of a cached trace.
+INGEST_PROFILES = ["lengths-only", "payload-prefix", "full"] # From least to most stored.
+INGEST_PROFILE = "full" # Profile of imports unless set otherwise.
+PAYLOAD_PREFIX_LENGTH = 1450 # TCP payload bytes stored by "payload-prefix" imports.
+MAX_PAYLOAD_BYTES = None # TCP payload bytes stored by any import, None for unlimited.
 IP_SRC = 0
 IP_DST = 1
 IP_EITHER = 2
+TRACE_INDEXES = ["time", "src", "dst", "tcp_info.payload_len", "tls_info"]
+DERIVED_TRACE_INDEXES = ["has_tls", "has_http"] # Only if derived fields are stored.
+# Select TCP packets, and those with payloads, including packets imported before
+# payload lengths were recorded, whose payloads are checked instead.
+TCP_FILTER = {"$or": [{"tcp_info.payload_len": {"$gte": 0}},
+ {"tcp_info.payload_len": {"$exists": False}, "tcp_info": {"$ne": None}}]}
+TCP_PAYLOAD_FILTER = {"$or": [{"tcp_info.payload_len": {"$gt": 0}},
+ {"tcp_info.payload_len": {"$exists": False}, "tcp_info": {"$ne": None},
+  "tcp_info.payload": {"$ne": b""}}]}
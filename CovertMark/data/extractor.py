@@ -0,0 +1,132 @@
+from . import utils, retrieve, reader
+
+from os.path import abspath, expanduser
+import struct
+
+PCAP_HEADER = struct.Struct("<IHHiIII")
+PCAP_RECORD = struct.Struct("<IIII")
+PCAP_MAGIC_NS = 0xa1b23c4d
+PCAP_SNAPLEN = 262144
+
+
+class PCAPExtractor:
+    """
+    Locate packets of a stored trace in the pcap file it was parsed from, using
+    the byte offset and length of each record recorded at ingest as
+    `pcap_offset` and `pcap_len`. This allows exactly the packets of interest,
+    such as those blocked as false positives, to be written to a new pcap by
+    seeking directly to them, and parts of the capture to be re-parsed.
+    """
+
+    def __init__(self, pcap_file, collection_name):
+        """
+        :param str pcap_file: path to the pcap file the trace was parsed from.
+        :param str collection_name: the name of the stored trace.
+        :raises FileNotFoundError: if the pcap file or the trace does not exist.
+        """
+
+        pcap_file = abspath(expanduser(pcap_file)) # Expand user and relative paths.
+        if not utils.check_file_exists(pcap_file):
+            raise FileNotFoundError("PCAP file not found: " + pcap_file)
+
+        self._pcap_file = pcap_file
+        self._retriever = retrieve.Retriever()
+        if not self._retriever.select(collection_name):
+            raise FileNotFoundError("Trace not found: " + str(collection_name))
+
+
+    def verify(self):
+        """
+        Check that the pcap file is the one the trace was imported from, by
+        comparing its content hash with that recorded in the trace index. The
+        file is only read if modified since it was last hashed by this process,
+        such as at import, see :func:`~CovertMark.data.utils.hash_file`.
+
+        :returns: True if the hashes match, False if not, None if the trace
+            has no recorded hash as it was not imported from a single pcap.
+        """
+
+        for trace in self._retriever.list():
+            if trace["name"] == self._retriever.current():
+                if "pcap_hash" not in trace:
+                    return None
+                return trace["pcap_hash"] == utils.hash_file(self._pcap_file)
+
+        return None
+
+
+    def locate(self, trace_filter={}):
+        """
+        Find the locations of stored packets in the pcap file.
+
+        :param dict trace_filter: a MongoDB query filter selecting the packets,
+            all packets if empty.
+        :returns: a sorted list of `(offset, length)` byte locations of the
+            matching packets, excluding packets without recorded locations.
+        """
+
+        locations = set()
+        for packet in self._retriever.iter_retrieve(trace_filter,
+         projection={"pcap_offset": True, "pcap_len": True}):
+            if packet.get("pcap_offset") is not None:
+                locations.add((packet["pcap_offset"], packet["pcap_len"]))
+
+        return sorted(locations)
+
+
+    def offset_range(self, start_time, end_time):
+        """
+        Find the byte range of the pcap file holding the stored packets within
+        a time range, for re-parsing it with
+        :meth:`~CovertMark.data.parser.PCAPParser.set_offset_range`. Records in
+        between that were excluded by input filters are also in the range.
+
+        :param float start_time: the earliest packet timestamp in the range.
+        :param float end_time: the latest packet timestamp in the range.
+        :returns: a tuple of `(start, stop)` byte offsets, None if no stored
+            packet with a recorded location is in the time range.
+        """
+
+        start = None
+        stop = None
+        for packet in self._retriever.iter_retrieve(projection={"time": True,
+         "pcap_offset": True, "pcap_len": True}):
+            if packet.get("pcap_offset") is None:
+                continue
+            if not start_time <= float(packet["time"]) <= end_time:
+                continue
+            if start is None or packet["pcap_offset"] < start:
+                start = packet["pcap_offset"]
+            if stop is None or packet["pcap_offset"] + packet["pcap_len"] > stop:
+                stop = packet["pcap_offset"] + packet["pcap_len"]
+
+        if start is None:
+            return None
+
+        return (start, stop)
+
+
+    def extract(self, output_file, trace_filter={}):
+        """
+        Write the stored packets matching a filter to a new pcap file, reading
+        only their records from the original pcap. Packets are written in the
+        order of the original capture, with nanosecond timestamps.
+
+        :param str output_file: path to the new pcap file, overwritten if exists.
+        :param dict trace_filter: a MongoDB query filter selecting the packets,
+            all packets if empty.
+        :returns: the number of packets written.
+        """
+
+        locations = self.locate(trace_filter)
+
+        with reader.PCAPReader(self._pcap_file) as pcap, open(output_file, 'wb') as f:
+            linktype = pcap.datalink()
+            f.write(PCAP_HEADER.pack(PCAP_MAGIC_NS, 2, 4, 0, 0, PCAP_SNAPLEN,
+             linktype if linktype is not None else reader.DLT_EN10MB))
+            for offset, _ in locations:
+                ts_ns, buf, wirelen = pcap.record_at(offset)
+                f.write(PCAP_RECORD.pack(ts_ns // 10 ** 9, ts_ns % 10 ** 9, len(buf), wirelen))
+                f.write(buf)
+
+        return len(locations)
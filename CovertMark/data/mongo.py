@@ -1,32 +1,210 @@
-from . import constants, utils, parser
+from . import constants, utils, parser, backend
+
+from pymongo import MongoClient, ASCENDING
+from pymongo.errors import PyMongoError
+from timeit import default_timer
+from time import monotonic
+from threading import Lock, Thread
+from os import path, getpid
+from datetime import datetime
+
+class CatalogCache:
+    """
+    An in-process cache of trace collection names, shared by all instances of
+    :class:`MongoDBManager` connected to the same server, so that repeated
+    lookups of collections are answered from memory. Entries expire after a
+    short TTL to pick up deletions made by other processes, collections not
+    found are looked up again in the database, and entries are invalidated
+    explicitly whenever this process creates, fills or deletes a collection.
+    """
+
+    def __init__(self, ttl=constants.CATALOG_CACHE_TTL):
+        self._ttl = ttl
+        self._catalogs = {}
+        self._lock = Lock()
+
+
+    def get(self, db_server):
+        """
+        Return the cached catalog of the server if not yet expired.
+
+        :param str db_server: the MongoDB server connected to.
+        :returns: a tuple of sets containing the names of collections in the
+            trace index, and those in the database. None if not cached or expired.
+        """
+
+        with self._lock:
+            if db_server not in self._catalogs:
+                return None
+
+            expiry, catalog = self._catalogs[db_server]
+            if monotonic() > expiry:
+                del self._catalogs[db_server]
+                return None
+
+            return catalog
+
+
+    def put(self, db_server, indexed, in_db):
+        """
+        Cache the catalog of the server.
+
+        :param str db_server: the MongoDB server connected to.
+        :param set indexed: names of collections in the trace index.
+        :param set in_db: names of collections in the database.
+        """
+
+        with self._lock:
+            self._catalogs[db_server] = (monotonic() + self._ttl, (indexed, in_db))
+
+
+    def invalidate(self, db_server=None):
+        """
+        Discard the cached catalog of the server, or those of all servers.
+
+        :param str db_server: the MongoDB server connected to, None for all.
+        """
+
+        with self._lock:
+            if db_server is None:
+                self._catalogs = {}
+            else:
+                self._catalogs.pop(db_server, None)
+
+
+catalog_cache = CatalogCache()
+
+
+class ClientRegistry:
+    """
+    A registry of MongoDB clients shared by all components of a process, one
+    per server, created lazily on first use. Each client maintains its own
+    connection pool of up to :const:`constants.MONGODB_POOL_SIZE` connections,
+    unless changed with :meth:`set_pool_size` before the first client is
+    created. As MongoDB clients must not be used across a fork, clients
+    created by a parent process are never handed out to its workers, which
+    create their own instead.
+    """
+
+    def __init__(self, pool_size=constants.MONGODB_POOL_SIZE):
+        self._pool_size = pool_size
+        self._clients = {}
+        self._lock = Lock()
+
+
+    def get(self, db_server):
+        """
+        Return the shared client of the server, connecting to it if this process
+        has not done so yet.
+
+        :param str db_server: the MongoDB server to connect to.
+        :returns: a connected :class:`pymongo.MongoClient`.
+        :raises pymongo.errors.PyMongoError: if the server cannot be reached.
+        """
+
+        with self._lock:
+            pid = getpid()
+            if db_server in self._clients and self._clients[db_server][0] == pid:
+                return self._clients[db_server][1]
+
+            creds = utils.read_mongo_credentials()
+            if creds is not None:
+                client = MongoClient(db_server, username=creds['username'],
+                 password=creds['password'], authSource=creds['auth_source'],
+                 serverSelectionTimeoutMS=500, maxPoolSize=self._pool_size,
+                 connect=False)
+            else:
+                client = MongoClient(db_server, serverSelectionTimeoutMS=500,
+                 maxPoolSize=self._pool_size, connect=False)
+            try:
+                client.server_info()
+            except Exception:
+                client.close()
+                raise
+
+            # A client inherited from a parent process is dropped without
+            # closing, as its sockets are still in use by the parent.
+            self._clients[db_server] = (pid, client)
+
+            return client
+
+
+    def set_pool_size(self, pool_size):
+        """
+        Set the maximum number of connections of each shared client. As clients
+        already handed out cannot be resized, this must be called before this
+        process first connects to any server, such as on start up.
+
+        :param int pool_size: a positive integer of maximum connections.
+        :raises ValueError: if the pool size is not a positive integer.
+        :raises RuntimeError: if this process has already created a client.
+        """
+
+        if not isinstance(pool_size, int) or pool_size < 1:
+            raise ValueError("Pool size must be a positive integer.")
+
+        with self._lock:
+            pid = getpid()
+            if any(client_pid == pid for client_pid, _ in self._clients.values()):
+                raise RuntimeError("Pool size must be set before the first client is created.")
+            self._pool_size = pool_size
 
-from pymongo import MongoClient
-import hashlib
-from os import urandom, path
-from datetime import date, datetime
 
-class MongoDBManager:
+client_registry = ClientRegistry()
+
+
+class MongoDBManager(backend.StorageBackend):
     ''' A manager for the MongoDB used to store trace data, both for temporary
         working and long term storage, as demanded.
     '''
 
+    QUERY_ERRORS = (PyMongoError,)
+
     def __init__(self, db_server=constants.MONGODB_SERVER):
 
-        creds = utils.read_mongo_credentials()
         try:
-            if creds is not None:
-                self.__db_client = MongoClient(db_server, username=creds['username'],
-                 password=creds['password'], authSource=creds['auth_source'],
-                 serverSelectionTimeoutMS=500)
-            else:
-                self.__db_client = MongoClient(db_server, serverSelectionTimeoutMS=500)
-            self.__db_client.server_info()
+            self.__db_client = client_registry.get(db_server)
         except:
             print("Error: Cannot connect to MongoDB Server, please check whether MongoDB Server is running and auth credentials if set.")
             raise
 
         self.__db = self.__db_client['covertmark']
         self._trace_index = self.__db["trace_index"]
+        self._db_server = db_server
+
+
+    @property
+    def location(self):
+        return self._db_server
+
+
+    def __getstate__(self):
+        # Clients cannot be pickled, so that managers passed to worker processes
+        # reconnect through the registry of the worker instead.
+        return {"db_server": self._db_server}
+
+
+    def __setstate__(self, state):
+        self.__init__(state["db_server"])
+
+
+    def _catalog(self):
+        """
+        Return the names of collections in the trace index and in the database,
+        from the catalog cache if available.
+
+        :returns: a tuple of sets containing the names of collections in the
+            trace index, and those in the database.
+        """
+
+        catalog = catalog_cache.get(self._db_server)
+        if catalog is None:
+            indexed = set([i["name"] for i in self._trace_index.find(projection={"name": True})])
+            in_db = set(self.__db.collection_names())
+            catalog_cache.put(self._db_server, indexed, in_db)
+            catalog = (indexed, in_db)
+
+        return catalog
 
 
     def lookup_collection(self, collection_name):
@@ -43,11 +221,15 @@ class MongoDBManager:
         if not collection_name.isalnum():
             return False
 
-        # Check whether collection is in the index.
-        in_index = self._trace_index.find_one({"name": collection_name})
-
-        # Check whether the collection exists in the database.
-        in_db = collection_name in self.__db.collection_names()
+        # Check whether collection is in the index and exists in the database.
+        indexed, in_db = self._catalog()
+        if collection_name not in indexed or collection_name not in in_db:
+            # Read the catalog again on a miss, in case the collection was
+            # created by another process since it was cached.
+            catalog_cache.invalidate(self._db_server)
+            indexed, in_db = self._catalog()
+        in_index = collection_name in indexed
+        in_db = collection_name in in_db
 
         if in_index and in_db:
             return True
@@ -56,12 +238,14 @@ class MongoDBManager:
         # If in index but not in database, delete the index and return False.
         if in_index and not in_db:
             self._trace_index.delete_many({"name": collection_name})
+            catalog_cache.invalidate(self._db_server)
             return False
 
         return False
 
 
-    def new_collection(self, description="", input_filters=[]):
+    def new_collection(self, description="", input_filters=[], derived_fields=False,
+     ingest_profile="full", max_payload_bytes=None):
         """
         Create a new trace collection with a name, store and return it.
 
@@ -69,14 +253,20 @@ class MongoDBManager:
             default.
         :param list input_filters: list of tuples (string-format filters, direction)
             for input filters of this collection.
+        :param bool derived_fields: whether packets of this collection are stored
+            with derived fields, see :meth:`parser.PCAPParser.set_derived_fields`.
+        :param str ingest_profile: the ingest profile packets of this collection
+            are stored under, see :meth:`parser.PCAPParser.set_ingest_profile`.
+        :param int max_payload_bytes: the maximum TCP payload bytes stored per
+            packet, None if unlimited, see :meth:`parser.PCAPParser.set_max_payload_bytes`.
         :returns: the name of the new collection.
         """
 
-        collection_name = MongoDBManager.generate_name()
+        collection_name = self.generate_name()
 
         # In case of collision.
         while self.lookup_collection(collection_name):
-            collection_name = MongoDBManager.generate_name()
+            collection_name = self.generate_name()
 
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
@@ -89,17 +279,138 @@ class MongoDBManager:
         input_filters = [(str(i[0]), int(i[1])) for i in input_filters]
 
         new_c = {"name": collection_name, "creation_time": now,
-            "description": description, "input_filters": input_filters}
+            "description": description, "input_filters": input_filters,
+            "derived_fields": bool(derived_fields), "ingest_profile": ingest_profile,
+            "max_payload_bytes": max_payload_bytes}
 
         self.__db[collection_name]
         # Does not actually create the database due to MongoDB laziness.
 
         if self._trace_index.insert_one(new_c):
+            catalog_cache.invalidate(self._db_server)
             return collection_name
         else:
             return False
 
 
+    def find_import(self, pcap_hash, input_filters, derived_fields=False,
+     ingest_profile="full", max_payload_bytes=None):
+        """
+        Find a completed import of a pcap with the same content and input filters,
+        so that it does not need to be parsed again.
+
+        :param str pcap_hash: content hash of the pcap, see :func:`utils.hash_file`.
+        :param list input_filters: list of tuples (filter, direction) used to
+            import the pcap.
+        :param bool derived_fields: if True, only match imports storing derived
+            fields; imports with derived fields also match if False.
+        :param str ingest_profile: only match imports storing at least the fields
+            of this ingest profile.
+        :param int max_payload_bytes: only match imports storing at least this
+            many bytes of TCP payloads, or full payloads if None.
+        :returns: the name of the matching collection, None if no match.
+        """
+
+        query = {"pcap_hash": pcap_hash,
+                 "normalised_filters": utils.normalise_filters(input_filters)}
+        if derived_fields:
+            query["derived_fields"] = True
+
+        for trace in self._trace_index.find(query, projection={"name": True,
+         "ingest_profile": True, "max_payload_bytes": True}):
+            if not utils.covers_profile(trace.get("ingest_profile"), ingest_profile):
+                continue
+            if not utils.covers_payload_bytes(trace.get("max_payload_bytes"), max_payload_bytes):
+                continue
+            if self.lookup_collection(trace["name"]):
+                return trace["name"]
+
+        return None
+
+
+    def record_import(self, collection_name, pcap_hash, input_filters=[]):
+        """
+        Record the content hash and normalised input filters of the pcap imported
+        into the named collection, to be found by :meth:`find_import`. Should
+        only be recorded once the import has completed.
+
+        :param str collection_name: the name of the imported collection.
+        :param str pcap_hash: content hash of the pcap, None to clear the record
+            if the collection no longer holds exactly one import.
+        :param list input_filters: list of tuples (filter, direction) used to
+            import the pcap.
+        :returns: True if recorded, False if the collection does not exist.
+        """
+
+        if not self.lookup_collection(collection_name):
+            return False
+
+        if pcap_hash is None:
+            update = {'$unset': {"pcap_hash": "", "normalised_filters": ""}}
+        else:
+            update = {'$set': {"pcap_hash": pcap_hash,
+             "normalised_filters": utils.normalise_filters(input_filters)}}
+        self._trace_index.update_one({"name": collection_name}, update)
+        catalog_cache.invalidate(self._db_server)
+
+        return True
+
+
+    def index_collection(self, collection_name, background=False):
+        """
+        Build secondary indexes on the named collection covering time, addresses
+        and TCP/TLS presence fields, so that strategic filters and distinct
+        counts do not require full collection scans. Should be called once bulk
+        insertion has finished, so that indexes are built once rather than
+        maintained during insertion. Existing indexes are left unchanged. The
+        build time is recorded in the trace index once indexes are built.
+
+        :param str collection_name: the name of the collection to be indexed.
+        :param bool background: if True, build the indexes in a separate thread
+            and return without waiting for them. The collection can be queried
+            meanwhile, though without the indexes not yet built.
+        :returns: the time taken to build the indexes in seconds, None if they
+            are being built in the background, False if the collection does not
+            exist.
+        """
+
+        if not self.lookup_collection(collection_name):
+            return False
+
+        fields = list(constants.TRACE_INDEXES)
+        if self._trace_index.find_one({"name": collection_name, "derived_fields": True}):
+            fields += constants.DERIVED_TRACE_INDEXES
+
+        if background:
+            # Not a daemon, so that the process waits for indexes being built
+            # before exiting.
+            Thread(target=self._build_indexes, args=(collection_name, fields)).start()
+            return None
+
+        return self._build_indexes(collection_name, fields)
+
+
+    def _build_indexes(self, collection_name, fields):
+        """
+        Build ascending indexes on the fields of the named collection, and
+        record the time taken in the trace index.
+
+        :param str collection_name: the name of the collection to be indexed.
+        :param list fields: the names of the fields to be indexed.
+        :returns: the time taken to build the indexes in seconds.
+        """
+
+        collection = self.__db[collection_name]
+        time_start = default_timer()
+        for field in fields:
+            collection.create_index([(field, ASCENDING)])
+        duration = default_timer() - time_start
+
+        self._trace_index.update_one({"name": collection_name}, {'$set': {"index_time": duration}})
+
+        return duration
+
+
     def delete_collection(self, collection_name):
         """
         Delete the index and the trace collection associated with collection_name.
@@ -113,6 +424,8 @@ class MongoDBManager:
 
         self._trace_index.delete_many({"name": collection_name})
         self.__db[collection_name].drop()
+        catalog_cache.invalidate(self._db_server)
+        backend.trace_cache.invalidate(self._db_server, collection_name)
 
         return True
 
@@ -145,7 +458,7 @@ class MongoDBManager:
         """
 
         collections = self._trace_index.find(projection={'_id': False})
-        in_db_collections = self.__db.collection_names()
+        _, in_db_collections = self._catalog()
         valid_collections = []
         for collection in collections:
             if collection["name"] in in_db_collections:
@@ -178,13 +491,26 @@ class MongoDBManager:
         # Conduct the insertion.
         collection = self.__db[collection_name]
         inserted = collection.insert_many(packets)
+        catalog_cache.invalidate(self._db_server) # Now exists in the database.
+        backend.trace_cache.invalidate(self._db_server, collection_name)
+
+        # Keep packet count, byte size and time span of the trace in the index,
+        # so that listing traces does not require counting packets.
+        times = [float(i["time"]) for i in packets if "time" in i]
+        trace_stats = {"$inc": {"count": len(inserted.inserted_ids),
+         "bytes": sum([i.get("len", 0) for i in packets])}}
+        if len(times) > 0:
+            trace_stats["$min"] = {"start_time": min(times)}
+            trace_stats["$max"] = {"end_time": max(times)}
+        trace_stats["$unset"] = {"distinct_counts": "", "distinct_estimates": ""}
+        self._trace_index.update_one({"name": collection_name}, trace_stats)
 
         result = {"collection_name": collection_name, "inserted": inserted}
 
         return result
 
 
-    def find_packets(self, collection_name, query_params, max_r=0):
+    def find_packets(self, collection_name, query_params, max_r=0, projection=None):
         """
         Return matched packets in the named collection up to a max of max_r
         packets.
@@ -192,23 +518,75 @@ class MongoDBManager:
         :param str collection_name: name of the queried collection.
         :param dict query_params: query written in MongoDB query object format.
         :param int max_r: maximum number of returned packets, <= 0 means unlimited.
+        :param dict projection: fields to include or exclude from returned
+            packets, written in MongoDB projection format. All fields are
+            returned if None.
         :returns: packets found matching the query parameters.
         """
 
+        query_result = self.iter_packets(collection_name, query_params, max_r, projection)
+        if query_result is False:
+            return False
+
+        result = [x for x in query_result]
+
+        return result
+
+
+    def iter_packets(self, collection_name, query_params, max_r=0, projection=None,
+     batch_size=0):
+        """
+        Return a cursor streaming matched packets in the named collection up to
+        a max of max_r packets, without loading all of them into memory.
+
+        :param str collection_name: name of the queried collection.
+        :param dict query_params: query written in MongoDB query object format.
+        :param int max_r: maximum number of returned packets, <= 0 means unlimited.
+        :param dict projection: fields to include or exclude from returned
+            packets, written in MongoDB projection format. All fields are
+            returned if None.
+        :param int batch_size: the number of packets fetched from the server in
+            each round trip, <= 0 means the server default.
+        :returns: an iterable cursor over packets found matching the query
+            parameters, False if the collection does not exist.
+        """
+
         if not self.lookup_collection(collection_name):
             return False
 
         if not isinstance(max_r, int) or max_r <= 0:
-            max_r = False
+            max_r = 0
+
+        query_projection = {'_id': False}
+        if projection:
+            query_projection.update(projection)
 
         collection = self.__db[collection_name]
-        if max_r:
-            query_result = collection.find(filter=query_params, projection={'_id': False},
-                limit = max_r)
-        else:
-            query_result = collection.find(filter=query_params, projection={'_id': False})
+        query_result = collection.find(filter=query_params, projection=query_projection,
+            limit = max_r)
+        if isinstance(batch_size, int) and batch_size > 0:
+            query_result = query_result.batch_size(batch_size)
 
-        result = [x for x in query_result]
+        return query_result
+
+
+    def aggregate_packets(self, collection_name, pipeline):
+        """
+        Run an aggregation pipeline on the named collection, so that summaries
+        of packets are computed by the server and only the results are returned.
+
+        :param str collection_name: name of the queried collection.
+        :param list pipeline: a list of aggregation stages in MongoDB format.
+        :returns: a list of documents output by the final stage of the pipeline.
+        """
+
+        if not self.lookup_collection(collection_name):
+            return False
+
+        collection = self.__db[collection_name]
+        aggregation_result = collection.aggregate(pipeline, allowDiskUse=True)
+
+        result = [x for x in aggregation_result]
 
         return result
 
@@ -225,26 +603,84 @@ class MongoDBManager:
         if not self.lookup_collection(collection_name):
             return False
 
+        if not query_params:
+            return self.estimate_packets(collection_name)
+
         collection = self.__db[collection_name]
         query_count = collection.find(filter=query_params).count()
 
         return query_count
 
 
-    def distinct_packets(self, collection_name, field_name):
+    def estimate_packets(self, collection_name):
+        """
+        Return the number of all packets in the named collection without counting
+        them, using the count recorded in the trace index at insertion, or the
+        collection metadata if not recorded.
+
+        :param str collection_name: name of the queried collection.
+        :returns: the number of packets in the collection.
+        """
+
+        if not self.lookup_collection(collection_name):
+            return False
+
+        trace = self._trace_index.find_one({"name": collection_name}, projection={"count": True})
+        if trace is not None and "count" in trace:
+            return trace["count"]
+
+        return self.__db[collection_name].estimated_document_count()
+
+
+    def distinct_packets(self, collection_name, field_name, approximate=False):
         """
         Return the number of distinct fields of a column in the named collection.
+        Exact counts are grouped by the server without returning the distinct
+        values, and approximate counts are estimated with HyperLogLog over the
+        streamed column. Either is cached in the trace index until packets of
+        the collection are inserted or deleted.
 
         :param str collection_name: name of the queried collection.
         :param str field_name: name of column to count distinct packets.
+        :param bool approximate: if True, estimate the count with a relative
+            standard error of about 1.04 / sqrt(2 ** :const:`constants.HLL_PRECISION`),
+            unless an exact count is already cached.
         :returns: the number of distinct fields found.
         """
 
         if not self.lookup_collection(collection_name):
             return False
 
+        cache_key = field_name.replace(".", "_")
+        trace = self._trace_index.find_one({"name": collection_name},
+         projection={"distinct_counts": True, "distinct_estimates": True})
+        if trace is not None:
+            if cache_key in trace.get("distinct_counts", {}):
+                return trace["distinct_counts"][cache_key]
+            if approximate and cache_key in trace.get("distinct_estimates", {}):
+                return trace["distinct_estimates"][cache_key]
+
         collection = self.__db[collection_name]
-        distinct_count = len(collection.find(filter={field_name: {"$ne": None}}).distinct(field_name))
+        if approximate:
+            estimator = utils.HyperLogLog(constants.HLL_PRECISION)
+            values = collection.find(filter={field_name: {"$ne": None}},
+             projection={'_id': False, field_name: True}).batch_size(constants.RETRIEVE_BATCH_SIZE)
+            for value in values:
+                for key in field_name.split("."):
+                    value = value.get(key) if isinstance(value, dict) else None
+                if value is not None:
+                    estimator.add(value)
+            distinct_count = estimator.count()
+            cache_field = "distinct_estimates." + cache_key
+        else:
+            pipeline = [{"$match": {field_name: {"$ne": None}}},
+                        {"$group": {"_id": "$" + field_name}},
+                        {"$count": "distinct"}]
+            groups = [x for x in collection.aggregate(pipeline, allowDiskUse=True)]
+            distinct_count = groups[0]["distinct"] if len(groups) > 0 else 0
+            cache_field = "distinct_counts." + cache_key
+
+        self._trace_index.update_one({"name": collection_name}, {'$set': {cache_field: distinct_count}})
 
         return distinct_count
 
@@ -264,19 +700,16 @@ class MongoDBManager:
         collection = self.__db[collection_name]
         deletion_result = collection.delete_many(query_params)
 
-        return deletion_result.deleted_count
-
+        # Recorded statistics and cached traces no longer apply.
+        if deletion_result.deleted_count > 0:
+            backend.trace_cache.invalidate(self._db_server, collection_name)
+            self._trace_index.update_one({"name": collection_name},
+             {"$unset": {"count": "", "bytes": "", "start_time": "", "end_time": "",
+             "distinct_counts": "", "distinct_estimates": ""}})
+            # Nor does the import, which must not be reused for the same pcap.
+            self.record_import(collection_name, None)
 
-    @staticmethod
-    def generate_name():
-        """
-        Generate a packet collection name in the format of 'traces(yyyymmdd)random-hex-string'.
-
-        :returns: a random collection name.
-        """
-        today = date.today().strftime("%Y%m%d")
-
-        return "traces" + today + hashlib.sha1(urandom(8)).hexdigest()
+        return deletion_result.deleted_count
 
 
     @staticmethod
@@ -1,4 +1,4 @@
-from . import utils, constants, mongo
+from . import utils, constants, backend, reader
 
 from os.path import isfile, abspath, expanduser
 from base64 import b64encode, b64decode
@@ -15,8 +15,134 @@ class PCAPParser:
             raise FileNotFoundError("PCAP file not found: " + pcap_file)
 
         self._pcap_file = pcap_file
-        self.__db = mongo.MongoDBManager(db_server=constants.MONGODB_SERVER)
+        self.__db = backend.get_backend()
         self.__filter = []
+        self.__derive = False
+        self.__index_time = None
+        self.__reused = False
+        self.__offset_range = (None, None)
+        self.__profile = constants.INGEST_PROFILE
+        self.__max_payload_bytes = constants.MAX_PAYLOAD_BYTES
+
+
+    def set_derived_fields(self, derive):
+        """
+        Configure the parser to also compute and store fields derived from each
+        packet at ingest, allowing strategic filters to select on them in MongoDB
+        rather than recomputing them at analysis. These are `has_tls` and `has_http`
+        for all packets, and `payload_entropy` in `tcp_info` of TCP packets. The
+        TCP payload length is always stored as `tcp_info.payload_len`, and the
+        TCP flags as the integer bitmask `tcp_info.flags`.
+
+        :param bool derive: True to store derived fields, False otherwise.
+        """
+
+        self.__derive = bool(derive)
+
+
+    def set_ingest_profile(self, profile):
+        """
+        Configure which packet fields the parser stores, so that parsing and
+        storage match what strategies analysing the import need. Profiles are:
+
+        - `full`: all fields as in :meth:`load_packet_info`.
+        - `payload-prefix`: TCP payloads only up to
+          :const:`constants.PAYLOAD_PREFIX_LENGTH` bytes, without TCP options,
+          HTTP headers, or TLS record data beyond the stored payload.
+        - `lengths-only`: no TCP payloads, TCP options, HTTP headers or TLS
+          record data.
+
+        The true TCP payload length is always stored as `tcp_info.payload_len`,
+        and derived fields are computed from full payloads. The profile is
+        recorded in the trace index, and imports under a profile storing more
+        fields are reused for profiles storing fewer.
+
+        :param str profile: one of :const:`constants.INGEST_PROFILES`.
+        :raises ValueError: if the profile is not recognised.
+        """
+
+        if profile not in constants.INGEST_PROFILES:
+            raise ValueError("Unknown ingest profile: " + str(profile))
+
+        self.__profile = profile
+
+
+    def set_max_payload_bytes(self, max_bytes):
+        """
+        Configure the parser to store at most a number of bytes of each TCP
+        payload, in addition to any truncation by the ingest profile. As
+        analysis examines payloads only up to the MTU or a test window, this
+        reduces the bytes stored and retrieved for captures with large
+        segmentation-offloaded payloads. The true payload length is still
+        stored as `tcp_info.payload_len`, keeping length-based features exact.
+        The limit is recorded in the trace index, and only imports storing at
+        least as many payload bytes are reused.
+
+        :param int max_bytes: the maximum number of payload bytes stored, None
+            to store payloads in full.
+        :raises ValueError: if max_bytes is negative or not an integer.
+        """
+
+        if max_bytes is not None and (not isinstance(max_bytes, int) or max_bytes < 0):
+            raise ValueError("Invalid maximum payload bytes: " + str(max_bytes))
+
+        self.__max_payload_bytes = max_bytes
+
+
+    def get_payload_limit(self):
+        """
+        Return the maximum number of TCP payload bytes stored per packet under
+        the current ingest profile and maximum payload bytes.
+
+        :returns: the number of bytes, None if payloads are stored in full.
+        """
+
+        limits = [self.__max_payload_bytes]
+        if self.__profile == "payload-prefix":
+            limits.append(constants.PAYLOAD_PREFIX_LENGTH)
+        elif self.__profile == "lengths-only":
+            limits.append(0)
+        limits = [i for i in limits if i is not None]
+
+        return min(limits) if len(limits) > 0 else None
+
+
+    def set_offset_range(self, start=None, stop=None):
+        """
+        Configure the parser to only parse records of the pcap file located
+        between two byte offsets, for re-parsing part of a capture such as a
+        time range found by :meth:`~CovertMark.data.extractor.PCAPExtractor.offset_range`.
+        Partial parses are never reused or recorded as imports of the whole file.
+
+        :param int start: the byte offset of the first record parsed, from the
+            start of the file if None.
+        :param int stop: the byte offset after the last record parsed, to the
+            end of the file if None.
+        """
+
+        self.__offset_range = (start, stop)
+
+
+    def get_index_time(self):
+        """
+        Return the time taken to index the collection last inserted into.
+
+        :returns: index build time in seconds, None if no collection indexed or
+            indexes are still being built in the background.
+        """
+
+        return self.__index_time
+
+
+    def is_reused(self):
+        """
+        Return whether the last call to :meth:`load_and_insert_new` found an
+        existing import of identical pcap content and filters instead of parsing.
+
+        :returns: True if an existing collection was reused, False otherwise.
+        """
+
+        return self.__reused
 
 
     def get_ip_filter(self):
@@ -80,19 +206,29 @@ class PCAPParser:
     def load_packet_info(self):
         """
         Load and return information of raw packets.
-        Non-IP/IPv6 packets are ignored.
+        Non-IP/IPv6 packets are ignored. Some fields are omitted or truncated
+        under ingest profiles other than `full`, see :meth:`set_ingest_profile`.
         Format::
             [{
             type: v4/v6, dst: dst_ip, src: src_ip, len: packet_length,
             proto: protocol, time: time_stamp, ttl: TTL/hop_limit,
+            pcap_offset: byte_offset_of_record_in_pcap,
+            pcap_len: byte_length_of_record_in_pcap,
             tcp_info (None for non-TCP packets):
-                {sport: src_port, dport: dst_port, flags: tcp_flags,
+                {sport: src_port, dport: dst_port, flags: tcp_flags_bitmask,
                 opts: tcp_options, seq: tcp_seq, ack: tcp_ack,
-                payload: b64encoded_payload},
+                payload: b64encoded_payload (up to payload limit),
+                payload_len: true_payload_length,
+                payload_entropy: payload_entropy (if derived)},
             tls_info (None for non-TLS packets):
                 {type: tls_type, ver: tls_version, len: tls_data_length,
-                records: tls_num_records, data: [b64_encoded_tls_data],
-                data_length = [b64_encoded_tls_data_length]}
+                records: tls_num_records, data_length: [tls_data_length],
+                offsets: [tls_data_offset_in_tcp_payload] (TCP packets), or
+                data: [b64_encoded_tls_data] (other packets)},
+            http_info (None for non-HTTP packets):
+                {headers: http_headers, uri: http_uri, version: http_version},
+            has_tls: tls_info is not None (if derived),
+            has_http: http_info is not None (if derived)
             }]
 
         :returns: a list of packets parsed formatted as above.
@@ -103,9 +239,15 @@ class PCAPParser:
         check_filter = False
         if len(self.__filter) > 0:
             check_filter = True
+            src_matcher = utils.SubnetMatcher(self.__filter_src_rules)
+            dst_matcher = utils.SubnetMatcher(self.__filter_dst_rules)
+            bidir_matcher = utils.SubnetMatcher(self.__filter_bidir_rules)
+
+        full = self.__profile == "full"
+        payload_limit = self.get_payload_limit()
 
-        with open(self._pcap_file, 'rb') as f:
-            for ts, buf in dpkt.pcap.Reader(f):
+        with reader.PCAPReader(self._pcap_file) as pcap:
+            for offset, length, ts_ns, buf, _ in pcap.indexed_records(*self.__offset_range):
                 eth = dpkt.ethernet.Ethernet(buf)
                 packet_info = {}
 
@@ -126,27 +268,25 @@ class PCAPParser:
                     packet_info["ttl"] = ip.hlim
 
                 else:
-                    PCAPParser.log_invalid("Non ip/ip6 packet ignored: " + str(buf))
+                    PCAPParser.log_invalid("Non ip/ip6 packet ignored: " + str(bytes(buf)))
                     continue
 
                 # Drop this packet if filter rules exclude this packet.
                 if check_filter:
 
-                    src_net = utils.build_subnet(packet_info["src"])
-                    dst_net = utils.build_subnet(packet_info["dst"])
-
+                    # Raw address bytes are matched, without building subnets.
                     if len(self.__filter_src_rules) > 0:
-                        src_match = any([s.overlaps(src_net) for s in self.__filter_src_rules])
+                        src_match = src_matcher.match(ip.src)
                     else:
                         src_match = True # Default acceptance if unspecified.
 
                     if len(self.__filter_dst_rules) > 0:
-                        dst_match = any([s.overlaps(dst_net) for s in self.__filter_dst_rules])
+                        dst_match = dst_matcher.match(ip.dst)
                     else:
                         dst_match = True # Default acceptance if unspecified.
 
                     if len(self.__filter_bidir_rules) > 0:
-                        bidir_match = any([s.overlaps(src_net) or s.overlaps(dst_net) for s in self.__filter_bidir_rules])
+                        bidir_match = bidir_matcher.match(ip.src) or bidir_matcher.match(ip.dst)
                     else:
                         bidir_match = False # No default acceptance for bidirectional filters.
 
@@ -155,7 +295,9 @@ class PCAPParser:
                             continue
 
                 packet_info["proto"] = type(ip.data).__name__
-                packet_info["time"] = "{0:.6f}".format(ts)
+                packet_info["time"] = "{0:.6f}".format(ts_ns / 1e9)
+                packet_info["pcap_offset"] = offset
+                packet_info["pcap_len"] = length
 
                 # Check and record TCP information if applicable.
                 tcp_info = None
@@ -163,11 +305,14 @@ class PCAPParser:
                     tcp_info = {}
                     tcp_info["sport"] = ip.data.sport
                     tcp_info["dport"] = ip.data.dport
-                    tcp_info["flags"] = utils.parse_tcp_flags(ip.data.flags)
-                    tcp_info["opts"] = dpkt.tcp.parse_opts(ip.data.opts)
+                    tcp_info["flags"] = ip.data.flags # Integer bitmask, see utils.TCPFlags.
+                    if full:
+                        tcp_info["opts"] = [(o, bytes(d)) for o, d in dpkt.tcp.parse_opts(ip.data.opts)]
                     tcp_info["ack"] = ip.data.ack
                     tcp_info["seq"] = ip.data.seq
-                    tcp_info["payload"] = b64encode(ip.data.data)
+                    stored_payload = ip.data.data[:payload_limit]
+                    tcp_info["payload"] = b64encode(stored_payload)
+                    tcp_info["payload_len"] = len(ip.data.data)
                 packet_info["tcp_info"] = tcp_info
 
                 # Check and record TLS information if applicable.
@@ -178,11 +323,20 @@ class PCAPParser:
                     tls_data["ver"] = constants.TLS_VERSION[tls.version]
                     tls_data["len"] = tls.len
                     tls_data["records"] = len(tls.records) # Number of records.
-                    tls_data["data"] = []
                     tls_data["data_length"] = []
+                    offsets = []
+                    record_offset = 0
                     for record in tls.records:
-                        tls_data["data"].append(b64encode(record.data))
+                        offsets.append(record_offset + 5) # After the record header.
+                        record_offset += 5 + len(record.data)
                         tls_data["data_length"].append(len(record.data))
+                    # Record data is referenced in the stored TCP payload rather
+                    # than stored again, if it is located there as expected.
+                    if tcp_info is not None and all([len(r.data) == len(stored_payload[o:o+len(r.data)])
+                     and ip.data.data[o:o+len(r.data)] == r.data for o, r in zip(offsets, tls.records)]):
+                        tls_data["offsets"] = offsets
+                    elif full:
+                        tls_data["data"] = [b64encode(record.data) for record in tls.records]
                 except:
                     tls_data = None
                 packet_info["tls_info"] = tls_data
@@ -191,38 +345,66 @@ class PCAPParser:
                 try:
                     http_request = dpkt.http.Request(ip.data.data)
                     http_data = {}
-                    http_data['headers'] = http_request.headers
+                    if full:
+                        http_data['headers'] = http_request.headers
                     http_data['uri'] = http_request.uri
                     http_data['version'] = http_request.version
                 except:
                     http_data = None
                 packet_info["http_info"] = http_data
 
+                # Record derived fields if required.
+                if self.__derive:
+                    packet_info["has_tls"] = tls_data is not None
+                    packet_info["has_http"] = http_data is not None
+                    if tcp_info is not None:
+                        tcp_info["payload_entropy"] = utils.byte_entropy(ip.data.data)
+
                 packet_list.append(packet_info)
 
         return packet_list
 
 
-    def load_and_insert_new(self, description=""):
+    def load_and_insert_new(self, description="", reuse=True):
         """
         Load raw packet from pcap file, and insert into a new collection.
         Returned collection name **must** be verified to not be False.
+        The content hash of the pcap file and the input filters are recorded in
+        the trace index, and if reuse is enabled, parsing is skipped in favour
+        of a completed import of identical content and filters.
 
         :param str description: description of the new collection, empty by default.
-        :returns: name of the new collection, False if failed.
+        :param bool reuse: True to return an identical existing import if found.
+        :returns: name of the new or reused collection, False if failed.
         """
 
+        self.__reused = False
+        partial = self.__offset_range != (None, None)
+        pcap_hash = utils.hash_file(self._pcap_file)
+        if reuse and not partial:
+            existing = self.__db.find_import(pcap_hash, self.__filter, self.__derive,
+             self.__profile, self.get_payload_limit())
+            if existing:
+                self.__reused = True
+                self.__index_time = 0.0
+                return existing
+
         packets = self.load_packet_info()
         if len(packets) == 0: # No packet loaded (likely incorrect ip filter.)
             return False
 
-        new_collection = self.__db.new_collection(description=description, input_filters=self.__filter)
+        new_collection = self.__db.new_collection(description=description,
+         input_filters=self.__filter, derived_fields=self.__derive,
+         ingest_profile=self.__profile, max_payload_bytes=self.get_payload_limit())
         if not new_collection:
             return False
 
         insertion_result = self.__db.insert_packets(packets, collection_name=new_collection)
 
         if len(insertion_result["inserted"].inserted_ids) > 0:
+            self.__index_time = self.__db.index_collection(new_collection, background=True)
+            if not partial:
+                self.__db.record_import(new_collection, pcap_hash, self.__filter)
             return new_collection
         else:
             return False
@@ -242,6 +424,8 @@ class PCAPParser:
         insertion_result = self.__db.insert_packets(packets, collection_name=collection_name)
 
         if len(insertion_result["inserted"].inserted_ids) > 0:
+            self.__index_time = self.__db.index_collection(collection_name, background=True)
+            self.__db.record_import(collection_name, None) # No longer a single import.
             return True
         else:
             return False
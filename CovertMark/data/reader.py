@@ -0,0 +1,369 @@
+import mmap
+import struct
+
+# Magic numbers of classic pcap files as read in little-endian byte order,
+# mapping to the number of timestamp fraction units per second.
+PCAP_MAGIC = {0xa1b2c3d4: 10 ** 6, 0xa1b23c4d: 10 ** 9}
+
+# pcapng block types.
+PCAPNG_SHB = 0x0a0d0d0a # Section header block, the same in both byte orders.
+PCAPNG_IDB = 0x00000001 # Interface description block.
+PCAPNG_OPB = 0x00000002 # Obsolete packet block.
+PCAPNG_SPB = 0x00000003 # Simple packet block.
+PCAPNG_EPB = 0x00000006 # Enhanced packet block.
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_IF_TSRESOL = 9 # Interface option of timestamp resolution.
+
+DLT_EN10MB = 1 # Ethernet link type.
+
+
+class PCAPReader:
+    """
+    A reader of pcap and pcapng captures through a read-only memory map of the
+    capture file. Record headers are decoded in place, and each packet is handed
+    out as a memoryview slice of the map rather than copied into new bytes.
+    Microsecond and nanosecond pcap timestamps, pcapng timestamp resolutions,
+    and captures of either byte order are supported.
+
+    Iterating the reader yields `(timestamp, buffer)` pairs as
+    :class:`dpkt.pcap.Reader` does. Buffers are only valid while the reader is
+    open, and should be copied with `bytes(buffer)` if kept beyond that.
+    """
+
+    def __init__(self, pcap_file):
+        """
+        :param str pcap_file: path to the pcap or pcapng file.
+        :raises ValueError: if the file is empty or not a pcap or pcapng capture.
+        """
+
+        self._file = open(pcap_file, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError("Empty capture file: " + pcap_file)
+        self._view = memoryview(self._map)
+
+        if len(self._view) >= 4 and struct.unpack_from("<I", self._view)[0] == PCAPNG_SHB:
+            self._pcapng = True
+            self._endian = "<"
+            self._interfaces = []
+            self._linktype = None
+            self._indexed = False # Whether interfaces of the whole capture are read.
+        else:
+            self._pcapng = False
+            self._read_pcap_header(pcap_file)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def __iter__(self):
+        for ts_ns, buf, _ in self.records():
+            yield ts_ns / 1e9, buf
+
+
+    def close(self):
+        """
+        Release the memory map and the capture file. If buffers handed out are
+        still referenced, the map is released once they are no longer in use.
+        """
+
+        self._view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            pass
+        self._file.close()
+
+
+    def datalink(self):
+        """
+        Return the link type of the capture, that of the first interface for
+        pcapng captures.
+
+        :returns: the integer link type, None if a pcapng capture has no
+            interface described yet.
+        """
+
+        if self._pcapng and self._linktype is None and len(self._interfaces) == 0:
+            for _ in self.records():
+                break
+
+        return self._linktype
+
+
+    def is_pcapng(self):
+        """
+        :returns: True if the capture is in pcapng format.
+        """
+
+        return self._pcapng
+
+
+    def ts_resolution(self):
+        """
+        Return the timestamp resolution of the capture, that of the first
+        interface for pcapng captures.
+
+        :returns: the number of timestamp units per second.
+        """
+
+        if self._pcapng:
+            self.datalink()
+            return self._interfaces[0][2] if len(self._interfaces) > 0 else 10 ** 6
+
+        return self._ts_units
+
+
+    def records(self, start=None, stop=None):
+        """
+        Iterate the packet records of the capture in place.
+
+        :param int start: if set, only records at or after this byte offset
+            of the capture are returned.
+        :param int stop: if set, only records before this byte offset of the
+            capture are returned.
+        :returns: a generator of `(timestamp_ns, buffer, original_length)`,
+            where timestamp_ns is the timestamp in integer nanoseconds, buffer
+            a memoryview of captured bytes, and original_length the length of
+            the packet on the wire.
+        """
+
+        for _, _, ts_ns, buf, wirelen in self._records(start, stop):
+            yield ts_ns, buf, wirelen
+
+
+    def indexed_records(self, start=None, stop=None):
+        """
+        Iterate the packet records of the capture in place with their locations,
+        allowing them to be read again later with :meth:`record_at`.
+
+        :param int start: see :meth:`records`.
+        :param int stop: see :meth:`records`.
+        :returns: a generator of `(offset, length, timestamp_ns, buffer,
+            original_length)`, where offset is the byte offset of the record in
+            the capture and length the number of bytes of the record including
+            its header, followed by fields as in :meth:`records`.
+        """
+
+        return self._records(start, stop)
+
+
+    def record_at(self, offset):
+        """
+        Read a single packet record at a byte offset returned by
+        :meth:`indexed_records`, without reading records before it. For pcapng
+        captures, interface descriptions are read once beforehand, and those of
+        the last section apply if the capture has more than one.
+
+        :param int offset: the byte offset of the record in the capture.
+        :returns: a tuple of `(timestamp_ns, buffer, original_length)` as in
+            :meth:`records`.
+        :raises ValueError: if no packet record is found at offset.
+        """
+
+        if self._pcapng:
+            if not self._indexed:
+                for _ in self._pcapng_records():
+                    pass
+                self._indexed = True
+            record = self._pcapng_packet(offset) if offset + 12 <= len(self._view) else None
+        else:
+            record = next(self._pcap_records(max(offset, 24)), None)
+            if record is not None and record[0] != offset:
+                record = None
+
+        if record is None:
+            raise ValueError("No packet record at offset " + str(offset))
+
+        return record[2:]
+
+
+    def shards(self, count):
+        """
+        Split the capture into byte ranges of roughly equal size, aligned to
+        packet records, for reading in parallel with :meth:`records`. Only
+        record headers are read to find the boundaries.
+
+        :param int count: the number of shards wanted.
+        :returns: a list of up to count `(start, stop)` byte offsets, covering
+            all records of the capture in order.
+        """
+
+        size = len(self._view)
+        boundaries = [0]
+        for offset, _, _, _, _ in self._records(None, None):
+            if offset >= size * len(boundaries) // count and len(boundaries) < count:
+                boundaries.append(offset)
+        boundaries.append(size)
+        boundaries = sorted(set(boundaries))
+
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+    def _records(self, start, stop):
+        """
+        Iterate records with the byte offsets and lengths of their headers.
+        """
+
+        if self._pcapng:
+            records = self._pcapng_records()
+        else:
+            records = self._pcap_records(max(start or 0, 24)) # After the global header.
+
+        for record in records:
+            if start is not None and record[0] < start:
+                continue
+            if stop is not None and record[0] >= stop:
+                break
+            yield record
+
+
+    def _read_pcap_header(self, pcap_file):
+        """
+        Decode the global header of a classic pcap file.
+        """
+
+        if len(self._view) < 24:
+            self.close()
+            raise ValueError("Invalid pcap header: " + pcap_file)
+
+        magic = struct.unpack_from("<I", self._view)[0]
+        if magic in PCAP_MAGIC:
+            self._endian = "<"
+        else:
+            magic = struct.unpack_from(">I", self._view)[0]
+            if magic not in PCAP_MAGIC:
+                self.close()
+                raise ValueError("Not a pcap or pcapng capture: " + pcap_file)
+            self._endian = ">"
+
+        self._ts_units = PCAP_MAGIC[magic]
+        self._snaplen, self._linktype = struct.unpack_from(self._endian + "II", self._view, 16)
+
+
+    def _pcap_records(self, offset):
+        """
+        Iterate records of a classic pcap file from the byte offset of a
+        record header.
+        """
+
+        header = struct.Struct(self._endian + "IIII")
+        view = self._view
+        size = len(view)
+        ns_per_unit = 10 ** 9 // self._ts_units
+
+        while offset + header.size <= size:
+            ts_sec, ts_frac, caplen, wirelen = header.unpack_from(view, offset)
+            data = offset + header.size
+            if data + caplen > size: # Truncated last record.
+                break
+            yield offset, header.size + caplen, ts_sec * 10 ** 9 + ts_frac * ns_per_unit, \
+             view[data:data+caplen], wirelen
+            offset = data + caplen
+
+
+    def _pcapng_records(self):
+        """
+        Iterate packet blocks of a pcapng file, following section headers and
+        interface descriptions for byte order and timestamp resolution. Blocks
+        are always walked from the start of the file to keep track of these.
+        """
+
+        view = self._view
+        size = len(view)
+        self._endian = "<"
+        offset = 0
+
+        while offset + 12 <= size:
+            block_type = struct.unpack_from(self._endian + "I", view, offset)[0]
+
+            if block_type == PCAPNG_SHB: # Byte order may change at each section.
+                if struct.unpack_from("<I", view, offset + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC:
+                    self._endian = "<"
+                else:
+                    self._endian = ">"
+                self._interfaces = []
+
+            block_length = struct.unpack_from(self._endian + "I", view, offset + 4)[0]
+            if block_length < 12 or offset + block_length > size: # Truncated last block.
+                break
+
+            if block_type == PCAPNG_IDB:
+                body = offset + 8
+                linktype, _, snaplen = struct.unpack_from(self._endian + "HHI", view, body)
+                self._interfaces.append((linktype, snaplen, self._pcapng_resolution(view,
+                 body + 8, offset + block_length - 4, self._endian)))
+                if self._linktype is None:
+                    self._linktype = linktype
+
+            elif block_type in (PCAPNG_EPB, PCAPNG_OPB, PCAPNG_SPB):
+                yield self._pcapng_packet(offset)
+
+            offset += block_length
+
+
+    def _pcapng_packet(self, offset):
+        """
+        Decode a pcapng packet block with the current byte order and interfaces.
+
+        :returns: a record as yielded by :meth:`_records`, None if the block at
+            offset is not a packet block.
+        """
+
+        view = self._view
+        endian = self._endian
+        block_type, block_length = struct.unpack_from(endian + "II", view, offset)
+        body = offset + 8
+        body_end = offset + block_length - 4
+
+        if block_type == PCAPNG_EPB or block_type == PCAPNG_OPB:
+            if block_type == PCAPNG_EPB:
+                interface, ts_high, ts_low, caplen, wirelen = \
+                 struct.unpack_from(endian + "IIIII", view, body)
+            else:
+                interface, _, ts_high, ts_low, caplen, wirelen = \
+                 struct.unpack_from(endian + "HHIIII", view, body)
+            data = body + 20
+            ts_units = self._interfaces[interface][2]
+            ticks = (ts_high << 32) | ts_low
+            ts_ns = ticks * 10 ** 9 // ts_units
+            return offset, block_length, ts_ns, view[data:min(data+caplen, body_end)], wirelen
+
+        elif block_type == PCAPNG_SPB:
+            wirelen = struct.unpack_from(endian + "I", view, body)[0]
+            snaplen = self._interfaces[0][1] if len(self._interfaces) > 0 else 0
+            caplen = min(wirelen, snaplen) if snaplen > 0 else wirelen
+            data = body + 4
+            return offset, block_length, 0, view[data:min(data+caplen, body_end)], wirelen # No timestamp recorded.
+
+        return None
+
+
+    @staticmethod
+    def _pcapng_resolution(view, offset, end, endian):
+        """
+        Find the timestamp resolution of an interface from its options.
+
+        :returns: the number of timestamp units per second, 10^6 by default.
+        """
+
+        while offset + 4 <= end:
+            code, length = struct.unpack_from(endian + "HH", view, offset)
+            if code == 0: # End of options.
+                break
+            if code == PCAPNG_IF_TSRESOL and length >= 1:
+                resolution = view[offset + 4]
+                if resolution & 0x80:
+                    return 2 ** (resolution & 0x7f)
+                else:
+                    return 10 ** resolution
+            offset += 4 + ((length + 3) & ~3)
+
+        return 10 ** 6
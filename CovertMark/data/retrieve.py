@@ -1,11 +1,14 @@
-from . import utils, constants, mongo
+from . import utils, constants, backend
 
 from base64 import b64decode
+from collections import defaultdict
+from collections.abc import Mapping, MutableMapping, Sequence
+import sys
 
 class Retriever:
 
     def __init__(self):
-        self.__db = mongo.MongoDBManager(db_server=constants.MONGODB_SERVER)
+        self.__db = backend.get_backend()
         self._collection = None
 
 
@@ -17,7 +20,9 @@ class Retriever:
         :param list match_filters: a list of :mod:`CovertMark.data.constants` filter types to
             match with those of stored collections, returning only matched
             collections. If None, return all collections.
-        :returns: list of traces with `{name, creation_time, description}`.
+        :returns: list of traces with `{name, creation_time, description,
+            input_filters, count}`, as well as `{bytes, start_time, end_time}`
+            if recorded at insertion.
         """
 
         traces = self.__db.list_collections()
@@ -31,7 +36,8 @@ class Retriever:
             traces = qualified_traces
 
         for trace in traces:
-            trace["count"] = self.__db.count_packets(trace["name"])
+            if "count" not in trace: # Imported before counts were recorded.
+                trace["count"] = self.__db.estimate_packets(trace["name"])
 
         if not in_string:
             return traces
@@ -119,20 +125,24 @@ class Retriever:
         return self.__db.count_packets(self._collection, trace_filter)
 
 
-    def distinct(self, column):
+    def distinct(self, column, approximate=False):
         """
         Count the number of distinct fields in the currently selected MongoDB
         collection's specified column.
 
         :param str field: name of the column for counting distinct addresses.
+        :param bool approximate: if True, estimate the count with HyperLogLog
+            rather than counting exactly, see
+            :meth:`~CovertMark.data.mongo.MongoDBManager.distinct_packets`.
         :returns: the number of packets matching the filter in the currently
             selected collection.
         """
 
-        return self.__db.distinct_packets(self._collection, column)
+        return self.__db.distinct_packets(self._collection, column, approximate)
 
 
-    def retrieve(self, trace_filter={}, limit=0):
+    def retrieve(self, trace_filter={}, limit=0, projection=None, payload_views=False,
+     records=False):
         """
         Retrieve packets from the currently selected MongoDB collection into
         memory, decoding base64-encoded payload and TLS data where possible.
@@ -141,38 +151,587 @@ class Retriever:
             case all packets returned.
         :param int limit: a positive integer containing the maximum number of packets
             to retrieve (normally in time-ascending order), or 0 for unlimited.
+        :param dict projection: a MongoDB projection of packet fields to include
+            or exclude, e.g. `{"dst": True, "tcp_info.payload_len": True}`. Full
+            packets are retrieved if None.
+        :param bool payload_views: if True, TCP payloads are held in one
+            contiguous :class:`~CovertMark.data.backend.PayloadArena` and returned
+            as memoryview slices of it, rather than as separate bytes objects.
+        :param bool records: if True, packets are returned as compact
+            :class:`Packet` records with dict-style access rather than as dicts.
         :returns: List of packets as specified. Returns an empty list of packets
             if no collection is selected or filter invalid.
         """
 
+        try:
+            packets = [x for x in self.iter_retrieve(trace_filter, limit, projection,
+             records=records)]
+            if payload_views and not self.__db.PAYLOAD_VIEWS:
+                Retriever._pack_payloads(packets)
+        except MemoryError:
+            print("Warning: cannot allocate sufficient memory for packets, perhaps you are using Windows?")
+            return []
+        except self.__db.QUERY_ERRORS:
+            return []
+
+        return packets
+
+
+    def retrieve_cached(self, trace_filter={}, projection=None, payload_views=False,
+     records=False):
+        """
+        Retrieve packets from the currently selected MongoDB collection as in
+        :meth:`retrieve`, through the process-level trace cache. Packets retrieved
+        with the same filter and projection are returned without querying MongoDB
+        while cached. The packets are shared with other holders of the trace, so
+        they are made read-only: dicts are returned as :class:`FrozenDict`,
+        lists as tuples, and records frozen, see :meth:`PacketRecord.freeze`.
+
+        :param dict trace_filter: a MongoDB query filter, can be empty -- in which
+            case all packets returned.
+        :param dict projection: a MongoDB projection of packet fields, see
+            :meth:`retrieve`.
+        :param bool payload_views: see :meth:`retrieve`, packets retrieved
+            with and without payload views are cached separately.
+        :param bool records: see :meth:`retrieve`, packets retrieved as records
+            and as dicts are cached separately.
+        :returns: a tuple of read-only packets as specified. Returns an empty
+            tuple if no collection is selected or filter invalid.
+        """
+
+        if not self._collection:
+            return ()
+
+        location = self.__db.location
+        payload_views = payload_views or self.__db.PAYLOAD_VIEWS # Always views if so stored.
+        packets = backend.trace_cache.get(location, self._collection, trace_filter,
+         projection, payload_views, records)
+        if packets is None:
+            packets = tuple([Retriever._freeze(i) for i in self.retrieve(trace_filter,
+             projection=projection, payload_views=payload_views, records=records)])
+            if len(packets) > 0:
+                backend.trace_cache.put(location, self._collection, trace_filter,
+                 projection, packets, payload_views, records)
+
+        return packets
+
+
+    def iter_retrieve(self, trace_filter={}, limit=0, projection=None,
+     batch_size=constants.RETRIEVE_BATCH_SIZE, batched=False, records=False):
+        """
+        Stream packets from the currently selected MongoDB collection, decoding
+        each as in :meth:`retrieve` as soon as it arrives. Only one batch of
+        packets is held by the cursor at a time, allowing collections larger than
+        memory to be processed.
+
+        :param dict trace_filter: a MongoDB query filter, can be empty -- in which
+            case all packets returned.
+        :param int limit: a positive integer containing the maximum number of packets
+            to retrieve, or 0 for unlimited.
+        :param dict projection: a MongoDB projection of packet fields, see
+            :meth:`retrieve`.
+        :param int batch_size: the number of packets fetched in each round trip
+            to MongoDB, and the size of batches yielded if `batched` is set.
+        :param bool batched: if True, yield lists of up to `batch_size` packets
+            rather than individual packets.
+        :param bool records: if True, yield :class:`Packet` records rather than
+            dicts, see :meth:`retrieve`.
+        :returns: a generator of packets or lists of packets as specified. Nothing
+            is generated if no collection is selected.
+        :raises pymongo.errors.PyMongoError: if the filter is invalid or the
+            connection fails while streaming.
+        """
+
         if isinstance(limit, int) and limit > 0:
             max_r = limit
         else:
             max_r = 0
 
+        packets = self.__db.iter_packets(self._collection, trace_filter, max_r,
+         projection, batch_size)
+        if not packets:
+            return
+
+        decode = not self.__db.DECODED_PAYLOADS
+        batch = []
+        for packet in packets:
+            if decode:
+                Retriever._decode_packet(packet)
+            if records:
+                packet = Packet.from_dict(packet)
+            Retriever._reference_tls_data(packet)
+            if not batched:
+                yield packet
+                continue
+
+            batch.append(packet)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+
+        if len(batch) > 0:
+            yield batch
+
+
+    def payload_length_histogram(self, trace_filter={}):
+        """
+        Count TCP packets in the currently selected MongoDB collection by their
+        payload length. Counting is done by the server, so no payload is
+        transferred except for packets stored without a recorded payload length.
+
+        :param dict trace_filter: a MongoDB query filter, can be empty -- in which
+            case all TCP packets are counted.
+        :returns: a dict mapping TCP payload lengths to the number of packets
+            matching the filter. Empty if no collection is selected or filter invalid.
+        """
+
+        pipeline = [{"$match": Retriever._tcp_filter(trace_filter)},
+                    {"$group": {"_id": "$tcp_info.payload_len", "count": {"$sum": 1}}}]
+
         try:
-            packets = self.__db.find_packets(self._collection, trace_filter, max_r)
-        except MemoryError:
-            print("Warning: cannot allocate sufficient memory for packets, perhaps you are using Windows?")
-            return []
+            groups = self.__db.aggregate_packets(self._collection, pipeline)
         except:
+            return {}
+
+        if not groups:
+            return {}
+
+        histogram = defaultdict(int)
+        for group in groups:
+            if group["_id"] is None:
+                for length, _ in self._unrecorded_payload_lengths(trace_filter):
+                    histogram[length] += 1
+            else:
+                histogram[group["_id"]] += group["count"]
+
+        return dict(histogram)
+
+
+    def payload_length_destinations(self, trace_filter={}):
+        """
+        Count TCP packets in the currently selected MongoDB collection by their
+        payload length and destination address, grouped by the server.
+
+        :param dict trace_filter: a MongoDB query filter, can be empty -- in which
+            case all TCP packets are counted.
+        :returns: a dict mapping TCP payload lengths to dicts of destination
+            addresses and the number of packets sent to them with that payload
+            length. Empty if no collection is selected or filter invalid.
+        """
+
+        pipeline = [{"$match": Retriever._tcp_filter(trace_filter)},
+                    {"$group": {"_id": {"len": "$tcp_info.payload_len", "dst": "$dst"},
+                     "count": {"$sum": 1}}}]
+
+        try:
+            groups = self.__db.aggregate_packets(self._collection, pipeline)
+        except:
+            return {}
+
+        if not groups:
+            return {}
+
+        destinations = defaultdict(lambda: defaultdict(int))
+        unrecorded = False
+        for group in groups:
+            if group["_id"].get("len") is None:
+                unrecorded = True
+            else:
+                destinations[group["_id"]["len"]][group["_id"]["dst"]] += group["count"]
+
+        if unrecorded:
+            for length, dst in self._unrecorded_payload_lengths(trace_filter):
+                destinations[length][dst] += 1
+
+        return {length: dict(dsts) for length, dsts in destinations.items()}
+
+
+    def count_by_destination(self, trace_filter={}):
+        """
+        Count packets in the currently selected MongoDB collection by their
+        destination address, grouped by the server.
+
+        :param dict trace_filter: a MongoDB query filter, can be empty -- in which
+            case all packets are counted.
+        :returns: a dict mapping destination addresses to the number of packets
+            matching the filter. Empty if no collection is selected or filter invalid.
+        """
+
+        pipeline = [{"$match": trace_filter},
+                    {"$group": {"_id": "$dst", "count": {"$sum": 1}}}]
+
+        try:
+            groups = self.__db.aggregate_packets(self._collection, pipeline)
+        except:
+            return {}
+
+        if not groups:
+            return {}
+
+        return {group["_id"]: group["count"] for group in groups}
+
+
+    def count_presence(self, trace_filter={}):
+        """
+        Count packets in the currently selected MongoDB collection bearing valid
+        TLS records or HTTP requests, summed by the server.
+
+        :param dict trace_filter: a MongoDB query filter, can be empty -- in which
+            case all packets are counted.
+        :returns: a dict containing `{total, tls, http, non_tls_http}`, the
+            numbers of matching packets, those with TLS records, those with HTTP
+            requests, and those with HTTP requests but no TLS records. All zero
+            if no collection is selected, None if the summary failed, such as
+            when the filter is invalid.
+        """
+
+        has_tls = {"$ne": ["$tls_info", None]}
+        no_tls = {"$eq": ["$tls_info", None]}
+        has_http = {"$ne": ["$http_info", None]}
+        pipeline = [{"$match": trace_filter},
+                    {"$group": {"_id": None,
+                     "total": {"$sum": 1},
+                     "tls": {"$sum": {"$cond": [has_tls, 1, 0]}},
+                     "http": {"$sum": {"$cond": [has_http, 1, 0]}},
+                     "non_tls_http": {"$sum": {"$cond": [{"$and": [no_tls, has_http]}, 1, 0]}}}}]
+
+        presence = {"total": 0, "tls": 0, "http": 0, "non_tls_http": 0}
+
+        try:
+            groups = self.__db.aggregate_packets(self._collection, pipeline)
+        except:
+            return None
+
+        if groups:
+            for key in presence:
+                presence[key] = groups[0][key]
+
+        return presence
+
+
+    def _unrecorded_payload_lengths(self, trace_filter):
+        """
+        Find payload lengths of TCP packets stored without a recorded payload
+        length, which is the case for collections imported by earlier versions.
+        Only payloads and destinations of these packets are transferred.
+
+        :param dict trace_filter: a MongoDB query filter.
+        :returns: a list of tuples containing the payload length and destination
+            address of each of these packets.
+        """
+
+        pipeline = [{"$match": {"$and": [Retriever._tcp_filter(trace_filter),
+                     {"tcp_info.payload_len": {"$exists": False}}]}},
+                    {"$project": {"_id": False, "dst": True, "tcp_info.payload": True}}]
+
+        packets = self.__db.aggregate_packets(self._collection, pipeline)
+        if not packets:
             return []
 
-        # Attempt to decode base64 payloads.
-        for packet in packets:
-            if packet["tcp_info"] is not None:
-                if isinstance(packet["tcp_info"]["payload"], bytes):
+        return [(len(b64decode(i["tcp_info"]["payload"])), i["dst"]) for i in packets]
+
+
+    @staticmethod
+    def _freeze(value, tcp_info=None):
+        """
+        Make a decoded packet, or a field of it, read-only for sharing between
+        holders. Dicts are copied as :class:`FrozenDict` and lists as tuples,
+        while records are frozen in place.
+
+        :param value: a packet as a dict or :class:`Packet`, or a field of it.
+        :param tcp_info: the read-only `tcp_info` of the packet, referenced by
+            the data of its TLS records.
+        :returns: the read-only packet or field.
+        """
+
+        if isinstance(value, TLSRecordData):
+            return TLSRecordData(tcp_info, tuple(value._offsets), tuple(value._lengths))
+        if isinstance(value, list):
+            return tuple([Retriever._freeze(i, tcp_info) for i in value])
+        if not isinstance(value, (dict, PacketRecord)):
+            return value
+
+        if "tcp_info" in value: # A packet, with TLS data referencing its payload.
+            tcp_info = Retriever._freeze(value["tcp_info"])
+        fields = {key: tcp_info if key == "tcp_info" else Retriever._freeze(field, tcp_info) \
+         for key, field in value.items()}
+
+        if isinstance(value, PacketRecord):
+            for key, field in fields.items():
+                value[key] = field
+            return value.freeze()
+
+        return FrozenDict(fields)
+
+
+    @staticmethod
+    def _pack_payloads(packets):
+        """
+        Move decoded TCP payloads of packets into one payload arena, replacing
+        each with a memoryview slice of the arena.
+
+        :param list packets: decoded packets.
+        """
+
+        tcp_infos = [i["tcp_info"] for i in packets if isinstance(i.get("tcp_info"), Mapping) \
+         and isinstance(i["tcp_info"].get("payload"), bytes)]
+        arena = backend.PayloadArena.from_payloads([i["payload"] for i in tcp_infos])
+        for i, tcp_info in enumerate(tcp_infos):
+            tcp_info["payload"] = arena.view(i)
+
+
+    @staticmethod
+    def _tcp_filter(trace_filter):
+        """
+        Restrict a MongoDB query filter to TCP packets only.
+
+        :param dict trace_filter: a MongoDB query filter, can be empty.
+        :returns: the combined MongoDB query filter.
+        """
+
+        tcp_filter = {"tcp_info": {"$ne": None}}
+        if not trace_filter:
+            return tcp_filter
+
+        return {"$and": [trace_filter, tcp_filter]}
+
+
+    @staticmethod
+    def _reference_tls_data(packet):
+        """
+        Give a packet storing its TLS records as offsets into its TCP payload
+        the `data` of records as in :meth:`~CovertMark.data.parser.PCAPParser.load_packet_info`,
+        resolved from the payload when accessed. Nothing is done if the payload
+        or record offsets have been projected out.
+
+        :param dict packet: a decoded packet.
+        """
+
+        tls_info = packet.get("tls_info")
+        tcp_info = packet.get("tcp_info")
+        if not isinstance(tls_info, dict) or "offsets" not in tls_info or "data" in tls_info:
+            return
+        if not isinstance(tcp_info, Mapping) or "payload" not in tcp_info or "data_length" not in tls_info:
+            return
+
+        tls_info["data"] = TLSRecordData(tcp_info, tls_info["offsets"], tls_info["data_length"])
+
+
+    @staticmethod
+    def _decode_packet(packet):
+        """
+        Decode base64-encoded payload and TLS data of a packet in place where
+        possible, skipping fields which have been projected out. TCP flags
+        stored as an integer bitmask are given dict access through
+        :class:`~CovertMark.data.utils.TCPFlags`.
+
+        :param dict packet: a packet retrieved from MongoDB.
+        """
+
+        tcp_info = packet.get("tcp_info")
+        if tcp_info is not None:
+            if isinstance(tcp_info.get("flags"), int):
+                tcp_info["flags"] = utils.TCPFlags(tcp_info["flags"])
+            if isinstance(tcp_info.get("payload"), bytes):
+                try:
+                    tcp_info["payload"] = b64decode(tcp_info["payload"])
+                except:
+                    return
+
+        tls_info = packet.get("tls_info")
+        if tls_info is not None and "data" in tls_info:
+            for i, data in enumerate(tls_info["data"]):
+                if isinstance(data, bytes):
                     try:
-                        packet["tcp_info"]["payload"] = b64decode(packet["tcp_info"]["payload"])
+                        tls_info["data"][i] = b64decode(data)
                     except:
                         continue
 
-            if packet["tls_info"] is not None:
-                for i, data in enumerate(packet["tls_info"]["data"]):
-                    if isinstance(data, bytes):
-                        try:
-                            packet["tls_info"]["data"][i] = b64decode(data)
-                        except:
-                            continue
 
-        return packets
+class TLSRecordData(Sequence):
+    """
+    The data of TLS records in a packet, referenced by offsets into its TCP
+    payload instead of stored separately, and sliced from the payload only
+    when accessed.
+    """
+
+    def __init__(self, tcp_info, offsets, lengths):
+        """
+        :param dict tcp_info: the `tcp_info` of the packet holding the payload,
+            a dict or :class:`TCPInfo`.
+        :param list offsets: the offset of the data of each record in the payload.
+        :param list lengths: the length of the data of each record.
+        """
+
+        self._tcp_info = tcp_info
+        self._offsets = offsets
+        self._lengths = lengths
+
+
+    def __len__(self):
+        return len(self._offsets)
+
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        offset = self._offsets[i]
+        return self._tcp_info["payload"][offset:offset+self._lengths[i]]
+
+
+    def __eq__(self, other):
+        return isinstance(other, (list, tuple, TLSRecordData)) and list(self) == list(other)
+
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class FrozenDict(dict):
+    """
+    A dict which cannot be modified, holding packets and their fields shared
+    through the trace cache. Copies made with :meth:`copy` or `dict()` are
+    ordinary dicts.
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Shared packets are read-only, modify a copy instead.")
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+class PacketRecord(MutableMapping):
+    """
+    A packet held in slots rather than a dict, read and written as a dict of
+    the fields listed in :attr:`FIELDS`. Fields not set, such as those
+    projected out, are missing keys. Records avoid the per-packet hash table
+    of a dict, and share repeated strings such as addresses across packets.
+    Any other fields, such as those stored by other versions, are carried in
+    a dict of extra fields created only when needed.
+    """
+
+    __slots__ = ("_frozen", "_extra")
+    FIELDS = ()
+    INTERNED = () # String fields shared across packets through sys.intern.
+
+    def __init__(self, fields={}):
+        """
+        :param dict fields: the fields of the packet.
+        """
+
+        for key, value in fields.items():
+            self[key] = value
+
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            return getattr(self, "_extra", {})[key]
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+
+    def __setitem__(self, key, value):
+        if self.frozen:
+            raise TypeError("Shared packets are read-only, modify a copy instead.")
+        if key not in self.FIELDS:
+            if not hasattr(self, "_extra"):
+                self._extra = {}
+            self._extra[key] = value
+            return
+        if key in self.INTERNED and isinstance(value, str):
+            value = sys.intern(value)
+        setattr(self, key, value)
+
+
+    def __delitem__(self, key):
+        if self.frozen:
+            raise TypeError("Shared packets are read-only, modify a copy instead.")
+        if key not in self.FIELDS:
+            del getattr(self, "_extra", {})[key]
+            return
+        try:
+            delattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+
+    def __iter__(self):
+        for key in self.FIELDS:
+            if hasattr(self, key):
+                yield key
+        yield from getattr(self, "_extra", {})
+
+
+    def __len__(self):
+        return sum([1 for _ in self])
+
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+    @property
+    def frozen(self):
+        """
+        Whether the record has been made read-only by :meth:`freeze`.
+        """
+
+        return getattr(self, "_frozen", False)
+
+
+    def freeze(self):
+        """
+        Make the record read-only, so that it can be shared between holders.
+        Fields it holds are not frozen.
+
+        :returns: the record.
+        """
+
+        self._frozen = True
+        return self
+
+
+class TCPInfo(PacketRecord):
+    """
+    The `tcp_info` of a :class:`Packet`.
+    """
+
+    FIELDS = ("sport", "dport", "flags", "opts", "ack", "seq", "payload",
+              "payload_len", "payload_entropy")
+    __slots__ = FIELDS
+
+
+class Packet(PacketRecord):
+    """
+    A packet in the format of :meth:`~CovertMark.data.parser.PCAPParser.load_packet_info`,
+    with its `tcp_info` held as a :class:`TCPInfo`. The `tls_info` and
+    `http_info` of the few packets carrying them remain dicts.
+    """
+
+    FIELDS = ("type", "dst", "src", "len", "proto", "time", "ttl", "pcap_offset",
+              "pcap_len", "tcp_info", "tls_info", "http_info", "has_tls", "has_http")
+    INTERNED = ("type", "dst", "src", "proto")
+    __slots__ = FIELDS
+
+    @classmethod
+    def from_dict(cls, packet):
+        """
+        Convert a retrieved packet into a record.
+
+        :param dict packet: a packet as retrieved.
+        :returns: a :class:`Packet` holding the same fields.
+        """
+
+        record = cls(packet)
+        if isinstance(packet.get("tcp_info"), dict):
+            record["tcp_info"] = TCPInfo(packet["tcp_info"])
+
+        return record
@@ -1,7 +1,13 @@
+from . import constants
+
 import os
 import socket
 import ipaddress
 from json import load
+from collections import Counter
+from functools import lru_cache
+from math import log
+from hashlib import blake2b
 
 from dpkt import tcp
 
@@ -79,6 +85,43 @@ def parse_ip(ip_bytes):
         return None
 
 
+@lru_cache(maxsize=65536)
+def address_to_int(ip_str):
+    """
+    Convert an IPv4/IPv6 address in string format into its version and integer
+    value, the compact form used to match and store addresses. Results are
+    cached, as the same addresses recur across the packets of a trace.
+
+    :param str ip_str: IP address in string format.
+    :returns: a tuple of `(version, integer)`, where version is 4 or 6, or None
+        if input invalid.
+    """
+
+    try:
+        address = ipaddress.ip_address(ip_str)
+    except ValueError:
+        return None
+
+    return address.version, int(address)
+
+
+@lru_cache(maxsize=65536)
+def int_to_address(version, ip_int):
+    """
+    Convert an IPv4/IPv6 address in its compact form back into string format,
+    reversing :func:`address_to_int`.
+
+    :param int version: 4 for IPv4, 6 for IPv6.
+    :param int ip_int: integer value of the address.
+    :returns: IP address in string format.
+    """
+
+    if version == 4:
+        return str(ipaddress.IPv4Address(ip_int))
+    else:
+        return str(ipaddress.IPv6Address(ip_int))
+
+
 def build_subnet(subnet_str):
     """
     Convert an IPv4/IPv6 subnet in string format (e.g. 192.168.1.0/24) into an
@@ -100,6 +143,229 @@ def build_subnet(subnet_str):
     return network
 
 
+class SubnetMatcher:
+    """
+    A matcher of raw IPv4/IPv6 addresses against subnets compiled once, testing
+    each address by masking its integer value rather than building an
+    :mod:`ipaddress` subnet for every address.
+    """
+
+    def __init__(self, subnets):
+        """
+        :param list subnets: :class:`ipaddress.IPv4Network` or
+            :class:`ipaddress.IPv6Network` objects to match against.
+        """
+
+        # Network addresses grouped by address length in bytes, then by netmask.
+        self._networks = {4: {}, 16: {}}
+        for subnet in subnets:
+            masks = self._networks[4 if subnet.version == 4 else 16]
+            masks.setdefault(int(subnet.netmask), set()).add(int(subnet.network_address))
+        self._networks = {k: list(v.items()) for k, v in self._networks.items()}
+
+
+    def match(self, ip_bytes):
+        """
+        Check whether an address falls within any of the subnets.
+
+        :param bytes ip_bytes: bytes of an IPv4/IPv6 address.
+        :returns: True if the address is in one of the subnets, False otherwise.
+        """
+
+        address = int.from_bytes(ip_bytes, 'big')
+        for mask, networks in self._networks.get(len(ip_bytes), ()):
+            if address & mask in networks:
+                return True
+
+        return False
+
+
+    def match_address(self, ip_str):
+        """
+        Check whether an address in string format falls within any of the
+        subnets, through its cached compact form from :func:`address_to_int`.
+
+        :param str ip_str: IPv4/IPv6 address in string format.
+        :returns: True if the address is in one of the subnets, False otherwise
+            or if input invalid.
+        """
+
+        address = address_to_int(ip_str)
+        if address is None:
+            return False
+
+        for mask, networks in self._networks[4 if address[0] == 4 else 16]:
+            if address[1] & mask in networks:
+                return True
+
+        return False
+
+
+def normalise_filters(input_filters):
+    """
+    Normalise input filters into a consistent form for comparing imports, with
+    single addresses expanded into lowest-level subnets and filters sorted.
+
+    :param list input_filters: list of tuples (filter subnet in string or
+        :mod:`ipaddress` network format, direction).
+    :returns: a sorted list of [subnet string, direction] pairs.
+    """
+
+    normalised = []
+    for input_filter in input_filters:
+        subnet = build_subnet(str(input_filter[0]))
+        if subnet:
+            normalised.append([str(subnet), int(input_filter[1])])
+
+    return sorted(normalised)
+
+
+def covers_profile(stored_profile, required_profile):
+    """
+    Check whether packets imported under an ingest profile hold all fields
+    stored under another, see :meth:`~CovertMark.data.parser.PCAPParser.set_ingest_profile`.
+
+    :param str stored_profile: the profile of an import, None for imports
+        made before profiles were recorded, which stored all fields.
+    :param str required_profile: the profile required.
+    :returns: True if the stored profile covers the required profile.
+    """
+
+    if stored_profile is None:
+        stored_profile = "full"
+
+    return constants.INGEST_PROFILES.index(stored_profile) >= \
+     constants.INGEST_PROFILES.index(required_profile)
+
+
+def covers_payload_bytes(stored_bytes, required_bytes):
+    """
+    Check whether TCP payloads stored up to a number of bytes hold those stored
+    up to another, see :meth:`~CovertMark.data.parser.PCAPParser.set_max_payload_bytes`.
+
+    :param int stored_bytes: the maximum payload bytes of an import, None if
+        payloads were stored in full.
+    :param int required_bytes: the maximum payload bytes required, None if
+        full payloads are required.
+    :returns: True if the stored payloads cover the required payloads.
+    """
+
+    if stored_bytes is None:
+        return True
+    if required_bytes is None:
+        return False
+
+    return stored_bytes >= required_bytes
+
+
+def hash_file(file_path, block_size=1048576):
+    """
+    Compute a content hash of the file at file_path, reading it in blocks so
+    that large pcap files are not loaded into memory. Hashes are cached by the
+    size and modification time of the file, so that a pcap hashed at import
+    is not read again when checked later unless it has been modified.
+
+    :param str file_path: full path to the file hashed.
+    :param int block_size: bytes read per block, 1MB by default.
+    :returns: the hexadecimal BLAKE2b digest of the file content.
+    """
+
+    stat = os.stat(file_path)
+    return _hash_file(os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, block_size)
+
+
+@lru_cache(maxsize=64)
+def _hash_file(file_path, size, mtime_ns, block_size):
+    """
+    Compute the content hash of a file of the given size and modification time,
+    see :func:`hash_file`.
+    """
+
+    digest = blake2b()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def byte_entropy(input_bytes):
+    """
+    Calculate the shannon entropy of the input bytes, giving the same result as
+    :meth:`~CovertMark.analytics.entropy.EntropyAnalyser.byte_entropy` at a
+    lower cost, for recording at ingest.
+
+    :param bytes input_bytes: input in bytes.
+    :returns: the base 2 shannon entropy of input_bytes, 0 if empty.
+    """
+
+    total = len(input_bytes)
+    if total == 0:
+        return 0
+
+    entropy = 0
+    for occurrences in Counter(input_bytes).values():
+        p = float(occurrences) / total
+        entropy -= p * log(p, 2)
+
+    return entropy
+
+
+class HyperLogLog:
+    """
+    A HyperLogLog cardinality estimator, counting distinct values in bounded
+    memory with a relative standard error of about 1.04 / sqrt(2 ** precision).
+    """
+
+    def __init__(self, precision=14):
+        if not isinstance(precision, int) or not 4 <= precision <= 18:
+            raise ValueError("Precision must be an integer between 4 and 18.")
+
+        self._precision = precision
+        self._m = 1 << precision
+        self._registers = bytearray(self._m)
+
+
+    def add(self, value):
+        """
+        Add a value to the estimator.
+
+        :param value: a value, hashed by its string representation.
+        """
+
+        h = int.from_bytes(blake2b(str(value).encode(), digest_size=8).digest(), "big")
+        index = h >> (64 - self._precision)
+        remainder = h & ((1 << (64 - self._precision)) - 1)
+        rank = (64 - self._precision) - remainder.bit_length() + 1
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+
+
+    def count(self):
+        """
+        Estimate the number of distinct values added.
+
+        :returns: the estimated number of distinct values as an integer.
+        """
+
+        m = self._m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum([2.0 ** -r for r in self._registers])
+
+        # Linear counting for small cardinalities.
+        zeros = self._registers.count(0)
+        if estimate <= 2.5 * m and zeros > 0:
+            estimate = m * log(float(m) / zeros)
+
+        return int(round(estimate))
+
+
+# Bits of TCP flags by name, based on dpkt manual by Jeff Silverman.
+TCP_FLAG_BITS = {"FIN": tcp.TH_FIN, "SYN": tcp.TH_SYN, "RST": tcp.TH_RST,
+                 "PSH": tcp.TH_PUSH, "ACK": tcp.TH_ACK, "URG": tcp.TH_URG,
+                 "ECE": tcp.TH_ECE, "CWR": tcp.TH_CWR}
+
+
 def parse_tcp_flags(flag_bits):
     """
     Parse flags of a TCP packet.
@@ -109,16 +375,65 @@ def parse_tcp_flags(flag_bits):
     :returns: a dict of TCP flags and their values.
     """
 
-    flags = {}
+    return {flag: (flag_bits & bit) != 0 for flag, bit in TCP_FLAG_BITS.items()}
+
+
+def build_tcp_flags(flags):
+    """
+    Build the flag bits of a TCP packet, reversing :func:`parse_tcp_flags`.
+    Flags already stored as an integer bitmask are returned as they are.
+
+    :param flags: a dict of TCP flags and their values, or an integer bitmask.
+    :returns: an integer of TCP flag bits.
+    """
+
+    if isinstance(flags, int):
+        return int(flags)
+
+    return sum([TCP_FLAG_BITS[flag] for flag, value in flags.items() if value])
+
+
+class TCPFlags(int):
+    """
+    TCP flags stored as an integer bitmask, which can also be read as the dict
+    of flags produced by :func:`parse_tcp_flags`, e.g. `flags['ACK']`. Flags
+    are decoded only when read by name.
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, flag):
+        return (self & TCP_FLAG_BITS[flag]) != 0
+
+
+    def __contains__(self, flag):
+        return flag in TCP_FLAG_BITS
+
+
+    def __iter__(self):
+        return iter(TCP_FLAG_BITS)
+
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            return parse_tcp_flags(self) == other
+        return int.__eq__(self, other)
+
+
+    __hash__ = int.__hash__
+
+
+    def get(self, flag, default=None):
+        return self[flag] if flag in TCP_FLAG_BITS else default
+
+
+    def keys(self):
+        return TCP_FLAG_BITS.keys()
+
+
+    def items(self):
+        return parse_tcp_flags(self).items()
 
-    # Based on dpkt manual by Jeff Silverman.
-    flags["FIN"] = (flag_bits & tcp.TH_FIN) != 0
-    flags["SYN"] = (flag_bits & tcp.TH_SYN) != 0
-    flags["RST"] = (flag_bits & tcp.TH_RST) != 0
-    flags["PSH"] = (flag_bits & tcp.TH_PUSH) != 0
-    flags["ACK"] = (flag_bits & tcp.TH_ACK) != 0
-    flags["URG"] = (flag_bits & tcp.TH_URG) != 0
-    flags["ECE"] = (flag_bits & tcp.TH_ECE) != 0
-    flags["CWR"] = (flag_bits & tcp.TH_CWR) != 0
 
-    return flags
+    def values(self):
+        return parse_tcp_flags(self).values()
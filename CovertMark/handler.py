@@ -27,7 +27,7 @@ class CommandHandler:
     def __init__(self, strategy_map):
 
         # Access facilities.
-        self.__db = data.mongo.MongoDBManager()
+        self.__db = data.backend.get_backend()
         self.__reader = data.retrieve.Retriever()
         self._strategy_map = strategy_map
         self._collections = self.__reader.list()
@@ -414,7 +414,8 @@ class CommandHandler:
             print("There is no valid procedure loaded, enter `new` to create a new procedure.")
             return
 
-        results, new_procedure = utils.execute_procedure(self._current_procedure, self._strategy_map, db_sub=True)
+        results, new_procedure = utils.execute_procedure(self._current_procedure,
+         self._strategy_map, db_sub=True, workers=c.PROCEDURE_WORKERS)
         print("Execution of the current procedure is complete.")
         if len(results) > 0:
             # Check if there were any non-collection inputs.
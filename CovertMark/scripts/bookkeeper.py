@@ -1,10 +1,15 @@
-from ..data import retrieve
+from ..data import retrieve, backend
 
-# Delete dormant entries in MongoDB and list the current stored traces.
+# Delete dormant entries in the trace storage, index traces imported without indexes,
+# and list the current stored traces.
 
 retriever = retrieve.Retriever()
+db = backend.get_backend()
 collections = retriever.list()
 for collection in collections:
     retriever.select(collection['name'])
+    if "index_time" not in collection:
+        index_time = db.index_collection(collection['name'])
+        print("Indexed {} in {:0.3f}s.".format(collection['name'], index_time))
 
 print(retriever.list(True))
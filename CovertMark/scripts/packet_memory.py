@@ -0,0 +1,88 @@
+# Measure the memory held per packet when a stored trace is loaded as dicts and
+# as compact packet records.
+# python -m CovertMark.scripts.packet_memory collection_name [--limit=N]
+# Payload bytes are reported separately, so that the per-packet overhead of each
+# representation can be compared on its own.
+from timeit import default_timer
+import tracemalloc
+import gc
+import sys
+
+from ..data import retrieve
+
+
+def payload_bytes(packets):
+    """
+    Count the bytes of TCP payloads held by packets as bytes objects, rather
+    than viewed in a memory-mapped payload arena outside the Python heap.
+
+    :param list packets: packets as retrieved.
+    :returns: the total length of payloads held.
+    """
+
+    total = 0
+    for packet in packets:
+        tcp_info = packet.get("tcp_info")
+        if tcp_info is not None and isinstance(tcp_info.get("payload"), bytes):
+            total += len(tcp_info["payload"])
+
+    return total
+
+
+def measure(retriever, limit, records):
+    """
+    Retrieve packets of the selected trace and measure the memory they hold.
+
+    :returns: a tuple of the number of packets, bytes held after retrieval,
+        payload bytes, and seconds taken.
+    """
+
+    gc.collect()
+    tracemalloc.start()
+    time_start = default_timer()
+    packets = retriever.retrieve(limit=limit, records=records)
+    elapsed = default_timer() - time_start
+    gc.collect()
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    count = len(packets)
+    payloads = payload_bytes(packets)
+    del packets
+
+    return count, held, payloads, elapsed
+
+
+def main(argvs):
+
+    limit = 0
+    for arg in argvs[2:]:
+        if arg.startswith("--limit="):
+            limit = int(arg.split("=", 1)[1]) if arg.split("=", 1)[1].isdigit() else -1
+
+    if len(argvs) < 2 or limit < 0:
+        print("Usage: python -m CovertMark.scripts.packet_memory collection_name [--limit=N]")
+        sys.exit(1)
+
+    retriever = retrieve.Retriever()
+    if not retriever.select(argvs[1]):
+        print("Error: collection does not exist.")
+        sys.exit(1)
+
+    results = {}
+    for name, records in [("dicts", False), ("records", True)]:
+        count, held, payloads, elapsed = measure(retriever, limit, records)
+        if count == 0:
+            print("Error: no packets retrieved from the collection.")
+            sys.exit(1)
+        results[name] = (held - payloads) / count
+        print("{:>8}: {} packets, {:.1f} MB held, {:.1f} MB of payloads, {:.0f} bytes overhead per packet, retrieved in {:.2f}s.".format(
+         name, count, held / 1048576, payloads / 1048576, results[name], elapsed))
+
+    print("Per-packet overhead reduced by {:.0f} bytes ({:.1f}%) with records.".format(
+     results["dicts"] - results["records"],
+     (results["dicts"] - results["records"]) / results["dicts"] * 100))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
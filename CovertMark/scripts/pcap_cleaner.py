@@ -1,67 +1,164 @@
 # Filter the input packet to preserve traffic between certain IP addresses or subnets only.
-# python -m CovertMark.scripts.pcap_cleaner pcap_in.pcap pcap_out.pcap {IPs separated by space}
-import dpkt
+# python -m CovertMark.scripts.pcap_cleaner pcap_in.pcap pcap_out.pcap {IPs separated by space} [--workers=N]
+# Matching packets are streamed to the output PCAP, optionally cleaning shards of the
+# input in N parallel processes.
+from concurrent.futures import ProcessPoolExecutor
+from timeit import default_timer
+import struct
 import sys, os
 
-from ..data import utils
+from ..data import utils, reader
 
-argvs = sys.argv
+ETH_TYPE_IP = 0x0800
+ETH_TYPE_IP6 = 0x86dd
+ETH_TYPE_VLAN = (0x8100, 0x88a8) # 802.1Q and 802.1ad tags.
 
-if len(argvs) < 4:
-    print("Usage: python -m CovertMark.scripts.pcap_cleaner pcap_in.pcap pcap_out.pcap {IPs separated by ','}")
-    sys.exit(1)
+PCAP_HEADER = struct.Struct("<IHHiIII")
+PCAP_RECORD = struct.Struct("<IIII")
+PCAP_SNAPLEN = 262144
 
-if not utils.check_file_exists(os.path.abspath(argvs[1])):
-    print("Error: input PCAP does not exist.")
-    sys.exit(1)
 
-if not utils.get_full_path(os.path.abspath(argvs[2])):
-    print("Error: path for output PCAP is not valid.")
-    sys.exit(1)
+def get_addresses(buf):
+    """
+    Locate the source and destination addresses of an IP packet in an Ethernet
+    frame without decoding the rest of the frame.
 
-if utils.check_file_exists(os.path.abspath(argvs[2])):
-    print("Error: output PCAP already exists.")
-    sys.exit(1)
+    :param buf: bytes-like Ethernet frame.
+    :returns: a tuple of source and destination address bytes, None if not an
+        IP/IPv6 packet.
+    """
 
-filter_nets = [utils.build_subnet(i) for i in argvs[3:]]
-if not all(filter_nets):
-    print("Error: some IP addresses or subnets supplied are not valid.")
-    sys.exit(1)
+    offset = 12
+    eth_type = buf[offset] << 8 | buf[offset + 1]
+    while eth_type in ETH_TYPE_VLAN:
+        offset += 4
+        eth_type = buf[offset] << 8 | buf[offset + 1]
 
-packets_to_write = []
-read = 0
-accepted = 0
-try:
-    with open(argvs[1], 'rb') as f:
-        for ts, buf in dpkt.pcap.Reader(f):
+    ip = offset + 2
+    if eth_type == ETH_TYPE_IP:
+        return buf[ip+12:ip+16], buf[ip+16:ip+20]
+    elif eth_type == ETH_TYPE_IP6:
+        return buf[ip+8:ip+24], buf[ip+24:ip+40]
+    else:
+        return None
+
+
+def clean_shard(pcap_in, shard_out, subnets, start, stop, ts_units):
+    """
+    Write records of the input PCAP between two byte offsets to a file if both
+    their source and destination are in the subnets.
+
+    :returns: a tuple of the numbers of packets read, packets written and bytes
+        read.
+    """
+
+    matcher = utils.SubnetMatcher([utils.build_subnet(i) for i in subnets])
+    ns_per_unit = 10 ** 9 // ts_units
+    read = 0
+    accepted = 0
+    read_bytes = 0
+    with reader.PCAPReader(pcap_in) as pcap, open(shard_out, 'ab') as f:
+        for ts_ns, buf, wirelen in pcap.records(start, stop):
             read += 1
+            read_bytes += len(buf)
             try:
-                eth = dpkt.ethernet.Ethernet(buf)
-                ip = eth.data
-                dst = utils.parse_ip(ip.dst)
-                src = utils.parse_ip(ip.src)
-                dst_match = any([n.overlaps(utils.build_subnet(dst)) for n in filter_nets])
-                src_match = any([n.overlaps(utils.build_subnet(src)) for n in filter_nets])
-                if dst_match and src_match: # Only packets from *and* to interested parties.
-                    packets_to_write.append((buf, ts))
-                    accepted += 1
-            except: # If not Ethernet packet or other read issues.
+                addresses = get_addresses(buf)
+            except IndexError: # Truncated frame.
+                continue
+            if addresses is None:
                 continue
-except:
-    print("Error: invalid data or format in input PCAP.")
-    sys.exit(1)
-
-print("Read {} packets from {}.".format(read, argvs[1]))
-print("Writing {} matching packets to {}.".format(accepted, argvs[2]))
-
-try:
-    with open(argvs[2], 'wb') as f:
-        output_writer = dpkt.pcap.Writer(f)
-        for buf, ts in packets_to_write:
-            output_writer.writepkt(buf, ts=ts)
-        output_writer.close()
-except:
-    print("Error: an error has been encountered when writing to the output PCAP.")
-    sys.exit(1)
-
-print("Successfully written to {}.".format(argvs[2]))
+            if matcher.match(addresses[0]) and matcher.match(addresses[1]): # Only packets from *and* to interested parties.
+                f.write(PCAP_RECORD.pack(ts_ns // 10 ** 9, ts_ns % 10 ** 9 // ns_per_unit,
+                 len(buf), wirelen))
+                f.write(buf)
+                accepted += 1
+
+    return read, accepted, read_bytes
+
+
+def main(argvs):
+
+    workers = 1
+    for arg in argvs[3:]:
+        if arg.startswith("--workers="):
+            workers = int(arg.split("=", 1)[1]) if arg.split("=", 1)[1].isdigit() else 0
+            argvs.remove(arg)
+            break
+
+    if len(argvs) < 4 or workers < 1:
+        print("Usage: python -m CovertMark.scripts.pcap_cleaner pcap_in.pcap pcap_out.pcap {IPs separated by ','} [--workers=N]")
+        sys.exit(1)
+
+    if not utils.check_file_exists(os.path.abspath(argvs[1])):
+        print("Error: input PCAP does not exist.")
+        sys.exit(1)
+
+    if not utils.get_full_path(os.path.abspath(argvs[2])):
+        print("Error: path for output PCAP is not valid.")
+        sys.exit(1)
+
+    if utils.check_file_exists(os.path.abspath(argvs[2])):
+        print("Error: output PCAP already exists.")
+        sys.exit(1)
+
+    filter_nets = [utils.build_subnet(i) for i in argvs[3:]]
+    if not all(filter_nets):
+        print("Error: some IP addresses or subnets supplied are not valid.")
+        sys.exit(1)
+
+    time_start = default_timer()
+    try:
+        with reader.PCAPReader(argvs[1]) as pcap:
+            linktype = pcap.datalink()
+            ts_units = 10 ** 9 if pcap.ts_resolution() > 10 ** 6 else 10 ** 6
+            shards = pcap.shards(workers) if workers > 1 else [(None, None)]
+    except ValueError:
+        print("Error: invalid data or format in input PCAP.")
+        sys.exit(1)
+
+    magic = 0xa1b23c4d if ts_units == 10 ** 9 else 0xa1b2c3d4
+    shard_outs = [argvs[2]] if len(shards) == 1 else \
+     ["{}.shard{}".format(argvs[2], i) for i in range(len(shards))]
+
+    try:
+        with open(argvs[2], 'wb') as f:
+            f.write(PCAP_HEADER.pack(magic, 2, 4, 0, 0, PCAP_SNAPLEN,
+             linktype if linktype is not None else 1))
+
+        if len(shards) == 1:
+            results = [clean_shard(argvs[1], argvs[2], argvs[3:], shards[0][0], shards[0][1], ts_units)]
+        else:
+            with ProcessPoolExecutor(max_workers=len(shards)) as executor:
+                results = list(executor.map(clean_shard, [argvs[1]] * len(shards),
+                 shard_outs, [argvs[3:]] * len(shards), [i[0] for i in shards],
+                 [i[1] for i in shards], [ts_units] * len(shards)))
+            with open(argvs[2], 'ab') as f:
+                for shard_out in shard_outs:
+                    with open(shard_out, 'rb') as shard:
+                        while True:
+                            block = shard.read(1048576)
+                            if not block:
+                                break
+                            f.write(block)
+                    os.remove(shard_out)
+    except OSError:
+        print("Error: an error has been encountered when writing to the output PCAP.")
+        sys.exit(1)
+    finally:
+        for shard_out in shard_outs:
+            if shard_out != argvs[2] and os.path.isfile(shard_out):
+                os.remove(shard_out)
+
+    elapsed = default_timer() - time_start
+    read = sum(i[0] for i in results)
+    accepted = sum(i[1] for i in results)
+    read_mb = sum(i[2] for i in results) / 1048576
+    print("Read {} packets from {}.".format(read, argvs[1]))
+    print("Written {} matching packets to {}.".format(accepted, argvs[2]))
+    print("Cleaned {:.1f} MB in {:.2f}s with {} worker(s): {:.0f} packets/s, {:.1f} MB/s.".format(
+     read_mb, elapsed, len(shards), read / elapsed if elapsed > 0 else 0,
+     read_mb / elapsed if elapsed > 0 else 0))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,5 +1,6 @@
 # Plot TCP payload distribution of packets in a stored collection.
 from ..data import retrieve, utils, plot
+from ..data import constants as data_constants
 from ..analytics import constants
 
 from sys import exit
@@ -26,28 +27,21 @@ else:
     print("Not excluding them.")
     mtu_avoidance = False
 
-print("Reading packets from selected collection...")
-packets = retriever.retrieve()
-lengths = []
-total = 0
-total_plotted = 0
-for packet in packets:
-    total += 1
-
-    if packet["tcp_info"] is None:
-        continue
+print("Counting payload lengths in selected collection...")
+# Payloads may be truncated or not stored, so their recorded lengths are counted.
+length_filter = data_constants.TCP_PAYLOAD_FILTER
+if tls_mode == "only":
+    length_filter = {"$and": [length_filter, {"tls_info": {"$ne": None}}]}
+histogram = retriever.payload_length_histogram(length_filter)
+total = retriever.count()
 
-    if len(packet["tcp_info"]["payload"]) <= 0:
-        continue
-    
-    if tls_mode == "only" and packet["tls_info"] is None:
-        continue
-
-    if mtu_avoidance and len(packet["tcp_info"]["payload"]) > constants.MTU_FRAME_AVOIDANCE_THRESHOLD:
+lengths = []
+for length, count in sorted(histogram.items()):
+    if mtu_avoidance and length > constants.MTU_FRAME_AVOIDANCE_THRESHOLD:
         continue
 
-    lengths.append(len(packet["tcp_info"]["payload"]))
-    total_plotted += 1
+    lengths += [length] * count
+total_plotted = len(lengths)
 
 print("Processed {} qualifying packets out of {} stored.".format(total_plotted, total))
 
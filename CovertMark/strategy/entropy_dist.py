@@ -19,6 +19,9 @@ class EntropyStrategy(DetectionStrategy):
     DESCRIPTION = "Detecting high-entropy PTs based on payload byte-uniformity and entropy-distribution."
     _DEBUG_PREFIX = "Entropy"
     RUN_CONFIG_DESCRIPTION = ["Block Size", "Test Size", "Criterion"]
+    PAYLOAD_VIEWS = True
+    PACKET_RECORDS = True
+    INGEST_PROFILE = "payload-prefix" # Payloads are tested up to the MTU threshold.
 
     # Three criteria possible: [conservative, majority voting, and sensitive].
     # Corresponding to [all, majority, any] when deciding whether to flag
@@ -44,6 +47,7 @@ class EntropyStrategy(DetectionStrategy):
         self._strategic_states['TPR'] = {}
         self._strategic_states['FPR'] = {}
         self._strategic_states['blocked_ips'] = {}
+        self._strategic_states['blocked_packets'] = {}
 
         # Record disregards.
         self._disregard_tls = False
@@ -53,6 +57,7 @@ class EntropyStrategy(DetectionStrategy):
         self._agreements_cache_positive = {}
         self._agreements_cache_negative = {}
         self._blocked_cache_negative = {}
+        self._offsets_cache_negative = {}
         self._execution_time_cache = {}
 
 
@@ -66,8 +71,17 @@ class EntropyStrategy(DetectionStrategy):
         # and TLS packets are done by run when observing retrieved packet
         # patterns.
 
-        self._strategic_packet_filter = {"tcp_info": {"$ne": None},
-         "tcp_info.payload": {"$ne": b''}}
+        self._strategic_packet_filter = data.constants.TCP_PAYLOAD_FILTER
+
+
+    def set_strategic_projection(self):
+        """
+        Only payloads and the presence of TLS and HTTP are examined, so TLS
+        record data, HTTP headers and TCP options are not loaded.
+        """
+
+        self._strategic_packet_projection = {"tls_info.data": False,
+         "http_info.headers": False, "tcp_info.opts": False}
 
 
     def interpret_config(self, config_set):
@@ -136,8 +150,9 @@ class EntropyStrategy(DetectionStrategy):
             examined_packets = 0
             for t in self._pt_packets:
                 payload = t['tcp_info']['payload']
+                payload_len = t['tcp_info'].get('payload_len', len(payload)) # True length if truncated.
 
-                if len(payload) >= max(self._protocol_min_length, block_size, test_size):
+                if payload_len >= self._protocol_min_length and len(payload) >= max(block_size, test_size):
                     examined_packets += 1
                     p1 = self._analyser.kolmogorov_smirnov_uniform_test(payload[:mtu_threshold])
                     p2 = self._analyser.kolmogorov_smirnov_dist_test(payload[:mtu_threshold], block_size)
@@ -183,29 +198,36 @@ class EntropyStrategy(DetectionStrategy):
         if subconfig in self._agreements_cache_negative:
             agreements = self._agreements_cache_negative[subconfig]
             blocked_ips = self._blocked_cache_negative[subconfig]
+            offsets = self._offsets_cache_negative[subconfig]
             # Overwrite positive execution time with that of the positive run originally calculating.
             self.register_performance_stats(config, time=self._execution_time_cache[subconfig])
         else:
             agreements = []
             blocked_ips = set([])
+            offsets = [] # Of packets tested, in the order of agreements.
             for t in self._neg_packets:
                 payload = t['tcp_info']['payload']
+                payload_len = t['tcp_info'].get('payload_len', len(payload)) # True length if truncated.
 
-                if len(payload) >= max(self._protocol_min_length, block_size, test_size):
+                if payload_len >= self._protocol_min_length and len(payload) >= max(block_size, test_size):
                     p1 = self._analyser.kolmogorov_smirnov_uniform_test(payload[:mtu_threshold])
                     p2 = self._analyser.kolmogorov_smirnov_dist_test(payload[:mtu_threshold], block_size)
                     p3 = self._analyser.anderson_darling_dist_test(payload[:mtu_threshold], block_size)
                     agreement = len(list(filter(lambda x: x >= self.P_THRESHOLD, [p1, p2, p3['min_threshold']])))
                     agreements.append(agreement)
+                    offsets.append(t.get('pcap_offset'))
 
                     if agreement >= criterion:
                         blocked_ips.add(t['dst'])
             
             self._agreements_cache_negative[subconfig] = agreements
             self._blocked_cache_negative[subconfig] = blocked_ips
+            self._offsets_cache_negative[subconfig] = offsets
             self._execution_time_cache[subconfig] = self._time_statistics[config]['time']
 
         self._negative_blocked_ips = blocked_ips
+        self._negative_blocked_packets = set([offset for offset, agreement in zip(offsets, agreements) \
+         if agreement >= criterion and offset is not None])
 
         # Calculate the number of positive identifications under the criterion.
         identified = sum([1 if i >= criterion else 0 for i in agreements])
@@ -215,6 +237,7 @@ class EntropyStrategy(DetectionStrategy):
         # Store all results in the state space.
         self._strategic_states['FPR'][config] = float(identified) / self._neg_collection_total
         self._strategic_states['blocked_ips'][config] = blocked_ips
+        self._strategic_states['blocked_packets'][config] = self._negative_blocked_packets
         self._false_positive_blocked_rate = float(len(blocked_ips)) / self._negative_unique_ips
 
         # Register the results.
@@ -273,14 +296,15 @@ class EntropyStrategy(DetectionStrategy):
         else:
             self._protocol_min_length = protocol_min_length
 
-        # Check whether we should include or disregard TLS or HTTP packets.
-        pt_tls_count = 0
-        pt_http_count = 0
-        for packet in self._pt_packets:
-            if packet["tls_info"] is not None:
-                pt_tls_count += 1
-            elif packet["http_info"] is not None:
-                pt_http_count += 1
+        if len(self._pt_packets) == 0:
+            self.debug_print("No positive TCP payloads loaded, giving up.")
+            return (None, None)
+
+        # Check whether we should include or disregard TLS or HTTP packets,
+        # with presence counted by MongoDB.
+        presence = self._count_presence(self._pt_collection, self._pt_packets)
+        pt_tls_count = presence["tls"]
+        pt_http_count = presence["non_tls_http"]
 
         if float(pt_tls_count) / len(self._pt_packets) >= self.TLS_HTTP_INCLUSION_THRESHOLD:
             self.debug_print("Considering TLS packets based on PT trace observations only.")
@@ -344,6 +368,7 @@ class EntropyStrategy(DetectionStrategy):
         self.debug_print("True positive rate: {}; False positive rate: {}".format(self._true_positive_rate, self._false_positive_rate))
 
         self._negative_blocked_ips = self._strategic_states['blocked_ips'][best_config]
+        self._negative_blocked_packets = self._strategic_states['blocked_packets'][best_config]
         self._false_positive_blocked_rate = float(len(self._negative_blocked_ips)) / self._negative_unique_ips
         self.debug_print("This classification configuration blocked {:0.2f}% of IPs seen.".format(self._false_positive_blocked_rate*100))
 
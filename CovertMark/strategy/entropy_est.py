@@ -20,6 +20,9 @@ class EntropyEstimationStrategy(DetectionStrategy):
     DESCRIPTION = "Detecting high-entropy PTs based on sliding window entropy estimation."
     _DEBUG_PREFIX = "EntropyEst"
     RUN_CONFIG_DESCRIPTION = ["Window Size", "Test Size", "Percentile Threshold"]
+    PAYLOAD_VIEWS = True
+    PACKET_RECORDS = True
+    INGEST_PROFILE = "payload-prefix" # Payloads are tested up to the MTU threshold.
     
     MIN_TEST_SIZES = [1024, 512, 256, 128]
     WINDOW_SIZE = 64 # Default.
@@ -37,6 +40,7 @@ class EntropyEstimationStrategy(DetectionStrategy):
         self._strategic_states['TPR'] = {}
         self._strategic_states['FPR'] = {}
         self._strategic_states['blocked_ips'] = {}
+        self._strategic_states['blocked_packets'] = {}
         self._strategic_states['cut_off'] = {}
 
         # Record disregards.
@@ -54,8 +58,17 @@ class EntropyEstimationStrategy(DetectionStrategy):
         # and TLS packets are done by run when observing retrieved packet
         # patterns.
 
-        self._strategic_packet_filter = {"tcp_info": {"$ne": None},
-         "tcp_info.payload": {"$ne": b''}}
+        self._strategic_packet_filter = data.constants.TCP_PAYLOAD_FILTER
+
+
+    def set_strategic_projection(self):
+        """
+        Only payloads and the presence of TLS and HTTP are examined, so TLS
+        record data, HTTP headers and TCP options are not loaded.
+        """
+
+        self._strategic_packet_projection = {"tls_info.data": False,
+         "http_info.headers": False, "tcp_info.opts": False}
 
 
     def interpret_config(self, config_set):
@@ -148,6 +161,7 @@ class EntropyEstimationStrategy(DetectionStrategy):
 
         false_positives = 0
         blocked_ips = set([])
+        blocked_packets = set([])
         for t in self._neg_packets:
             payload = t['tcp_info']['payload'][:mtu_threshold]
 
@@ -155,9 +169,12 @@ class EntropyEstimationStrategy(DetectionStrategy):
                 high_entropy_proportion = self._analyser.entropy_estimation(payload, window_size)
                 if high_entropy_proportion >= self._strategic_states['cut_off'][config]:
                     blocked_ips.add(t['dst'])
+                    if t.get('pcap_offset') is not None:
+                        blocked_packets.add(t['pcap_offset'])
                     false_positives += 1
 
         self._negative_blocked_ips = blocked_ips
+        self._negative_blocked_packets = blocked_packets
 
 
         # Unlike the positive case, we consider the false positive rate to be
@@ -165,6 +182,7 @@ class EntropyEstimationStrategy(DetectionStrategy):
         # Store all results in the state space.
         self._strategic_states['FPR'][config] = false_positives / self._neg_collection_total
         self._strategic_states['blocked_ips'][config] = blocked_ips
+        self._strategic_states['blocked_packets'][config] = blocked_packets
         self._false_positive_blocked_rate = float(len(blocked_ips)) / self._negative_unique_ips
 
         # Register the results.
@@ -223,14 +241,15 @@ class EntropyEstimationStrategy(DetectionStrategy):
         else:
             self._protocol_min_length = protocol_min_length
 
-        # Check whether we should include or disregard TLS or HTTP packets.
-        pt_tls_count = 0
-        pt_http_count = 0
-        for packet in self._pt_packets:
-            if packet["tls_info"] is not None:
-                pt_tls_count += 1
-            elif packet["http_info"] is not None:
-                pt_http_count += 1
+        if len(self._pt_packets) == 0:
+            self.debug_print("No positive TCP payloads loaded, giving up.")
+            return (None, None)
+
+        # Check whether we should include or disregard TLS or HTTP packets,
+        # with presence counted by MongoDB.
+        presence = self._count_presence(self._pt_collection, self._pt_packets)
+        pt_tls_count = presence["tls"]
+        pt_http_count = presence["non_tls_http"]
 
         if float(pt_tls_count) / len(self._pt_packets) >= self.TLS_HTTP_INCLUSION_THRESHOLD:
             self.debug_print("Considering TLS packets based on PT trace observations only.")
@@ -291,6 +310,7 @@ class EntropyEstimationStrategy(DetectionStrategy):
         self.debug_print("True positive rate: {}; False positive rate: {}".format(self._true_positive_rate, self._false_positive_rate))
 
         self._negative_blocked_ips = self._strategic_states['blocked_ips'][best_config]
+        self._negative_blocked_packets = self._strategic_states['blocked_packets'][best_config]
         self._false_positive_blocked_rate = float(len(self._negative_blocked_ips)) / self._negative_unique_ips
         self.debug_print("This classification configuration blocked {:0.2f}% of IPs seen.".format(self._false_positive_blocked_rate*100))
 
@@ -18,6 +18,8 @@ class LengthClusteringStrategy(DetectionStrategy):
     DESCRIPTION = "Detecting low-payload heartbeat messages."
     _DEBUG_PREFIX = "LenClustering"
     RUN_CONFIG_DESCRIPTION = ["MeanShift bandwidth", "Using top N clusters"]
+    INGEST_PROFILE = "lengths-only"
+    PACKET_RECORDS = True
 
     TLS_INCLUSION_THRESHOLD = 0.1
     MEANSHIFT_BWS = [1, 2, 3, 5, 10]
@@ -38,6 +40,10 @@ class LengthClusteringStrategy(DetectionStrategy):
         self._strategic_states['blocked'] = {}
         self._tls_mode = self.TLS_MODES[0]
         self._best_config = None # For wireshark reporting.
+        self._pt_histograms = None # Payload length histograms of positive packets.
+        self._neg_length_counts = None # Negative packet counts by payload length.
+        self._neg_length_dsts = None # Negative destination IPs by payload length.
+        self._tls_filter = {} # TLS mode filter applied to examined packets.
 
 
     def set_strategic_filter(self):
@@ -48,8 +54,35 @@ class LengthClusteringStrategy(DetectionStrategy):
         it is only necessary to filter out TCP packets with no payload.
         """
 
-        self._strategic_packet_filter = {"tcp_info": {"$ne": None},
-         "tcp_info.payload": {"$ne": b''}}
+        self._strategic_packet_filter = data.constants.TCP_PAYLOAD_FILTER
+
+
+    def set_strategic_projection(self):
+        """
+        Payload lengths are summarised by MongoDB, so payloads themselves are
+        never read. Only addresses, payload lengths and TLS presence are loaded.
+        """
+
+        self._strategic_packet_projection = {"time": True, "src": True, "dst": True,
+         "tcp_info.payload_len": True, "tls_info.type": True}
+
+
+    def _length_filter(self, tls_only=False):
+        """
+        Build the MongoDB query filter selecting the packets examined under the
+        current TLS mode, for summarising their payload lengths server-side.
+
+        :param bool tls_only: if True, additionally select TLS packets only.
+        :returns: a MongoDB query filter.
+        """
+
+        filters = [self._strategic_packet_filter]
+        if self._tls_filter:
+            filters.append(self._tls_filter)
+        if tls_only:
+            filters.append({"tls_info": {"$ne": None}})
+
+        return {"$and": filters}
 
 
     def interpret_config(self, config_set):
@@ -102,24 +135,34 @@ class LengthClusteringStrategy(DetectionStrategy):
         bandwidth = 1 if 'bandwidth' not in kwargs else kwargs['bandwidth']
         clusters = 1 if 'clusters' not in kwargs else kwargs['clusters']
 
-        if self._tls_mode == "only":
-            most_frequent = analytics.traffic.ordered_tcp_payload_length_frequency(self._pt_packets, True, bandwidth)
-        else:
-            most_frequent = analytics.traffic.ordered_tcp_payload_length_frequency(self._pt_packets, False, bandwidth)
+        # Length histograms are summarised by MongoDB once, so that each
+        # bandwidth swept only costs a histogram clustering.
+        if self._pt_histograms is None:
+            pt_reader = self._collection_reader(self._pt_collection)
+            examined_counts = pt_reader.payload_length_histogram(self._length_filter())
+            clustering_counts = pt_reader.payload_length_histogram(self._length_filter(self._tls_mode == "only"))
+            self._pt_histograms = {
+                "all": analytics.traffic.counts_to_histogram(examined_counts),
+                "clustering": analytics.traffic.counts_to_histogram(clustering_counts,
+                 analytics.constants.MTU_FRAME_AVOIDANCE_THRESHOLD_CLUSTERING)
+            }
 
-        top_clusters = most_frequent[0]
-        for i in range(1, clusters):
-            top_clusters = top_clusters.union(most_frequent[i])
+        most_frequent = analytics.traffic.cluster_length_histogram(self._pt_histograms["clustering"], bandwidth)
 
-        identified = 0
-        for packet in self._pt_packets:
-            if len(packet['tcp_info']['payload']) in top_clusters:
-                identified += 1
+        top_clusters = set([]).union(*most_frequent[:clusters])
+
+        all_lengths = self._pt_histograms["all"]
+        identified = int(sum([all_lengths[i] for i in top_clusters if i < len(all_lengths)]))
 
         # Pass the cluster to the negative run.
         self._strategic_states['top_clusters'][(bandwidth, clusters)] = top_clusters
 
-        self._strategic_states['TPR'][(bandwidth, clusters)] = identified / len(self._pt_packets)
+        if int(all_lengths.sum()) == 0:
+            self.debug_print("No positive TCP payloads to cluster, rejecting this configuration.")
+            self._strategic_states['TPR'][(bandwidth, clusters)] = 0
+            return 0
+
+        self._strategic_states['TPR'][(bandwidth, clusters)] = identified / int(all_lengths.sum())
         self.debug_print("TCP payload lengths in the {} cluster(s): {}.".format(clusters, ', '.join([str(i) for i in list(top_clusters)])))
         self.register_performance_stats((bandwidth, clusters),
          TPR=self._strategic_states['TPR'][(bandwidth, clusters)])
@@ -140,13 +183,18 @@ class LengthClusteringStrategy(DetectionStrategy):
         bandwidth = 1 if 'bandwidth' not in kwargs else kwargs['bandwidth']
         clusters = 1 if 'clusters' not in kwargs else kwargs['clusters']
 
+        # Negative packets are summarised by MongoDB only once, after which each
+        # configuration is evaluated from the per-length lookup tables.
+        if self._neg_length_counts is None:
+            neg_reader = self._collection_reader(self._neg_collection)
+            length_dsts = neg_reader.payload_length_destinations(self._length_filter())
+            self._neg_length_counts = {i: sum(dsts.values()) for i, dsts in length_dsts.items()}
+            self._neg_length_dsts = {i: set(dsts) for i, dsts in length_dsts.items()}
+
         top_cluster = self._strategic_states['top_clusters'][(bandwidth, clusters)]
-        falsely_identified = 0
-        self._strategic_states['blocked'][(bandwidth, clusters)] = set([])
-        for packet in self._neg_packets:
-            if len(packet['tcp_info']['payload']) in top_cluster:
-                falsely_identified += 1
-                self._strategic_states['blocked'][(bandwidth, clusters)].add(packet['dst'])
+        matched_lengths = [i for i in top_cluster if i in self._neg_length_counts]
+        falsely_identified = sum([self._neg_length_counts[i] for i in matched_lengths])
+        self._strategic_states['blocked'][(bandwidth, clusters)] = set([]).union(*[self._neg_length_dsts[i] for i in matched_lengths])
 
         # Unlike the positive case, we consider the false positive rate to be
         # over all packets, rather than just the ones were are interested in.
@@ -191,6 +239,19 @@ class LengthClusteringStrategy(DetectionStrategy):
         return wireshark_output
 
 
+    def blocked_packet_filter(self):
+        """
+        Negative packets are flagged by their payload lengths being in the best
+        configuration's top clusters, under the TLS mode.
+        """
+
+        if self._best_config is None:
+            return super().blocked_packet_filter()
+
+        top_clusters = sorted(self._strategic_states['top_clusters'][self._best_config])
+        return {"$and": [self._length_filter(), {"tcp_info.payload_len": {"$in": top_clusters}}]}
+
+
     def run_strategy(self, **kwargs):
         """
         PT clients and servers in the input PCAP should be specified via :const:`data.constants.IP_SRC`
@@ -209,13 +270,13 @@ class LengthClusteringStrategy(DetectionStrategy):
 
         if tls_mode == 'guess':
             self.debug_print("Studying PT packets to figure out about TLS packets")
-            tls_packets = 0
-            for t in self._pt_packets:
-                if 'tls_info' in t and t['tls_info'] is not None:
-                    tls_packets += 1
-            if float(tls_packets) / len(self._pt_packets) > 0.95:
+            presence = self._count_presence(self._pt_collection, self._pt_packets)
+            tls_packets = presence["tls"]
+            if presence["total"] == 0: # Nothing to study.
+                self._tls_mode = "all"
+            elif float(tls_packets) / presence["total"] > 0.95:
                 self._tls_mode = "only"
-            elif float(tls_packets) / len(self._pt_packets) < 0.05:
+            elif float(tls_packets) / presence["total"] < 0.05:
                 self._tls_mode = "none"
             else:
                 self._tls_mode = "all"
@@ -224,14 +285,20 @@ class LengthClusteringStrategy(DetectionStrategy):
 
         if tls_mode == 'only':
             self.debug_print("Strategy TLS mode: examining TLS packets only.")
-            self._pt_packets = [i for i in self._pt_packets if i["tls_info"] is not None]
-            self._neg_packets = [i for i in self._neg_packets if i["tls_info"] is not None]
+            self._pt_packets = [i for i in self._pt_packets if i.get("tls_info") is not None]
+            self._neg_packets = [i for i in self._neg_packets if i.get("tls_info") is not None]
+            self._tls_filter = {"tls_info": {"$ne": None}}
         elif tls_mode == 'none':
             self.debug_print("Strategy TLS mode: examining non-TLS packets only.")
-            self._pt_packets = [i for i in self._pt_packets if i["tls_info"] is None]
-            self._neg_packets = [i for i in self._neg_packets if i["tls_info"] is None]
+            self._pt_packets = [i for i in self._pt_packets if i.get("tls_info") is None]
+            self._neg_packets = [i for i in self._neg_packets if i.get("tls_info") is None]
+            self._tls_filter = {"tls_info": None}
         else:
             self.debug_print("Strategy TLS mode: examining all packets regardless of TLS status.")
+            self._tls_filter = {}
+        self._pt_histograms = None
+        self._neg_length_counts = None
+        self._neg_length_dsts = None
 
         self.debug_print("- Testing the following bandwidths for MeanShift: {}".format(', '.join([str(i) for i in self.MEANSHIFT_BWS])))
         for bw in self.MEANSHIFT_BWS:
@@ -24,6 +24,7 @@ class SGDStrategy(DetectionStrategy):
     DESCRIPTION = "Generic binary classification strategy."
     _DEBUG_PREFIX = "sgd"
     RUN_CONFIG_DESCRIPTION = ("Occurrence Threshold (%ile)", "Run #")
+    PACKET_RECORDS = True
 
     LOSS_FUNC = "hinge"
     TIME_SEGMENT_SIZE = 60
@@ -47,7 +48,17 @@ class SGDStrategy(DetectionStrategy):
         Only supports TCP-based PTs for now due to SEQ-related shaping.
         """
 
-        self._strategic_packet_filter = {"tcp_info": {"$ne": None}}
+        self._strategic_packet_filter = data.constants.TCP_FILTER
+
+
+    def set_strategic_projection(self):
+        """
+        Window statistics are based on TCP information alone, so TLS and HTTP
+        information and TCP options are not loaded.
+        """
+
+        self._strategic_packet_projection = {"tls_info": False, "http_info": False,
+         "tcp_info.opts": False}
 
 
     def interpret_config(self, config_set):
@@ -96,6 +107,7 @@ class SGDStrategy(DetectionStrategy):
         all_features = np.concatenate((self._strategic_states['positive_features'],
          self._strategic_states['negative_features']), axis=0)
         all_ips = self._strategic_states['positive_ips'] + self._strategic_states['negative_ips']
+        all_windows = [() for i in range(positive_len)] + self._strategic_states['negative_windows']
         all_labels = [1 for i in range(positive_len)] + [0 for i in range(negative_len)]
         self._strategic_states['negative_unique_ips'] = len(set(self._strategic_states['negative_ips']))
         for ip in all_ips:
@@ -104,14 +116,16 @@ class SGDStrategy(DetectionStrategy):
         # Rescale to zero centered uniform variance data.
         all_features = preprocessing.scale(all_features, axis=0, copy=False)
 
-        # Orde-preserving split of features, their labels, and their IPs.
+        # Orde-preserving split of features, their labels, their IPs, and the
+        # pcap offsets of negative packets in their windows.
         split = model_selection.train_test_split(all_features, all_labels, all_ips,
-         train_size=split_ratio, shuffle=True)
+         all_windows, train_size=split_ratio, shuffle=True)
 
         self._pt_test_labels = split[2]
         self._pt_validation_labels = split[3]
         self._pt_test_ips = split[4]
         self._pt_validation_ips = split[5]
+        self._pt_validation_windows = split[7]
 
         return (split[0], split[1])
 
@@ -143,6 +157,7 @@ class SGDStrategy(DetectionStrategy):
         true_negatives = 0
         false_negatives = 0
         self._strategic_states[run_num]["negative_blocked_ips"] = set([])
+        self._strategic_states[run_num]["negative_blocked_packets"] = set([])
         self._strategic_states[run_num]["ip_occurrences"] = defaultdict(int)
         for i in range(0, len(prediction)):
             target_ip_this_window = self._pt_validation_ips[i]
@@ -164,6 +179,7 @@ class SGDStrategy(DetectionStrategy):
                 else: # Actually non-PT traffic.
                     if decide_to_block: # We got it wrong.
                         self._strategic_states[run_num]["negative_blocked_ips"].add(self._pt_validation_ips[i])
+                        self._strategic_states[run_num]["negative_blocked_packets"].update(self._pt_validation_windows[i])
                         false_positives += 1
                     else: # It was right to be conservative about this IP.
                         true_negatives += 1
@@ -322,6 +338,7 @@ class SGDStrategy(DetectionStrategy):
         negative_features = []
         positive_ips = []
         negative_ips = []
+        negative_windows = []
 
         for time_window in time_windows_positive:
             packets_by_client = analytics.traffic.group_packets_by_ip_fixed_size(time_window, self._positive_subnets, self._window_size)
@@ -358,6 +375,7 @@ class SGDStrategy(DetectionStrategy):
                     # Commit this window if the features came back fine.
                     negative_features.append([i[1] for i in sorted(feature_dict.items(), key=itemgetter(0))])
                     negative_ips.append(window_ip)
+                    negative_windows.append(tuple([i['pcap_offset'] for i in window if i.get('pcap_offset') is not None]))
 
         time_windows_positive = []
         time_windows_negative = []
@@ -371,10 +389,12 @@ class SGDStrategy(DetectionStrategy):
         self._strategic_states['negative_features'] = np.asarray(negative_features, dtype=np.float64)
         self._strategic_states['positive_ips'] = positive_ips
         self._strategic_states['negative_ips'] = negative_ips
+        self._strategic_states['negative_windows'] = negative_windows
         positive_features = []
         negative_features = []
         positive_ips = []
         negative_ips = []
+        negative_windows = []
 
         # Perform dynamic adjustment if set, otherwise finish after 1 loop.
         for threshold_pct in self.DYNAMIC_THRESHOLD_PERCENTILES:
@@ -420,6 +440,7 @@ class SGDStrategy(DetectionStrategy):
             self._true_positive_rate = self._strategic_states[median_fpr_run]["TPR"]
             self._false_positive_rate = self._strategic_states[median_fpr_run]["FPR"]
             self._negative_blocked_ips = self._strategic_states[median_fpr_run]["negative_blocked_ips"]
+            self._negative_blocked_packets = self._strategic_states[median_fpr_run]["negative_blocked_packets"]
             self._false_positive_blocked_rate = self._strategic_states[median_fpr_run]["false_positive_blocked_rate"]
             self.debug_print("FPR Median: TPR {:0.2f}%, FPR {:0.2f}%, blocked {} ({:0.2f}%)".format(\
              self._true_positive_rate*100, self._false_positive_rate*100,
@@ -6,6 +6,7 @@ from abc import ABC, abstractmethod
 from datetime import date, datetime
 from collections import defaultdict
 from timeit import default_timer
+from concurrent.futures import ThreadPoolExecutor
 from math import log1p
 
 
@@ -23,6 +24,14 @@ class DetectionStrategy(ABC):
     RUN_CONFIG_DESCRIPTION = [] # A list of strings representing the fixed format
                                 # of configuration for each run initiated in
                                 # self.positive_run and self._negative_run.
+    DERIVED_FIELDS = False # Set to True if the strategic filter selects on
+                           # fields derived at ingest, such as payload entropy.
+    PAYLOAD_VIEWS = False # Set to True if TCP payloads are only read, so they can
+                          # be retrieved as views of a shared payload arena.
+    PACKET_RECORDS = False # Set to True if packets are only read by key, so they
+                           # can be retrieved as compact data.retrieve.Packet records.
+    INGEST_PROFILE = "full" # Fields stored when importing pcaps, see
+                            # data.parser.PCAPParser.set_ingest_profile.
 
     def __init__(self, pt_pcap, negative_pcap=None, recall_pcap=None, debug=False):
         self.__debug_on = debug
@@ -57,10 +66,14 @@ class DetectionStrategy(ABC):
         self._recall_packets = []
         self._positive_subnets = []
         self._negative_subnets = []
+        self._positive_matcher = data.utils.SubnetMatcher([])
+        self._negative_matcher = data.utils.SubnetMatcher([])
         self._recall_subnets = []
 
         # The strategic filter to examine a subset of loaded packets.
         self._strategic_packet_filter = {}
+        # The strategic projection to load only a subset of packet fields.
+        self._strategic_packet_projection = None
 
         # The strategy's internal states.
         self._strategic_states = {}
@@ -69,6 +82,7 @@ class DetectionStrategy(ABC):
         self._false_positive_blocked_rate = 0
         self._negative_unique_ips = 0
         self._negative_blocked_ips = set([])
+        self._negative_blocked_packets = set([]) # Pcap offsets of negative packets flagged.
         self._recall_rate = None
         self._test_recall = False
 
@@ -116,11 +130,17 @@ class DetectionStrategy(ABC):
 
         self.__pt_parser = data.parser.PCAPParser(self.__pt_pcap)
         self.__pt_parser.set_ip_filter(pt_filters)
+        self.__pt_parser.set_derived_fields(self.DERIVED_FIELDS)
+        self.__pt_parser.set_ingest_profile(self.INGEST_PROFILE)
         self.set_case_membership(pt_filters, None)
         desp = self.NAME + " positive packets from " + os.path.basename(self.__pt_pcap)
         self._pt_collection = self.__pt_parser.load_and_insert_new(description=desp)
 
-        if self._pt_collection:
+        if self._pt_collection and self.__pt_parser.is_reused():
+            self.debug_print("Reusing existing import of positive packets in " + self._pt_collection + ".")
+            return True
+        elif self._pt_collection:
+            self._report_index_time("positive", self.__pt_parser)
             return True
         else:
             return False
@@ -139,11 +159,17 @@ class DetectionStrategy(ABC):
 
         self.__neg_parser = data.parser.PCAPParser(self.__negative_pcap)
         self.__neg_parser.set_ip_filter(negative_filters)
+        self.__neg_parser.set_derived_fields(self.DERIVED_FIELDS)
+        self.__neg_parser.set_ingest_profile(self.INGEST_PROFILE)
         self.set_case_membership(None, negative_filters)
         desp = self.NAME + " negative packets from " + os.path.basename(self.__negative_pcap)
         self._neg_collection = self.__neg_parser.load_and_insert_new(description=desp)
 
-        if self._neg_collection:
+        if self._neg_collection and self.__neg_parser.is_reused():
+            self.debug_print("Reusing existing import of negative packets in " + self._neg_collection + ".")
+            return True
+        elif self._neg_collection:
+            self._report_index_time("negative", self.__neg_parser)
             return True
         else:
             return False
@@ -162,34 +188,104 @@ class DetectionStrategy(ABC):
 
         self.__recall_parser = data.parser.PCAPParser(self.__recall_pcap)
         self.__recall_parser.set_ip_filter(recall_filters)
+        self.__recall_parser.set_derived_fields(self.DERIVED_FIELDS)
+        self.__recall_parser.set_ingest_profile(self.INGEST_PROFILE)
         desp = self.NAME + " positive recall packets from " + os.path.basename(self.__recall_pcap)
         self._recall_collection = self.__recall_parser.load_and_insert_new(description=desp)
 
-        if self._recall_collection:
+        if self._recall_collection and self.__recall_parser.is_reused():
+            self.debug_print("Reusing existing import of positive recall packets in " + self._recall_collection + ".")
+            return True
+        elif self._recall_collection:
+            self._report_index_time("positive recall", self.__recall_parser)
             return True
         else:
             return False
 
 
+    def _report_index_time(self, case, parser):
+        """
+        Report the time taken to index the packets just imported by the parser.
+
+        :param str case: the description of the packets imported.
+        :param parser: the :class:`~CovertMark.data.parser.PCAPParser` used.
+        """
+
+        index_time = parser.get_index_time()
+        if index_time is None:
+            self.debug_print("Indexing " + case + " packets in the background.")
+        else:
+            self.debug_print("Indexed {} packets in {:0.3f}s.".format(case, index_time))
+
+
+    def _fetch_collection(self, collection_name, count_unique_ips=False):
+        """
+        Retrieve a stored collection with the strategic filter and projection
+        applied, along with its packet count and input filters. A separate
+        retriever is used for each call, so that collections can be fetched
+        concurrently. Packets are retrieved through the process-level trace
+        cache, so they are shared with other strategy instances loading the
+        same trace and are read-only.
+
+        :param str collection_name: the name of the collection to be fetched.
+        :param bool count_unique_ips: if True, also count the distinct
+            destination IP addresses in the collection.
+        :returns: a dict containing `{packets, total, filters, unique_ips, time}`,
+            where time is the number of seconds taken to fetch.
+        """
+
+        time_start = default_timer()
+        reader = data.retrieve.Retriever()
+        reader.select(collection_name)
+        fetched = {}
+        fetched["packets"] = reader.retrieve_cached(trace_filter=self._strategic_packet_filter,
+         projection=self._strategic_packet_projection, payload_views=self.PAYLOAD_VIEWS,
+         records=self.PACKET_RECORDS)
+        fetched["total"] = reader.count(trace_filter={})
+        fetched["filters"] = reader.get_input_filters()
+        fetched["unique_ips"] = reader.distinct('dst') if count_unique_ips else 0
+        fetched["time"] = default_timer() - time_start
+
+        return fetched
+
+
     def _load_into_memory(self):
         """
         Load parsed positive (and if set, negative) test traces from MongoDB
-        into runtime memory for analysis, applying :attr:`_strategic_filter` to
-        both.
+        into runtime memory for analysis, applying :attr:`_strategic_filter` and
+        :attr:`_strategic_packet_projection` to both. Positive, negative and
+        recall traces are fetched concurrently.
 
         :returns: True if successfully loaded, False otherwise.
         """
 
-        self.__reader.select(self._pt_collection)
-        self.debug_print("- Retrieving from {}...".format(self.__reader.current()))
-        self._pt_packets = self.__reader.retrieve(trace_filter=self._strategic_packet_filter)
-        self._pt_collection_total = self.__reader.count(trace_filter={})
+        collections = [("positive", self._pt_collection)]
+        if self._neg_collection is not None:
+            collections.append(("negative", self._neg_collection))
+        if self._recall_collection is not None:
+            collections.append(("positive recall", self._recall_collection))
+
+        for case, collection in collections:
+            self.debug_print("- Retrieving {} packets from {}...".format(case, collection))
+
+        time_start = default_timer()
+        with ThreadPoolExecutor(max_workers=len(collections)) as executor:
+            futures = {case: executor.submit(self._fetch_collection, collection,
+             case == "negative") for case, collection in collections}
+            fetched = {case: future.result() for case, future in futures.items()}
+
+        for case, _ in collections:
+            self.debug_print("Retrieved {} {} packets in {:0.2f}s.".format(len(fetched[case]["packets"]), case, fetched[case]["time"]))
+        self.debug_print("All packets retrieved in {:0.2f}s.".format(default_timer() - time_start))
+
+        self._pt_packets = fetched["positive"]["packets"]
+        self._pt_collection_total = fetched["positive"]["total"]
 
         if len(self._pt_packets) == 0:
             return False
 
         # Reload positive filters.
-        pt_filters = self.__reader.get_input_filters()
+        pt_filters = fetched["positive"]["filters"]
         if pt_filters:
             pt_clients = [i[0] for i in pt_filters]
             self.debug_print("- Automatically setting the corresponding input filters for positive clients: {}".format(str(pt_clients)))
@@ -200,19 +296,17 @@ class DetectionStrategy(ABC):
 
         # If no negative pcap parsed, we skip it.
         if self._neg_collection is not None:
-            self.__reader.select(self._neg_collection)
-            self.debug_print("- Retrieving from {}...".format(self.__reader.current()))
-            self._neg_packets = self.__reader.retrieve(trace_filter=self._strategic_packet_filter)
-            self._neg_collection_total = self.__reader.count(trace_filter={})
+            self._neg_packets = fetched["negative"]["packets"]
+            self._neg_collection_total = fetched["negative"]["total"]
 
             # Record distinct destination IP addresses for stat reporting.
-            self._negative_unique_ips = self.__reader.distinct('dst')
+            self._negative_unique_ips = fetched["negative"]["unique_ips"]
 
             if len(self._neg_packets) == 0:
                 return False
 
             # Reload negative filters.
-            neg_filters = self.__reader.get_input_filters()
+            neg_filters = fetched["negative"]["filters"]
             if neg_filters:
                 neg_clients = [i[0] for i in neg_filters]
                 self.debug_print("- Automatically setting the corresponding input filters for negative clients: {}".format(str(neg_clients)))
@@ -226,13 +320,11 @@ class DetectionStrategy(ABC):
             self._packets_loaded = True
             return True
 
-        self.__reader.select(self._recall_collection)
-        self.debug_print("- Retrieving from {}...".format(self.__reader.current()))
-        self._recall_packets = self.__reader.retrieve(trace_filter=self._strategic_packet_filter)
-        self._recall_collection_total = self.__reader.count(trace_filter={})
+        self._recall_packets = fetched["positive recall"]["packets"]
+        self._recall_collection_total = fetched["positive recall"]["total"]
 
         # Set recall subnets.
-        recall_filters = self.__reader.get_input_filters()
+        recall_filters = fetched["positive recall"]["filters"]
         if recall_filters:
             self._recall_subnets = [data.utils.build_subnet(i[0]) for i in recall_filters if i[1] in [data.constants.IP_SRC, data.constants.IP_EITHER]]
             self.debug_print("Automatically set the corresponding input filters for recall clients: {}.".format(str([i[0] for i in recall_filters])))
@@ -247,6 +339,49 @@ class DetectionStrategy(ABC):
         return True
 
 
+    def _collection_reader(self, collection_name):
+        """
+        Select a stored collection for server-side summaries, allowing strategies
+        to count or group packets in MongoDB without retrieving them.
+
+        :param str collection_name: the name of the collection to be summarised.
+        :returns: the :class:`~CovertMark.data.retrieve.Retriever` with the
+            collection selected.
+        :raises ValueError: if the collection does not exist.
+        """
+
+        if not self.__reader.select(collection_name):
+            raise ValueError("Collection to summarise does not exist: " + str(collection_name))
+
+        return self.__reader
+
+
+    def _count_presence(self, collection_name, packets):
+        """
+        Count packets of a stored collection under the strategic filter bearing
+        valid TLS records or HTTP requests, as summarised by
+        :meth:`~CovertMark.data.retrieve.Retriever.count_presence`. If the
+        summary fails, the packets of the collection loaded are counted instead.
+
+        :param str collection_name: the name of the collection to be summarised.
+        :param list packets: packets loaded from the collection under the
+            strategic filter.
+        :returns: a dict containing `{total, tls, http, non_tls_http}` as in
+            :meth:`~CovertMark.data.retrieve.Retriever.count_presence`.
+        :raises ValueError: if the collection does not exist.
+        """
+
+        presence = self._collection_reader(collection_name).count_presence(self._strategic_packet_filter)
+        if presence is None:
+            self.debug_print("Warning: failed to summarise " + collection_name + ", counting loaded packets instead.")
+            tls = [i.get("tls_info") is not None for i in packets]
+            http = [i.get("http_info") is not None for i in packets]
+            presence = {"total": len(packets), "tls": sum(tls), "http": sum(http),
+             "non_tls_http": sum([h and not t for t, h in zip(tls, http)])}
+
+        return presence
+
+
     def set_case_membership(self, positive_filters, negative_filters):
         """
         Set an internal list of positive and negative subnets for membership
@@ -264,12 +399,14 @@ class DetectionStrategy(ABC):
             if all(positive_subnets):
                 self._positive_filters = positive_filters
                 self._positive_subnets = positive_subnets
+                self._positive_matcher = data.utils.SubnetMatcher(positive_subnets)
 
         if negative_filters:
             negative_subnets = [data.utils.build_subnet(i[0]) for i in negative_filters]
             if all(negative_subnets):
                 self._negative_filters = negative_filters
                 self._negative_subnets = negative_subnets
+                self._negative_matcher = data.utils.SubnetMatcher(negative_subnets)
 
         return True
 
@@ -283,6 +420,9 @@ class DetectionStrategy(ABC):
             False otherwise, or if input invalid.
         """
 
+        if isinstance(ip, str) and "/" not in ip: # Single addresses are matched in their compact form.
+            return self._positive_matcher.match_address(ip)
+
         ip_subnet = data.utils.build_subnet(ip)
         if not ip_subnet:
             return False
@@ -303,6 +443,9 @@ class DetectionStrategy(ABC):
             False otherwise, or if input invalid.
         """
 
+        if isinstance(ip, str) and "/" not in ip: # Single addresses are matched in their compact form.
+            return self._negative_matcher.match_address(ip)
+
         ip_subnet = data.utils.build_subnet(ip)
         if not ip_subnet:
             return False
@@ -375,6 +518,7 @@ class DetectionStrategy(ABC):
 
         # Clear the falsely block set.
         self._negative_blocked_ips = set()
+        self._negative_blocked_packets = set()
 
         fpr = self.negative_run(**kwargs)
         self._false_positive_rate = fpr
@@ -625,6 +769,9 @@ class DetectionStrategy(ABC):
         self.debug_print("- Setting strategic filter...")
         self.set_strategic_filter()
         self.debug_print("Strategy filter on traces from MongoDB: {}".format(self._strategic_packet_filter))
+        self.set_strategic_projection()
+        if self._strategic_packet_projection:
+            self.debug_print("Strategy projection on traces from MongoDB: {}".format(self._strategic_packet_projection))
 
         self.debug_print("- Loading packets according to the initial strategic filter...")
         self._load_into_memory()
@@ -763,15 +910,43 @@ class DetectionStrategy(ABC):
         :meth:`load` should be called again after each change of filter to reload
         the postive and negative traces with the new filter.
 
-        :param dict new_filter: MongoDB trace querying filter, examples:
-            - Only examine TCP packets: {"tcp_info": {"$ne": None}}
+        :param dict new_filter: MongoDB trace querying filter, preferably on
+            fields indexed at import (see :const:`~CovertMark.data.constants.TRACE_INDEXES`), examples:
+            - Only examine TCP packets: :const:`~CovertMark.data.constants.TCP_FILTER`
             - Only examine TCP packets with non-empty payload:
-            {"tcp_info": {"$ne": None}, "tcp_info.payload": {"$ne": b''}}
+            :const:`~CovertMark.data.constants.TCP_PAYLOAD_FILTER`, which
+            unlike {"tcp_info.payload_len": {"$gt": 0}} also selects packets
+            imported before payload lengths were recorded
+            - Only examine high-entropy TCP payloads of at least 128 bytes, with
+            :attr:`DERIVED_FIELDS` set:
+            {"tcp_info.payload_len": {"$gte": 128}, "tcp_info.payload_entropy": {"$gte": 7}}
         """
 
         self._strategic_packet_filter = new_filter
 
 
+    def set_strategic_projection(self, new_projection=None):
+        """
+        If this strategy only reads certain fields of the packets examined, such
+        as lengths and addresses but not payloads, they should be declared here
+        in the strategic projection, so that other fields are not transferred
+        from MongoDB. The syntax follows MongoDB projections on the packet syntax.
+        (For packet syntax see :meth:`~CovertMark.data.parser.PCAPParser.load_packet_info`)
+        Override this method by assigning to :attr:`_strategic_packet_projection`,
+        by default full packets are loaded. As with :meth:`set_strategic_filter`,
+        :meth:`load` should be called again after each change of projection.
+
+        :param dict new_projection: MongoDB projection, or None to load full
+            packets. Examples:
+            - Only load addresses and payload lengths:
+            {"src": True, "dst": True, "tcp_info.payload_len": True}
+            - Load all but the TLS records and TCP options:
+            {"tls_info.data": False, "tcp_info.opts": False}
+        """
+
+        self._strategic_packet_projection = new_projection
+
+
     def test_validation_split(self, split_ratio):
         """
         Perform a split of positive test packets into test and validation sets if
@@ -822,7 +997,9 @@ class DetectionStrategy(ABC):
         --- :attr:`_negative_unique_ips`
         Assign to :attr:`_strategic_states` if information needs to be stored
         between runs or carried over into positive test runs.
-        Add to :attr:`_negative_blocked_ips` to tally blocked IPs for reporting.
+        Add to :attr:`_negative_blocked_ips` to tally blocked IPs for reporting,
+        and the `pcap_offset` of each negative packet flagged to
+        :attr:`_negative_blocked_packets` for :meth:`extract_blocked_packets`.
         Implement this method, simply return 0 if no negative trace required.
 
         :returns: False positive identification rate as your strategy interprets.
@@ -861,6 +1038,48 @@ class DetectionStrategy(ABC):
         return ""
 
 
+    def blocked_packet_filter(self):
+        """
+        Return a MongoDB query filter selecting the negative packets flagged as
+        positives under the configuration reported by :meth:`report_blocked_ips`.
+        By default these are the packets at the pcap offsets in
+        :attr:`_negative_blocked_packets`. Override this method if flagged
+        packets are not tested individually, but can be described by a filter.
+
+        :returns: a MongoDB query filter.
+        """
+
+        return {"pcap_offset": {"$in": sorted(self._negative_blocked_packets)}}
+
+
+    def extract_blocked_packets(self, output_file):
+        """
+        Write the negative packets flagged as positives, as selected by
+        :meth:`blocked_packet_filter`, to a new pcap, reading them directly
+        from the negative pcap rather than re-scanning it.
+
+        :param str output_file: path to the new pcap file, overwritten if exists.
+        :returns: the number of packets written, False if no negative trace
+            was parsed from a pcap, or if the negative pcap is missing or no
+            longer the one the trace was imported from.
+        """
+
+        if self._neg_collection is None or self.__negative_pcap is None:
+            return False
+
+        try:
+            extractor = data.extractor.PCAPExtractor(self.__negative_pcap, self._neg_collection)
+        except FileNotFoundError:
+            return False
+
+        # Recorded locations only apply to the pcap imported.
+        if extractor.verify() is False:
+            self.debug_print("Negative pcap has changed since import, not extracting packets.")
+            return False
+
+        return extractor.extract(output_file, self.blocked_packet_filter())
+
+
     def interpret_config(self, config_set):
         """
         Interpret as string a configuration passed into :meth:`run_on_positive`
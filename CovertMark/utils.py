@@ -7,6 +7,7 @@ from collections import Counter
 from tabulate import tabulate
 from datetime import date
 from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
 import hashlib
 
 from . import data, strategy
@@ -252,7 +253,7 @@ def import_procedure(import_path, strategy_map):
     return procedure
 
 
-def execute_procedure(procedure, strategy_map, db_sub=False):
+def execute_procedure(procedure, strategy_map, db_sub=False, workers=1):
     """
     Execute a validated procedure and preserve their strategy states in order.
 
@@ -260,7 +261,11 @@ def execute_procedure(procedure, strategy_map, db_sub=False):
     :param dict strategy_map: a strategy map validated by covertmark.py.
     :param bool db_sub: subsitute PCAP and input filters specified in the procedure
         with MongoDB-stored collection names, eliminating importing the same
-        pcap file with same filters.
+        pcap file with same filters. Imports of identical pcap content and
+        filters from previous sessions are reused by the parser regardless.
+    :param int workers: the maximum number of runs executed concurrently in
+        separate processes. If more than 1, each distinct pcap and filters pair
+        is imported exactly once before the runs start.
     :returns: a list of tuples each containing a strategy instances executed
         based on runs specified in the procedure, and the run specification.
         Returns empty list if execution fails. If `db_sub` is set, the updated
@@ -276,110 +281,53 @@ def execute_procedure(procedure, strategy_map, db_sub=False):
         else:
             return []
 
+    if workers > 1:
+        completed_instances = _execute_runs_parallel(procedure, strategy_map, db_sub, workers)
+        if db_sub:
+            return completed_instances, procedure
+        else:
+            return completed_instances
+
     mongo_reader = data.retrieve.Retriever()
     completed_instances = []
     imported_pcaps = {}
     for run in procedure:
         strat = strategy_map[run["strategy"]]
-        strategy_module = getattr(strategy, strat["module"])
-        strategy_object = getattr(strategy_module, strat["object"])
         use_negative = strat["negative_input"]
         run_info = [i for i in strat["runs"] if i["run_order"] == run["run_order"]][0]
-
-        # Retrieve the IP filters.
-        if mongo_reader.select(run["pt_collection"]):
-            pt_filters = mongo_reader.get_input_filters()
-            pt_use_collection = True
-        else:
-            pt_filters = run["pt_filters"]
-            pt_key = format_pcap_filters(run["pt_pcap"], pt_filters, run_info["pt_filters_reverse"])
-            if db_sub and pt_key in imported_pcaps:
-                run["pt_collection"] = imported_pcaps[pt_key]
-                pt_use_collection = True
-            else:
-                pt_use_collection = False
-
-        if use_negative:
-            if mongo_reader.select(run["neg_collection"]):
-                negative_filters = mongo_reader.get_input_filters()
-                negative_use_collection = True
-            else:
-                negative_filters = run["neg_filters"]
-                negative_use_collection = False
-                neg_key = format_pcap_filters(run["neg_pcap"], negative_filters, run_info["negative_filters_reverse"])
-                if db_sub and neg_key in imported_pcaps:
-                    run["neg_collection"] = imported_pcaps[neg_key]
-                    negative_use_collection = True
-                else:
-                    negative_use_collection = False
-
-        # Composition of filters should have been validated in strategy map
-        # reading, but for correctness asserted here.
-        if not pt_use_collection:
-            assert(set([i[1] for i in pt_filters]) == set(strat["pt_filters"]))
-        if use_negative and not negative_use_collection:
-            assert(set([i[1] for i in negative_filters]) == set(strat["negative_filters"]))
-
-        # Map the filters.
-        if run_info["pt_filters_reverse"]:
-            pt_filters = [[x[0], strategy.constants.FILTERS_REVERSE_MAP[x[1]]] for x in pt_filters]
-        if use_negative and run_info["negative_filters_reverse"]:
-            negative_filters = [[x[0], strategy.constants.FILTERS_REVERSE_MAP[x[1]]] for x in negative_filters]
-
-        print("Attempting to execute " + strategy_object.NAME + " for " + run_info["run_description"] + "...\n")
-        print("User defined name: " + run["user_defined_name"] + ".")
-
-        # Construct the parameters if applicable (PCAP path, input filters, existing collection)
-        if pt_use_collection:
-            pt_params = ["_", [], run["pt_collection"]]
-        else:
-            pt_filters = [tuple(i) for i in pt_filters] # Compability.
-            pt_params = [run["pt_pcap"], pt_filters, None]
-
-        if use_negative:
-            if negative_use_collection:
-                neg_params = ["_", [], run["neg_collection"]]
-            else:
-                negative_filters = [tuple(i) for i in negative_filters] # Compability.
-                neg_params = [run["neg_pcap"], negative_filters, None]
-        else:
-            neg_params = [None, [], None]
-
-        user_params = {i[0]: i[1] for i in run["user_params"]}
-
-        # Append strategy-fixed parameters to the runtime parameters, which take
-        # precedence over user parameters if there is a clash.
-        for param, value in strat["fixed_params"]:
-            user_params[param] = value
-
-        try:
-            strategy_instance = strategy_object(pt_params[0], neg_params[0])
-            strategy_instance.setup(pt_ip_filters=pt_params[1],
-                                    negative_ip_filters=neg_params[1],
-                                    pt_collection=pt_params[2],
-                                    negative_collection=neg_params[2])
-            strategy_instance.run(**user_params)
-
-            # Record collection imported for possible reuse.
-            if not pt_use_collection:
-                pt_key = format_pcap_filters(run["pt_pcap"], pt_filters, run_info["pt_filters_reverse"])
-                imported_pcaps[pt_key] = strategy_instance._pt_collection
-                if db_sub:
-                    run["pt_collection"] = strategy_instance._pt_collection
-            if use_negative and (not negative_use_collection):
-                neg_key = format_pcap_filters(run["neg_pcap"], negative_filters, run_info["negative_filters_reverse"])
-                imported_pcaps[neg_key] = strategy_instance._neg_collection
-                if db_sub:
-                    run["neg_collection"] = strategy_instance._neg_collection
-
-            # Light weight storage of states we actually need.
-            strategy_instance.destroy_traces()
-        except Exception as e:
-            print(str(e))
-            print("Exception was raised during the execution of this strategy, skipping...")
+        strategy_object = getattr(getattr(strategy, strat["module"]), strat["object"])
+        stored = (strategy_object.DERIVED_FIELDS, strategy_object.INGEST_PROFILE)
+
+        # Substitute previously imported pcaps if applicable, as long as they
+        # store the fields needed by this strategy.
+        pt_imported = not mongo_reader.select(run["pt_collection"])
+        if pt_imported:
+            pt_key = format_pcap_filters(run["pt_pcap"], run["pt_filters"], run_info["pt_filters_reverse"])
+            if db_sub and pt_key in imported_pcaps and _covers_import(imported_pcaps[pt_key], stored):
+                run["pt_collection"] = imported_pcaps[pt_key][0]
+                pt_imported = False
+
+        negative_imported = use_negative and not mongo_reader.select(run["neg_collection"])
+        if negative_imported:
+            neg_key = format_pcap_filters(run["neg_pcap"], run["neg_filters"], run_info["negative_filters_reverse"])
+            if db_sub and neg_key in imported_pcaps and _covers_import(imported_pcaps[neg_key], stored):
+                run["neg_collection"] = imported_pcaps[neg_key][0]
+                negative_imported = False
+
+        strategy_instance = _execute_run(run, strategy_map)
+        if strategy_instance is None:
             continue
 
-        print("Strategy run execution successful, saving the instance states.\n")
+        # Record collection imported for possible reuse.
+        if pt_imported:
+            imported_pcaps[pt_key] = (strategy_instance._pt_collection,) + stored
+            if db_sub:
+                run["pt_collection"] = strategy_instance._pt_collection
+        if negative_imported:
+            imported_pcaps[neg_key] = (strategy_instance._neg_collection,) + stored
+            if db_sub:
+                run["neg_collection"] = strategy_instance._neg_collection
+
         completed_instances.append((strategy_instance, run))
 
     if db_sub:
@@ -388,6 +336,224 @@ def execute_procedure(procedure, strategy_map, db_sub=False):
         return completed_instances
 
 
+def _execute_runs_parallel(procedure, strategy_map, db_sub, workers):
+    """
+    Execute runs of a validated procedure in a pool of worker processes. Each
+    distinct pcap and filters pair is imported once by the pool first, after
+    which runs only read from existing collections and share no state.
+
+    :param dict procedure: a validated CovertMark procedure.
+    :param dict strategy_map: a strategy map validated by covertmark.py.
+    :param bool db_sub: if True, runs in the procedure are updated with names
+        of the collections imported.
+    :param int workers: the maximum number of concurrent worker processes.
+    :returns: a list of tuples each containing a strategy instance executed and
+        its run specification, in procedure order.
+    """
+
+    mongo_reader = data.retrieve.Retriever()
+    imports = {}
+    run_imports = []
+    for run in procedure:
+        strat = strategy_map[run["strategy"]]
+        strategy_object = getattr(getattr(strategy, strat["module"]), strat["object"])
+        run_info = [i for i in strat["runs"] if i["run_order"] == run["run_order"]][0]
+
+        inputs = [("pt_collection", "pt_pcap", "pt_filters", "pt_filters_reverse")]
+        if strat["negative_input"]:
+            inputs.append(("neg_collection", "neg_pcap", "neg_filters", "negative_filters_reverse"))
+
+        keys = {}
+        for collection_field, pcap_field, filters_field, reverse_field in inputs:
+            if mongo_reader.select(run[collection_field]):
+                continue
+            key = format_pcap_filters(run[pcap_field], run[filters_field], run_info[reverse_field])
+            keys[collection_field] = key
+
+            # Derived fields are stored if any run using the import needs them,
+            # and under the profile storing the most fields needed by any run.
+            derive = strategy_object.DERIVED_FIELDS
+            profile = strategy_object.INGEST_PROFILE
+            if key in imports:
+                derive = derive or imports[key][2]
+                if data.utils.covers_profile(imports[key][3], profile):
+                    profile = imports[key][3]
+            input_filters = run[filters_field]
+            if run_info[reverse_field]:
+                input_filters = [[x[0], strategy.constants.FILTERS_REVERSE_MAP[x[1]]] for x in input_filters]
+            imports[key] = (run[pcap_field], [tuple(i) for i in input_filters], derive, profile)
+
+        run_imports.append(keys)
+
+    completed_instances = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        print("Importing " + str(len(imports)) + " distinct pcap inputs...\n")
+        import_futures = {key: pool.submit(_import_pcap, *imports[key]) for key in imports}
+        imported_pcaps = {}
+        for key, future in import_futures.items():
+            try:
+                imported_pcaps[key] = future.result()
+            except Exception as e:
+                print(str(e))
+                imported_pcaps[key] = False
+
+        run_futures = []
+        for run, keys in zip(procedure, run_imports):
+            run_input = deepcopy(run)
+            for collection_field, key in keys.items():
+                if imported_pcaps[key]:
+                    run_input[collection_field] = imported_pcaps[key]
+                    if db_sub:
+                        run[collection_field] = imported_pcaps[key]
+            run_futures.append(pool.submit(_execute_run, run_input, strategy_map))
+
+        for run, future in zip(procedure, run_futures):
+            try:
+                strategy_instance = future.result()
+            except Exception as e:
+                print(str(e))
+                print("Exception was raised by the worker executing this strategy, skipping...")
+                continue
+            if strategy_instance is not None:
+                completed_instances.append((strategy_instance, run))
+
+    return completed_instances
+
+
+def _covers_import(imported, required):
+    """
+    Check whether a collection imported earlier in a procedure stores the
+    fields required by a strategy.
+
+    :param tuple imported: the collection name, whether derived fields are
+        stored, and the ingest profile of the import.
+    :param tuple required: whether derived fields are needed, and the ingest
+        profile needed.
+    :returns: True if the import can be used.
+    """
+
+    return (imported[1] or not required[0]) and data.utils.covers_profile(imported[2], required[1])
+
+
+def _import_pcap(pcap_path, input_filters, derived_fields, ingest_profile="full"):
+    """
+    Import a pcap into a new collection, reusing an identical existing import.
+
+    :param str pcap_path: the path to the pcap file.
+    :param list input_filters: list of tuples (filter, direction) to import by.
+    :param bool derived_fields: whether to store derived fields at ingest.
+    :param str ingest_profile: the ingest profile to store packets under.
+    :returns: the name of the collection imported, False if failed.
+    """
+
+    # The catalog cached by the parent process before forking misses imports
+    # completed since by other workers.
+    data.mongo.catalog_cache.invalidate()
+
+    parser = data.parser.PCAPParser(os.path.expanduser(pcap_path))
+    parser.set_ip_filter(input_filters)
+    parser.set_derived_fields(derived_fields)
+    parser.set_ingest_profile(ingest_profile)
+    desp = "Procedure packets from " + os.path.basename(pcap_path)
+
+    return parser.load_and_insert_new(description=desp)
+
+
+def _execute_run(run, strategy_map):
+    """
+    Execute a single run of a validated procedure, importing its pcap inputs
+    unless existing collections are specified.
+
+    :param dict run: a run of a validated CovertMark procedure.
+    :param dict strategy_map: a strategy map validated by covertmark.py.
+    :returns: the strategy instance executed with its traces destroyed, None
+        if the execution failed.
+    """
+
+    data.mongo.catalog_cache.invalidate() # See _import_pcap.
+
+    mongo_reader = data.retrieve.Retriever()
+    strat = strategy_map[run["strategy"]]
+    strategy_module = getattr(strategy, strat["module"])
+    strategy_object = getattr(strategy_module, strat["object"])
+    use_negative = strat["negative_input"]
+    run_info = [i for i in strat["runs"] if i["run_order"] == run["run_order"]][0]
+
+    # Retrieve the IP filters.
+    if mongo_reader.select(run["pt_collection"]):
+        pt_filters = mongo_reader.get_input_filters()
+        pt_use_collection = True
+    else:
+        pt_filters = run["pt_filters"]
+        pt_use_collection = False
+
+    if use_negative:
+        if mongo_reader.select(run["neg_collection"]):
+            negative_filters = mongo_reader.get_input_filters()
+            negative_use_collection = True
+        else:
+            negative_filters = run["neg_filters"]
+            negative_use_collection = False
+
+    # Composition of filters should have been validated in strategy map
+    # reading, but for correctness asserted here.
+    if not pt_use_collection:
+        assert(set([i[1] for i in pt_filters]) == set(strat["pt_filters"]))
+    if use_negative and not negative_use_collection:
+        assert(set([i[1] for i in negative_filters]) == set(strat["negative_filters"]))
+
+    # Map the filters.
+    if run_info["pt_filters_reverse"]:
+        pt_filters = [[x[0], strategy.constants.FILTERS_REVERSE_MAP[x[1]]] for x in pt_filters]
+    if use_negative and run_info["negative_filters_reverse"]:
+        negative_filters = [[x[0], strategy.constants.FILTERS_REVERSE_MAP[x[1]]] for x in negative_filters]
+
+    print("Attempting to execute " + strategy_object.NAME + " for " + run_info["run_description"] + "...\n")
+    print("User defined name: " + run["user_defined_name"] + ".")
+
+    # Construct the parameters if applicable (PCAP path, input filters, existing collection)
+    if pt_use_collection:
+        pt_params = ["_", [], run["pt_collection"]]
+    else:
+        pt_filters = [tuple(i) for i in pt_filters] # Compability.
+        pt_params = [run["pt_pcap"], pt_filters, None]
+
+    if use_negative:
+        if negative_use_collection:
+            neg_params = ["_", [], run["neg_collection"]]
+        else:
+            negative_filters = [tuple(i) for i in negative_filters] # Compability.
+            neg_params = [run["neg_pcap"], negative_filters, None]
+    else:
+        neg_params = [None, [], None]
+
+    user_params = {i[0]: i[1] for i in run["user_params"]}
+
+    # Append strategy-fixed parameters to the runtime parameters, which take
+    # precedence over user parameters if there is a clash.
+    for param, value in strat["fixed_params"]:
+        user_params[param] = value
+
+    try:
+        strategy_instance = strategy_object(pt_params[0], neg_params[0])
+        strategy_instance.setup(pt_ip_filters=pt_params[1],
+                                negative_ip_filters=neg_params[1],
+                                pt_collection=pt_params[2],
+                                negative_collection=neg_params[2])
+        strategy_instance.run(**user_params)
+
+        # Light weight storage of states we actually need.
+        strategy_instance.destroy_traces()
+    except Exception as e:
+        print(str(e))
+        print("Exception was raised during the execution of this strategy, skipping...")
+        return None
+
+    print("Strategy run execution successful, saving the instance states.\n")
+
+    return strategy_instance
+
+
 def printable_procedure(procedure, strategy_map):
     """
     Provide a pretty-print tabulate of programmed strategy runs in the procedure.
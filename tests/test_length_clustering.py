@@ -0,0 +1,58 @@
+import unittest
+
+import numpy as np
+from sklearn.cluster import MeanShift
+
+from CovertMark.analytics import traffic
+
+
+def meanshift_clusters(lengths, bandwidth):
+    """
+    Cluster lengths as the original scikit-learn implementation did.
+    """
+
+    points = np.array([[length, 0] for length in lengths], dtype=float)
+    meanshift = MeanShift(bandwidth=bandwidth, bin_seeding=True).fit(points)
+
+    clusters = []
+    for i in range(len(meanshift.cluster_centers_)):
+        members = set(int(length) for length in points[meanshift.labels_ == i, 0])
+        if len(members) > 0:
+            clusters.append(members)
+
+    return clusters
+
+
+class LengthClusteringTest(unittest.TestCase):
+
+    def assertMatchesMeanShift(self, lengths, bandwidth):
+        histogram = np.bincount(lengths)
+        self.assertEqual(traffic.cluster_length_histogram(histogram, bandwidth),
+         meanshift_clusters(lengths, bandwidth))
+
+
+    def test_tied_modes(self):
+        self.assertMatchesMeanShift([10, 10, 20, 20], 3)
+        self.assertMatchesMeanShift([10, 10, 11, 20, 20, 21], 3)
+        self.assertMatchesMeanShift([100, 100, 100, 200, 200, 200, 300, 300, 300], 5)
+        self.assertMatchesMeanShift([12, 12, 40, 40, 68, 68], 4)
+        self.assertMatchesMeanShift([30, 30, 31, 31, 60, 60, 61, 61, 90], 2)
+        self.assertMatchesMeanShift([3, 9, 9, 15, 15], 2)
+
+
+    def test_unbinned_seeds(self):
+        # Every length falls in a bin of its own, so lengths are seeded directly.
+        self.assertMatchesMeanShift([2, 23, 29], 5)
+        self.assertMatchesMeanShift([5, 40, 90, 91], 3)
+        self.assertMatchesMeanShift([1, 2, 3, 50, 51, 52], 1)
+        self.assertMatchesMeanShift([7], 1)
+
+
+    def test_empty_and_invalid(self):
+        self.assertEqual(traffic.cluster_length_histogram(np.zeros(10, dtype=int), 3), [])
+        with self.assertRaises(ValueError):
+            traffic.cluster_length_histogram(np.bincount([1, 2]), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import socket
+import shutil
+import tempfile
+import unittest
+
+import dpkt
+
+from CovertMark.data import backend, constants, parser, retrieve
+
+
+def write_pcap(pcap_file):
+    """
+    Write a small pcap of TCP packets from 10.0.0.1, some carrying a TLS
+    application data record.
+    """
+
+    with open(pcap_file, 'wb') as f:
+        writer = dpkt.pcap.Writer(f)
+        for i in range(20):
+            payload = b"\x17\x03\x03\x00\x05hello" if i % 2 else bytes(range(i + 1))
+            tcp = dpkt.tcp.TCP(sport=40000, dport=443, flags=dpkt.tcp.TH_ACK | dpkt.tcp.TH_PUSH,
+             seq=i, ack=i, data=payload)
+            ip = dpkt.ip.IP(src=socket.inet_aton("10.0.0.1"), dst=socket.inet_aton("10.0.1.1"),
+             p=dpkt.ip.IP_PROTO_TCP, data=tcp)
+            ip.len = 20 + len(bytes(tcp))
+            writer.writepkt(bytes(dpkt.ethernet.Ethernet(type=dpkt.ethernet.ETH_TYPE_IP, data=ip)),
+             ts=1500000000 + i)
+
+
+class TraceCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._settings = (constants.STORAGE_BACKEND, constants.COLUMNAR_STORE_PATH)
+        constants.STORAGE_BACKEND = "columnar"
+        constants.COLUMNAR_STORE_PATH = os.path.join(self._directory, "traces")
+        backend.trace_cache.invalidate()
+
+        pcap_file = os.path.join(self._directory, "trace.pcap")
+        write_pcap(pcap_file)
+        pcap_parser = parser.PCAPParser(pcap_file)
+        pcap_parser.set_ip_filter([("10.0.0.1", constants.IP_SRC)])
+        self._retriever = retrieve.Retriever()
+        self.assertTrue(self._retriever.select(pcap_parser.load_and_insert_new("Test trace.")))
+
+
+    def tearDown(self):
+        backend.trace_cache.invalidate()
+        constants.STORAGE_BACKEND, constants.COLUMNAR_STORE_PATH = self._settings
+        shutil.rmtree(self._directory)
+
+
+    def test_cached_packets_are_read_only(self):
+        for records in [False, True]:
+            packets = self._retriever.retrieve_cached(records=records)
+            self.assertEqual(len(packets), 20)
+            tls_packet = [i for i in packets if i["tls_info"] is not None][0]
+
+            with self.assertRaises(TypeError):
+                packets[0]["dst"] = "10.0.2.2"
+            with self.assertRaises(TypeError):
+                del packets[0]["src"]
+            with self.assertRaises(TypeError):
+                packets[0]["tcp_info"]["payload"] = b""
+            with self.assertRaises(TypeError):
+                tls_packet["tls_info"]["type"] = None
+            with self.assertRaises((TypeError, AttributeError)):
+                tls_packet["tls_info"]["data"].append(b"")
+
+            # Copies may be modified without affecting the cached trace.
+            copied = dict(packets[0])
+            copied["dst"] = "10.0.2.2"
+
+            cached = self._retriever.retrieve_cached(records=records)
+            self.assertIs(cached, packets)
+            self.assertEqual(cached[0]["dst"], "10.0.1.1")
+            self.assertEqual(cached[0]["src"], "10.0.0.1")
+            self.assertEqual(bytes(cached[0]["tcp_info"]["payload"]), b"\x00")
+            self.assertEqual([bytes(i) for i in tls_packet["tls_info"]["data"]], [b"hello"])
+
+
+if __name__ == "__main__":
+    unittest.main()